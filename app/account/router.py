@@ -0,0 +1,215 @@
+import json
+from datetime import datetime, timezone
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from fastapi import APIRouter, Depends, HTTPException, Header, Request
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.account.schema import AccountRecord, BookmarkRecord, ImportResult, ShelfRecord, TagRecord
+from app.cache.etag import etag_matches, not_modified
+from app.cache.response import BOOKMARKS, TAGS, response_cache
+from app.config import cfg
+from app.database.connection.session import AsyncSessionLocal, get_session
+from app.database.models.bookmark import Bookmark, BookmarkInShelf, Shelf
+from app.database.models.tag import Tag, UserTag
+from app.tags.service import tag_dictionary
+from app.users.service import bump_version, get_version, version_etag
+
+router = APIRouter(prefix="/account", tags=["account"])
+
+
+def _dump(record: dict) -> bytes:
+    return json.dumps(record, ensure_ascii=False).encode() + b"\n"
+
+
+async def _export_lines(user_id: int) -> AsyncIterator[bytes]:
+    # отдельная сессия живёт, пока отдаётся ответ; строки читаются серверным курсором.
+    # все запросы видят один снимок: полка, созданная во время выгрузки, не попадёт в неё
+    # без своих закладок, и файл загрузится обратно без "Unknown shelf"
+    async with AsyncSessionLocal() as session:
+        await session.connection(execution_options={"isolation_level": "REPEATABLE READ",
+                                                    "postgresql_readonly": True})
+        shelves_query = (select(Shelf.id, Shelf.name)
+                         .where(Shelf.fk_user == user_id)
+                         .order_by(Shelf.id)
+                         .execution_options(yield_per=cfg.account_batch_size))
+        result = await session.stream(shelves_query)
+        async for rows in result.partitions():
+            yield b"".join(_dump({"type": "shelf", "id": row.id, "name": row.name}) for row in rows)
+
+        bookmarks_query = (select(BookmarkInShelf.fk_shelf, BookmarkInShelf.fk_bookmark, BookmarkInShelf.title)
+                           .join(Shelf, Shelf.id == BookmarkInShelf.fk_shelf)
+                           .where(Shelf.fk_user == user_id)
+                           .order_by(BookmarkInShelf.fk_shelf, BookmarkInShelf.fk_bookmark)
+                           .execution_options(yield_per=cfg.account_batch_size))
+        result = await session.stream(bookmarks_query)
+        async for rows in result.partitions():
+            yield b"".join(_dump({"type": "bookmark", "shelf_id": row.fk_shelf,
+                                  "bookmark_id": row.fk_bookmark, "title": row.title}) for row in rows)
+
+        tags_query = (select(Tag.name, UserTag.created_at)
+                      .join(UserTag, UserTag.tag_id == Tag.id)
+                      .where(UserTag.user_id == user_id)
+                      .order_by(Tag.name)
+                      .execution_options(yield_per=cfg.account_batch_size))
+        result = await session.stream(tags_query)
+        async for rows in result.partitions():
+            yield b"".join(_dump({"type": "tag", "name": row.name,
+                                  "created_at": row.created_at.isoformat()}) for row in rows)
+
+
+async def _read_records(request: Request) -> AsyncIterator:
+    buffer = b""
+    line_number = 0
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            line_number += 1
+            _check_line_size(line, line_number)
+            if line.strip():
+                yield _parse_record(line, line_number)
+        # незавершённая строка не копится без предела
+        _check_line_size(buffer, line_number + 1)
+    if buffer.strip():
+        yield _parse_record(buffer, line_number + 1)
+
+
+def _check_line_size(line: bytes, line_number: int) -> None:
+    if len(line) > cfg.account_max_line_size:
+        raise HTTPException(status_code=413, detail=f"Record on line {line_number} is too large")
+
+
+def _parse_record(line: bytes, line_number: int):
+    try:
+        return AccountRecord.validate_json(line)
+    except ValidationError:
+        raise HTTPException(status_code=400, detail=f"Invalid record on line {line_number}")
+
+
+class AccountImporter:
+    """Накапливает записи импорта и записывает их пачками в текущей транзакции."""
+
+    def __init__(self, session: AsyncSession, user_id: int):
+        self.session = session
+        self.user_id = user_id
+        self.shelf_ids: Dict[int, int] = {}
+        self.shelves: List[ShelfRecord] = []
+        self.bookmarks: Dict[Tuple[int, int], str] = {}
+        self.tags: Dict[str, datetime] = {}
+        # теги, созданные импортом: попадают в словарь тегов только после коммита
+        self.created_tags: Dict[str, int] = {}
+        self.counts = {"shelves": 0, "bookmarks": 0, "tags": 0}
+
+    async def add(self, record) -> None:
+        if isinstance(record, ShelfRecord):
+            self.shelves.append(record)
+            if len(self.shelves) >= cfg.account_batch_size:
+                await self.flush_shelves()
+        elif isinstance(record, BookmarkRecord):
+            # закладки ссылаются на полки из этого же файла
+            if self.shelves:
+                await self.flush_shelves()
+            if record.shelf_id not in self.shelf_ids:
+                raise HTTPException(status_code=400, detail=f"Unknown shelf {record.shelf_id}")
+            self.bookmarks[(self.shelf_ids[record.shelf_id], record.bookmark_id)] = record.title
+            if len(self.bookmarks) >= cfg.account_batch_size:
+                await self.flush_bookmarks()
+        elif isinstance(record, TagRecord):
+            self.tags[record.name] = record.created_at or datetime.now(timezone.utc)
+            if len(self.tags) >= cfg.account_batch_size:
+                await self.flush_tags()
+
+    async def flush(self) -> None:
+        await self.flush_shelves()
+        await self.flush_bookmarks()
+        await self.flush_tags()
+
+    async def flush_shelves(self) -> None:
+        if not self.shelves:
+            return
+        insert_shelves_query = pg_insert(Shelf).returning(Shelf.id, sort_by_parameter_order=True)
+        new_ids = (await self.session.execute(
+            insert_shelves_query,
+            [{"fk_user": self.user_id, "name": shelf.name} for shelf in self.shelves],
+        )).scalars().all()
+        for shelf, new_id in zip(self.shelves, new_ids):
+            self.shelf_ids[shelf.id] = new_id
+        self.counts["shelves"] += len(new_ids)
+        self.shelves = []
+
+    async def flush_bookmarks(self) -> None:
+        if not self.bookmarks:
+            return
+        await self.session.execute(
+            pg_insert(Bookmark)
+            .values([{"id": bookmark_id} for bookmark_id in sorted({key[1] for key in self.bookmarks})])
+            .on_conflict_do_nothing()
+        )
+        # считаются только вставленные строки: уже существующие связи пропускаются
+        added = (await self.session.execute(
+            pg_insert(BookmarkInShelf)
+            .values([{"fk_shelf": shelf_id, "fk_bookmark": bookmark_id, "title": title}
+                     for (shelf_id, bookmark_id), title in self.bookmarks.items()])
+            .on_conflict_do_nothing()
+            .returning(BookmarkInShelf.fk_bookmark)
+        )).all()
+        self.counts["bookmarks"] += len(added)
+        self.bookmarks = {}
+
+    async def flush_tags(self) -> None:
+        if not self.tags:
+            return
+        tag_ids, created = await tag_dictionary.resolve(self.session, self.tags, create=True)
+        self.created_tags.update(created)
+        added = (await self.session.execute(
+            pg_insert(UserTag)
+            .values([{"user_id": self.user_id, "tag_id": tag_id, "created_at": self.tags[name]}
+                     for name, tag_id in sorted(tag_ids.items())])
+            .on_conflict_do_nothing(index_elements=["user_id", "tag_id"])
+            .returning(UserTag.tag_id)
+        )).all()
+        self.counts["tags"] += len(added)
+        self.tags = {}
+
+
+@router.get("/export")
+async def export_account(user_id: int = Header(None, alias="x-user-id"),
+                         if_none_match: Optional[str] = Header(None),
+                         session: AsyncSession = Depends(get_session)):
+    """Потоковая выгрузка полок, закладок и тегов пользователя в формате NDJSON"""
+    # версия читается до выгрузки: изменения во время неё приведут к новому ETag, а не потеряются
+    etag = version_etag(user_id, await get_version(user_id, session))
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+    return StreamingResponse(_export_lines(user_id), media_type="application/x-ndjson", headers={"ETag": etag})
+
+
+@router.post("/import", response_model=ImportResult)
+async def import_account(request: Request,
+                         user_id: int = Header(None, alias="x-user-id"),
+                         session: AsyncSession = Depends(get_session)):
+    """Потоковая загрузка выгрузки из /account/export одной транзакцией"""
+    await get_version(user_id, session)
+
+    importer = AccountImporter(session, user_id)
+    try:
+        async for record in _read_records(request):
+            await importer.add(record)
+        await importer.flush()
+        # версия увеличивается в конце: блокировка строки пользователя не держится,
+        # пока клиент передаёт тело запроса
+        await bump_version(user_id, session)
+        await session.commit()
+    except SQLAlchemyError as e:
+        await session.rollback()
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+    tag_dictionary.remember(importer.created_tags)
+    await response_cache.invalidate(user_id, BOOKMARKS, TAGS)
+
+    return importer.counts
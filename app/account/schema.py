@@ -0,0 +1,33 @@
+from datetime import datetime
+from typing import Annotated, Literal, Optional, Union
+
+from pydantic import BaseModel, Field, TypeAdapter
+
+
+class ShelfRecord(BaseModel):
+    type: Literal["shelf"]
+    id: int
+    name: Optional[str] = None
+
+
+class BookmarkRecord(BaseModel):
+    type: Literal["bookmark"]
+    shelf_id: int
+    bookmark_id: int
+    title: str
+
+
+class TagRecord(BaseModel):
+    type: Literal["tag"]
+    name: str
+    created_at: Optional[datetime] = None
+
+
+AccountRecord = TypeAdapter(Annotated[Union[ShelfRecord, BookmarkRecord, TagRecord],
+                                      Field(discriminator="type")])
+
+
+class ImportResult(BaseModel):
+    shelves: int
+    bookmarks: int
+    tags: int
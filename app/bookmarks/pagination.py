@@ -0,0 +1,43 @@
+import base64
+import json
+from typing import List, Optional, Sequence, Tuple
+
+from fastapi import HTTPException, Query
+
+from app.config import cfg
+
+
+class Page:
+    """Параметры страницы: размер и ключ, после которого продолжается выдача."""
+
+    def __init__(self,
+                 limit: int = Query(cfg.page_size_default, ge=1, le=cfg.page_size_max),
+                 cursor: Optional[str] = Query(None)):
+        self.limit = limit
+        self.after = decode_cursor(cursor)
+
+
+def encode_cursor(last_key: int) -> str:
+    raw = json.dumps({"after": last_key}, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: Optional[str]) -> Optional[int]:
+    if cursor is None:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        after = json.loads(raw)["after"]
+    except (ValueError, TypeError, KeyError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not isinstance(after, int):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return after
+
+
+def split_page(keys: Sequence[int], limit: int) -> Tuple[List[int], Optional[str]]:
+    """Отрезает лишний (limit + 1)-й ключ и строит курсор на следующую страницу."""
+    if len(keys) <= limit:
+        return list(keys), None
+    page = list(keys[:limit])
+    return page, encode_cursor(page[-1])
@@ -1,111 +1,126 @@
-from fastapi import APIRouter, Depends, HTTPException, Header
+from typing import Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Header, Response
 from sqlalchemy.exc import SQLAlchemyError
 
+from app.bookmarks.pagination import Page, split_page
+from app.cache.etag import etag_matches, not_modified
+from app.cache.response import BOOKMARKS, CachedResponse, ResponseCacheScope, response_cache
+from app.config import cfg
 from app.database.connection.session import get_session
-from app.database.models.user import User
+from app.users.service import bump_version, get_version, version_etag
 from app.database.models.bookmark import Bookmark, Shelf, BookmarkInShelf
+from app.database.models.user import User
 from app.bookmarks.schema import (ReturnShelves, CreateShelf, ReturnOnlyShelves,
                                   ReturnBookmarks, AddBookmark, RemoveBookmark,
-                                  RemoveShelf)
-from sqlalchemy.dialects.postgresql import insert as pg_insert
-from sqlalchemy import select, delete
-from sqlalchemy.schema import MetaData
-
-from app.database.connection.session import engine
+                                  RemoveShelf, AddBookmarks, AddBookmarksResult)
+from sqlalchemy.dialects.postgresql import ARRAY, insert as pg_insert
+from sqlalchemy import String, select, delete, func
+from sqlalchemy.ext.asyncio import AsyncSession
 
 
 router = APIRouter(prefix="/bookmarks", tags=["bookmarks"])
 
 
-# проверяет существование пользователя
-def check_user(user_id: int, session) -> None:
-    user_exists_query = select(User).where(User.id == user_id)
-    user_exists = session.execute(user_exists_query).fetchone()
-    if not user_exists:
-        raise HTTPException(status_code=404, detail=f"User with id {user_id} not found")
-
-
 @router.get("/get_only_shelves", response_model=ReturnOnlyShelves)
-def get_only_shelves(user_id: int = Header(None, alias="x-user-id"),
-                     session=Depends(get_session)):
-    check_user(user_id, session)
-
+async def get_only_shelves(user_id: int = Header(None, alias="x-user-id"),
+                           page: Page = Depends(),
+                           cached: CachedResponse = Depends(ResponseCacheScope(BOOKMARKS, "limit", "cursor")),
+                           session: AsyncSession = Depends(get_session)):
+    etag = version_etag(user_id, await get_version(user_id, session))
+    response = await cached.get(user_id, etag)
+    if response is not None:
+        return response
+
+    # keyset-пагинация по id полки: стабильна при параллельных вставках и удалениях
     get_only_shelves_query = (select(Shelf.id)
-                              .where(Shelf.fk_user == user_id))
-    result = session.execute(get_only_shelves_query).fetchall()
-    if not result:
-        return {"id": []}
-    only_shelves = []
-    for element in result:
-        only_shelves.append(element[0])
-    return {"id": only_shelves}
+                              .where(Shelf.fk_user == user_id)
+                              .order_by(Shelf.id)
+                              .limit(page.limit + 1))
+    if page.after is not None:
+        get_only_shelves_query = get_only_shelves_query.where(Shelf.id > page.after)
+    result = (await session.execute(get_only_shelves_query)).scalars().all()
 
+    only_shelves, next_cursor = split_page(result, page.limit)
+    return await cached.store(user_id, etag, ReturnOnlyShelves,
+                              {"id": only_shelves, "next_cursor": next_cursor})
 
-@router.get("/get_shelves", response_model=ReturnShelves)
-def get_shelves(user_id: int = Header(None, alias="x-user-id"),
-                session=Depends(get_session)):
-
-    check_user(user_id, session)
 
-    # формируем и отправляем запрос
-    get_shelves_query = (select(Shelf.id, Shelf.name, BookmarkInShelf.title)
-                         .select_from(Shelf)
-                         .join(BookmarkInShelf, BookmarkInShelf.fk_shelf == Shelf.id)
+@router.get("/get_shelves", response_model=ReturnShelves)
+async def get_shelves(user_id: int = Header(None, alias="x-user-id"),
+                      page: Page = Depends(),
+                      cached: CachedResponse = Depends(ResponseCacheScope(BOOKMARKS, "limit", "cursor")),
+                      session: AsyncSession = Depends(get_session)):
+    etag = version_etag(user_id, await get_version(user_id, session))
+    response = await cached.get(user_id, etag)
+    if response is not None:
+        return response
+
+    # первые закладки каждой полки собираются в массив в самой базе: одна строка на полку,
+    # подзапрос выполняется только для полок страницы, пустые полки получают пустой массив
+    preview = (select(BookmarkInShelf.title)
+               .where(BookmarkInShelf.fk_shelf == Shelf.id)
+               .order_by(BookmarkInShelf.fk_bookmark)
+               .limit(cfg.shelf_preview_size)
+               .scalar_subquery())
+    get_shelves_query = (select(Shelf.id, Shelf.name, func.array(preview, type_=ARRAY(String)).label("bookmarks"))
                          .where(Shelf.fk_user == user_id)
-                         .group_by(Shelf.id, Shelf.name, BookmarkInShelf.title))
-    result = session.execute(get_shelves_query).fetchall()
-    if not result:
-        return {"shelves": []}
-
-    # форматируем ответ
-    response_list = []
-    last_id = -1
-    counter = 0
-    new_shelf = {"id": -1, "name": "None", "bookmarks": []}
-    for shelf in result:
-        if shelf.id != last_id:
-            counter = 0
-            if last_id != -1:
-                response_list.append(new_shelf)
-            last_id = shelf.id
-            new_shelf = {"id": shelf[0], "name": shelf[1], "bookmarks": []}
-        if counter > 2:
-            continue
-        counter += 1
-        new_shelf["bookmarks"].append(shelf[2])
-    response_list.append(new_shelf)
-
-    return {"shelves": response_list}
+                         .order_by(Shelf.id)
+                         .limit(page.limit + 1))
+    if page.after is not None:
+        get_shelves_query = get_shelves_query.where(Shelf.id > page.after)
+    result = (await session.execute(get_shelves_query)).all()
+
+    shelf_ids, next_cursor = split_page([shelf.id for shelf in result], page.limit)
+    return await cached.store(user_id, etag, ReturnShelves,
+                              {"shelves": result[:len(shelf_ids)], "next_cursor": next_cursor})
 
 
 @router.get("/get_bookmarks", response_model=ReturnBookmarks)
-def get_bookmarks(shelf_id: int,
-                  user_id: int = Header(None, alias="x-user-id"),
-                  session=Depends(get_session)):
+async def get_bookmarks(shelf_id: int,
+                        response: Response,
+                        user_id: int = Header(None, alias="x-user-id"),
+                        page: Page = Depends(),
+                        if_none_match: Optional[str] = Header(None),
+                        session: AsyncSession = Depends(get_session)):
+
+    # версия читается вместе с проверкой владельца полки: ETag строится по версии пользователя,
+    # поэтому чужая полка не должна ни читаться, ни получать 304
+    version_query = (
+        select(User.data_version)
+        .join(Shelf, Shelf.fk_user == User.id)
+        .where(User.id == user_id)
+        .where(Shelf.id == shelf_id)
+    )
+    version = await session.scalar(version_query)
+    if version is None:
+        await get_version(user_id, session)
+        raise HTTPException(status_code=404, detail="Shelf not found")
 
-    check_user(user_id, session)
+    etag = version_etag(user_id, version)
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+    response.headers["ETag"] = etag
 
     # формируем и отправляем запрос
-    get_bookmarks_query = (select(Bookmark.id, BookmarkInShelf.title)
-                           .join(BookmarkInShelf, Bookmark.id == BookmarkInShelf.fk_bookmark)
-                           .where(BookmarkInShelf.fk_shelf == shelf_id))
-    result = session.execute(get_bookmarks_query).fetchall()
+    get_bookmarks_query = (select(BookmarkInShelf.fk_bookmark.label("id"), BookmarkInShelf.title)
+                           .where(BookmarkInShelf.fk_shelf == shelf_id)
+                           .order_by(BookmarkInShelf.fk_bookmark)
+                           .limit(page.limit + 1))
+    if page.after is not None:
+        get_bookmarks_query = get_bookmarks_query.where(BookmarkInShelf.fk_bookmark > page.after)
+    result = (await session.execute(get_bookmarks_query)).all()
 
-    if not result:
-        return {"bookmarks": []}
-
-    bookmark_list = []
-    for element in result:
-        bookmark_list.append({"id": element.id, "title": element.title})
-    return {"bookmarks": bookmark_list}
+    bookmark_ids, next_cursor = split_page([element.id for element in result], page.limit)
+    return {"bookmarks": result[:len(bookmark_ids)], "next_cursor": next_cursor}
 
 
 @router.post("/create_shelf", response_model=dict)
-def create_shelf(shelf_name: CreateShelf,
-                 user_id: int = Header(None, alias="x-user-id"),
-                 session=Depends(get_session)):
+async def create_shelf(shelf_name: CreateShelf,
+                       user_id: int = Header(None, alias="x-user-id"),
+                       session: AsyncSession = Depends(get_session)):
 
-    check_user(user_id, session)
+    await bump_version(user_id, session)
 
     # формируем запрос
     create_shelf_query = (
@@ -115,28 +130,30 @@ def create_shelf(shelf_name: CreateShelf,
 
     # пытаемся провести транзакцию
     try:
-        session.execute(create_shelf_query)
-        session.commit()
+        await session.execute(create_shelf_query)
+        await session.commit()
     except SQLAlchemyError as e:
-        session.rollback()
+        await session.rollback()
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+    await response_cache.invalidate(user_id, BOOKMARKS)
 
     return {"message": "Shelf successfully created"}
 
 
 @router.post("/add_bookmark", response_model=dict)
-def add_bookmark(new_bookmark: AddBookmark,
-                 user_id: int = Header(None, alias="x-user-id"),
-                 session=Depends(get_session)):
+async def add_bookmark(new_bookmark: AddBookmark,
+                       user_id: int = Header(None, alias="x-user-id"),
+                       session: AsyncSession = Depends(get_session)):
 
-    check_user(user_id, session)
+    await bump_version(user_id, session)
 
-    # проверяем наличие полки
+    # проверяем, что полка существует и принадлежит пользователю
     check_shelf = (
-        select(Shelf).where(Shelf.id == new_bookmark.shelf_id)
+        select(Shelf.id)
+        .where(Shelf.id == new_bookmark.shelf_id)
+        .where(Shelf.fk_user == user_id)
     )
-    result = session.execute(check_shelf)
-    if not result:
+    if (await session.execute(check_shelf)).scalar() is None:
         raise HTTPException(status_code=404, detail="Shelf not found")
 
     # формируем запросы
@@ -154,29 +171,100 @@ def add_bookmark(new_bookmark: AddBookmark,
 
     # пытаемся провести транзакцию
     try:
-        session.execute(add_bookmark_query)
-        session.execute(add_link_query)
-        session.commit()
+        await session.execute(add_bookmark_query)
+        await session.execute(add_link_query)
+        await session.commit()
     except SQLAlchemyError as e:
-        session.rollback()
+        await session.rollback()
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+    await response_cache.invalidate(user_id, BOOKMARKS)
 
     return {"message": "Bookmark successfully added"}
 
 
+@router.post("/add_bookmarks", response_model=AddBookmarksResult)
+async def add_bookmarks(new_bookmarks: AddBookmarks,
+                        user_id: int = Header(None, alias="x-user-id"),
+                        session: AsyncSession = Depends(get_session)):
+    """Пакетное добавление закладок на полки пользователя одной транзакцией"""
+    items = new_bookmarks.bookmarks
+    if not items:
+        raise HTTPException(status_code=400, detail="Bookmarks list cannot be empty")
+    if len(items) > cfg.bookmarks_batch_max:
+        raise HTTPException(status_code=400,
+                            detail=f"Bookmarks list cannot be longer than {cfg.bookmarks_batch_max}")
+
+    await bump_version(user_id, session)
+
+    # проверяем все полки из запроса одним запросом
+    check_shelves = (
+        select(Shelf.id)
+        .where(Shelf.id.in_({item.shelf_id for item in items}))
+        .where(Shelf.fk_user == user_id)
+    )
+    user_shelves = set((await session.execute(check_shelves)).scalars().all())
+
+    statuses = []
+    links = {}
+    for item in items:
+        key = (item.shelf_id, item.bookmark_id)
+        if item.shelf_id not in user_shelves:
+            statuses.append("shelf_not_found")
+        elif key in links:
+            statuses.append("duplicate")
+        else:
+            links[key] = item.title
+            statuses.append(None)
+
+    if links:
+        # формируем многострочные запросы, ключи отсортированы для единого порядка блокировок
+        add_bookmarks_query = (
+            pg_insert(Bookmark)
+            .values([{"id": bookmark_id} for bookmark_id in sorted({key[1] for key in links})])
+            .on_conflict_do_nothing()
+        )
+        add_links_query = (
+            pg_insert(BookmarkInShelf)
+            .values([{"fk_shelf": shelf_id, "fk_bookmark": bookmark_id, "title": title}
+                     for (shelf_id, bookmark_id), title in sorted(links.items())])
+            .on_conflict_do_nothing()
+            .returning(BookmarkInShelf.fk_shelf, BookmarkInShelf.fk_bookmark)
+        )
+
+        # пытаемся провести транзакцию
+        try:
+            await session.execute(add_bookmarks_query)
+            added = set(map(tuple, (await session.execute(add_links_query)).fetchall()))
+            await session.commit()
+        except SQLAlchemyError as e:
+            await session.rollback()
+            raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+        await response_cache.invalidate(user_id, BOOKMARKS)
+    else:
+        added = set()
+
+    results = []
+    for item, status in zip(items, statuses):
+        if status is None:
+            status = "added" if (item.shelf_id, item.bookmark_id) in added else "exists"
+        results.append({"bookmark_id": item.bookmark_id, "shelf_id": item.shelf_id, "status": status})
+    return {"results": results}
+
+
 @router.post("/delete_bookmark_from_shelf", response_model=dict)
-def delete_bookmark_from_shelf(bookmark_to_remove: RemoveBookmark,
-                               user_id: int = Header(None, alias="x-user-id"),
-                               session=Depends(get_session)):
+async def delete_bookmark_from_shelf(bookmark_to_remove: RemoveBookmark,
+                                     user_id: int = Header(None, alias="x-user-id"),
+                                     session: AsyncSession = Depends(get_session)):
 
-    check_user(user_id, session)
+    await bump_version(user_id, session)
 
-    # проверяем наличие полки
+    # проверяем, что полка существует и принадлежит пользователю
     check_shelf = (
-        select(Shelf).where(Shelf.id == bookmark_to_remove.shelf_id)
+        select(Shelf.id)
+        .where(Shelf.id == bookmark_to_remove.shelf_id)
+        .where(Shelf.fk_user == user_id)
     )
-    result = session.execute(check_shelf)
-    if not result:
+    if (await session.execute(check_shelf)).scalar() is None:
         raise HTTPException(status_code=404, detail="Shelf not found")
 
     # формируем запрос
@@ -188,46 +276,50 @@ def delete_bookmark_from_shelf(bookmark_to_remove: RemoveBookmark,
 
     # пытаемся провести транзакцию
     try:
-        session.execute(remove_bookmark_query)
-        session.commit()
+        await session.execute(remove_bookmark_query)
+        await session.commit()
     except SQLAlchemyError as e:
-        session.rollback()
+        await session.rollback()
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+    await response_cache.invalidate(user_id, BOOKMARKS)
 
     return {"message": "Bookmark removed from shelf"}
 
 
 @router.post("/delete_shelf", response_model=dict)
-def delete_shelf(shelf_to_remove: RemoveShelf,
-                 user_id: int = Header(None, alias="x-user-id"),
-                 session=Depends(get_session)):
-    check_user(user_id, session)
+async def delete_shelf(shelf_to_remove: RemoveShelf,
+                       user_id: int = Header(None, alias="x-user-id"),
+                       session: AsyncSession = Depends(get_session)):
+    await bump_version(user_id, session)
 
-    # проверяем наличие полки
+    # проверяем, что полка существует и принадлежит пользователю
     check_shelf = (
-        select(Shelf).where(Shelf.id == shelf_to_remove.shelf_id)
+        select(Shelf.id)
+        .where(Shelf.id == shelf_to_remove.shelf_id)
+        .where(Shelf.fk_user == user_id)
     )
-    result = session.execute(check_shelf)
-    if not result:
+    if (await session.execute(check_shelf)).scalar() is None:
         return {"message": "Nothing to remove"}
 
     # формируем запросы
-    remove_shelf_query = (
-        delete(Shelf)
-        .where(Shelf.id == shelf_to_remove.shelf_id)
-    )
+    # связи удаляются первыми: на полку ссылается внешний ключ bookmarks_inshelf
     remove_link_query = (
         delete(BookmarkInShelf)
         .where(BookmarkInShelf.fk_shelf == shelf_to_remove.shelf_id)
     )
+    remove_shelf_query = (
+        delete(Shelf)
+        .where(Shelf.id == shelf_to_remove.shelf_id)
+    )
 
     # пытаемся провести транзакцию
     try:
-        session.execute(remove_shelf_query)
-        session.execute(remove_link_query)
-        session.commit()
+        await session.execute(remove_link_query)
+        await session.execute(remove_shelf_query)
+        await session.commit()
     except SQLAlchemyError as e:
-        session.rollback()
+        await session.rollback()
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+    await response_cache.invalidate(user_id, BOOKMARKS)
 
     return {"message": "Shelf removed"}
@@ -1,13 +1,31 @@
-from pydantic import BaseModel
-from typing import List
+from pydantic import BaseModel, ConfigDict
+from typing import List, Literal, Optional
+
+
+# строки ответов строятся прямо из строк результата запроса
+class ShelfPreview(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    id: int
+    name: Optional[str]
+    bookmarks: List[str]
+
+
+class BookmarkItem(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    id: int
+    title: str
 
 
 class ReturnShelves(BaseModel):
-    shelves: List[dict]
+    shelves: List[ShelfPreview]
+    next_cursor: Optional[str] = None
 
 
 class ReturnOnlyShelves(BaseModel):
     id: List[int]
+    next_cursor: Optional[str] = None
 
 
 class CreateShelf(BaseModel):
@@ -15,7 +33,8 @@ class CreateShelf(BaseModel):
 
 
 class ReturnBookmarks(BaseModel):
-    bookmarks: List[dict]
+    bookmarks: List[BookmarkItem]
+    next_cursor: Optional[str] = None
 
 
 class AddBookmark(BaseModel):
@@ -24,6 +43,20 @@ class AddBookmark(BaseModel):
     shelf_id: int
 
 
+class AddBookmarks(BaseModel):
+    bookmarks: List[AddBookmark]
+
+
+class AddBookmarkResult(BaseModel):
+    bookmark_id: int
+    shelf_id: int
+    status: Literal["added", "exists", "duplicate", "shelf_not_found"]
+
+
+class AddBookmarksResult(BaseModel):
+    results: List[AddBookmarkResult]
+
+
 class RemoveBookmark(BaseModel):
     bookmark_id: int
     shelf_id: int
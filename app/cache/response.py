@@ -0,0 +1,230 @@
+import itertools
+import logging
+from collections import defaultdict
+from typing import Dict, Optional, Type
+
+from fastapi import Request, Response
+from pydantic import BaseModel
+
+from app.cache.etag import etag_matches, not_modified
+from app.cache.ttl import TTLCache
+from app.config import cfg
+
+try:
+    from redis import asyncio as redis_asyncio
+except ImportError:  # redis нужен только для response_cache_backend = "redis"
+    redis_asyncio = None
+
+logger = logging.getLogger(__name__)
+
+# области кэша: запись в область сбрасывает только её ответы
+TAGS = "tags"
+BOOKMARKS = "bookmarks"
+
+
+class LocalBackend:
+    """
+    Ответы в памяти процесса: общий LRU по (область пользователя, поколение, адрес запроса).
+
+    Сброс области выдаёт ей новое поколение, а ответы прежнего вытесняются LRU и ttl,
+    поэтому число ответов ограничено maxsize независимо от того, сколько разных адресов запрашивают.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.entries = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.generations = TTLCache(maxsize=maxsize, ttl=ttl)
+        # номера поколений не повторяются, даже если поколение области вытеснено
+        self._counter = itertools.count()
+
+    async def get(self, namespace: str, key: str) -> Optional[bytes]:
+        generation = self.generations.get(namespace)
+        if generation is None:
+            return None
+        return self.entries.get((namespace, generation, key))
+
+    async def set(self, namespace: str, key: str, value: bytes) -> None:
+        generation = self.generations.get(namespace)
+        if generation is None:
+            generation = next(self._counter)
+        # поколение живёт не меньше своих ответов
+        self.generations.set(namespace, generation)
+        self.entries.set((namespace, generation, key), value)
+
+    async def delete(self, namespace: str) -> None:
+        self.generations.set(namespace, next(self._counter))
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.generations.clear()
+
+    def size(self) -> Optional[int]:
+        return len(self.entries)
+
+
+class RedisBackend:
+    """
+    Ответы в Redis: отдельный ключ со своим ttl на каждый ответ, сброс области — INCR её поколения.
+
+    Ключ поколения продлевается при каждой записи ответа, поэтому истекает только после всех
+    своих ответов, и счётчик, начавшийся заново, не встретит живой ответ с тем же номером.
+    """
+
+    def __init__(self, client, ttl: float):
+        self.client = client
+        self.ttl = int(ttl)
+
+    @staticmethod
+    def _generation(namespace: str) -> str:
+        return f"responses:{namespace}:generation"
+
+    async def _name(self, namespace: str, key: str) -> str:
+        generation = await self.client.get(self._generation(namespace))
+        return f"responses:{namespace}:{int(generation or 0)}:{key}"
+
+    async def get(self, namespace: str, key: str) -> Optional[bytes]:
+        return await self.client.get(await self._name(namespace, key))
+
+    async def set(self, namespace: str, key: str, value: bytes) -> None:
+        await self.client.set(await self._name(namespace, key), value, ex=self.ttl)
+        await self.client.expire(self._generation(namespace), self.ttl)
+
+    async def delete(self, namespace: str) -> None:
+        await self.client.incr(self._generation(namespace))
+        await self.client.expire(self._generation(namespace), self.ttl)
+
+    def clear(self) -> None:
+        pass
+
+    def size(self) -> Optional[int]:
+        return None
+
+
+class ResponseCache:
+    """Кэш сериализованных ответов GET-запросов по пользователю и области с подсчётом попаданий."""
+
+    def __init__(self, backend, maxsize: Optional[int] = None):
+        self.backend = backend
+        self.maxsize = maxsize
+        self.hits: Dict[str, int] = defaultdict(int)
+        self.misses: Dict[str, int] = defaultdict(int)
+
+    async def get(self, user_id: int, scope: str, key: str, etag: str) -> Optional[bytes]:
+        """
+        Тело ответа, сохранённого для текущей версии данных пользователя (etag).
+
+        Ответ прежней версии считается промахом: запись могла пройти между чтением базы и сохранением
+        или в другом процессе, чей сброс кэша сюда не дошёл.
+        """
+        if self.backend is None:
+            return None
+        try:
+            entry = await self.backend.get(f"{user_id}:{scope}", key)
+        except Exception as e:
+            # недоступный кэш не должен ломать чтение
+            logger.warning("Response cache get failed: %s", e)
+            entry = None
+        body = None
+        if entry is not None:
+            stored, body = entry.split(b"\n", 1)
+            if stored != etag.encode():
+                body = None
+        if body is None:
+            self.misses[scope] += 1
+        else:
+            self.hits[scope] += 1
+        return body
+
+    async def set(self, user_id: int, scope: str, key: str, etag: str, body: bytes) -> None:
+        if self.backend is None:
+            return
+        try:
+            await self.backend.set(f"{user_id}:{scope}", key, etag.encode() + b"\n" + body)
+        except Exception as e:
+            logger.warning("Response cache set failed: %s", e)
+
+    async def invalidate(self, user_id: int, *scopes: str) -> None:
+        if self.backend is None:
+            return
+        for scope in scopes:
+            try:
+                await self.backend.delete(f"{user_id}:{scope}")
+            except Exception as e:
+                logger.error("Response cache invalidation of %s for user %s failed: %s", scope, user_id, e)
+
+    def clear(self) -> None:
+        if self.backend is not None:
+            self.backend.clear()
+
+    def stats(self) -> Dict[str, dict]:
+        size = self.backend.size() if self.backend is not None else None
+        result = {}
+        for scope in (TAGS, BOOKMARKS):
+            total = self.hits[scope] + self.misses[scope]
+            result[scope] = {
+                "size": size,
+                "maxsize": self.maxsize,
+                "hits": self.hits[scope],
+                "misses": self.misses[scope],
+                "hit_ratio": self.hits[scope] / total if total else 0.0,
+            }
+        return result
+
+
+class CachedResponse:
+    """
+    Ответ текущего запроса в кэше: ключ — путь и объявленные маршрутом параметры запроса.
+
+    Ответ хранится вместе со своим ETag и отдаётся, только пока ETag совпадает с текущей версией
+    данных пользователя: попадание стоит одного запроса по первичному ключу вместо запроса данных.
+    """
+
+    def __init__(self, scope: str, key: str, if_none_match: Optional[str]):
+        self.scope = scope
+        self.key = key
+        self.if_none_match = if_none_match
+
+    async def get(self, user_id: int, etag: str) -> Optional[Response]:
+        if etag_matches(self.if_none_match, etag):
+            return not_modified(etag)
+        body = await response_cache.get(user_id, self.scope, self.key, etag)
+        if body is None:
+            return None
+        return Response(content=body, media_type="application/json", headers={"ETag": etag})
+
+    async def store(self, user_id: int, etag: str, model: Type[BaseModel], data) -> Response:
+        body = model.model_validate(data, from_attributes=True).model_dump_json().encode()
+        await response_cache.set(user_id, self.scope, self.key, etag, body)
+        return Response(content=body, media_type="application/json", headers={"ETag": etag})
+
+
+class ResponseCacheScope:
+    """
+    Зависимость, выдающая CachedResponse для области: Depends(ResponseCacheScope(BOOKMARKS, "limit", "cursor")).
+
+    В ключ попадают только перечисленные параметры, чтобы посторонние (?x=1, ?x=2, ...) не плодили записи.
+    """
+
+    def __init__(self, scope: str, *params: str):
+        self.scope = scope
+        self.params = params
+
+    def __call__(self, request: Request) -> CachedResponse:
+        key = request.url.path
+        query = "&".join(f"{name}={request.query_params[name]}" for name in self.params
+                         if name in request.query_params)
+        if query:
+            key += "?" + query
+        return CachedResponse(self.scope, key, request.headers.get("if-none-match"))
+
+
+def create_response_cache() -> ResponseCache:
+    if cfg.response_cache_backend == "off":
+        return ResponseCache(None)
+    if cfg.response_cache_backend == "redis":
+        if redis_asyncio is None:
+            raise RuntimeError("response_cache_backend = redis requires the redis package")
+        return ResponseCache(RedisBackend(redis_asyncio.from_url(cfg.redis_url), cfg.response_cache_ttl))
+    return ResponseCache(LocalBackend(cfg.response_cache_size, cfg.response_cache_ttl), cfg.response_cache_size)
+
+
+response_cache = create_response_cache()
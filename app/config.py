@@ -1,4 +1,5 @@
 import os
+from typing import List, Literal
 
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
@@ -14,17 +15,94 @@ class Config(BaseSettings):
     debug: bool = False
     logging_level: str = "info"
 
+    # повторные попытки подключения к зависимостям при старте
+    startup_retries: int = 5
+    startup_retry_delay: float = 1.0
+
     postgres_host: str
     postgres_port: int = 5432
     postgres_db: str
     postgres_user: str
     postgres_password: str
 
+    # postgres connection pool settings
+    postgres_pool_size: int = 5
+    postgres_max_overflow: int = 10
+    postgres_pool_timeout: float = 30.0
+    postgres_pool_recycle: int = 1800
+    postgres_pool_pre_ping: bool = True
+    postgres_statement_timeout_ms: int = 0
+
+    # журнал медленных запросов: порог (0 — выключен), доля запросов с планом EXPLAIN
+    # и ограничение числа записей в минуту
+    slow_query_threshold_ms: float = 500.0
+    slow_query_explain_rate: float = 0.1
+    slow_query_log_per_minute: int = 10
+
+    # количество закладок в превью полки для /bookmarks/get_shelves
+    shelf_preview_size: int = 3
+
+    # размер страницы для списков полок и закладок
+    page_size_default: int = 100
+    page_size_max: int = 1000
+
+    # максимальное число закладок в /bookmarks/add_bookmarks
+    bookmarks_batch_max: int = 1000
+
+    # подсказки тегов: размер выдачи и минимальная длина запроса для нечёткого поиска
+    tag_suggest_limit: int = 10
+    tag_suggest_limit_max: int = 50
+    tag_suggest_fuzzy_min_length: int = 3
+    # короче префикс совпадает с большой частью словаря, и сортировка по популярности читает его целиком
+    tag_suggest_min_length: int = 2
+    # период пересчёта популярности тегов в фоне, секунды
+    tag_popularity_refresh_interval: int = 300
+
+    # кэш ответов GET-запросов по пользователю: local — LRU в процессе, redis — общий для всех процессов,
+    # off — отключён; ответ отдаётся, только пока совпадает версия данных пользователя в базе,
+    # поэтому local безопасен и при нескольких процессах, а ttl лишь освобождает память
+    response_cache_backend: Literal["local", "redis", "off"] = "local"
+    response_cache_size: int = 10000
+    response_cache_ttl: float = 60.0
+    redis_url: str = "redis://localhost:6379/0"
+
+    # размер пачки строк при экспорте и импорте аккаунта
+    account_batch_size: int = 1000
+    # максимальная длина одной записи NDJSON при импорте аккаунта
+    account_max_line_size: int = 64 * 1024
+
     # minio s3 settings
     minio_url: str = "localhost:9000"
     minio_root_user: str
     minio_root_password: str
     s3_bucket_name: str = "static"
+    s3_link_expires: int = 3600
+    # ссылка вытесняется из кэша за s3_link_cache_margin секунд до истечения подписи
+    s3_link_cache_margin: int = 300
+    s3_link_cache_size: int = 10000
+    s3_upload_threads: int = 8
+
+    # загрузка аватарок; часть multipart-загрузки S3 не может быть меньше 5 МиБ
+    avatar_max_size: int = 10 * 1024 * 1024
+    avatar_upload_chunk_size: int = 5 * 1024 * 1024
+    # время жизни политики прямой загрузки в S3
+    avatar_upload_policy_expires: int = 600
+    # неподтверждённые прямые загрузки удаляются правилом жизненного цикла бакета
+    avatar_staging_prefix: str = "icons/uploads"
+    avatar_staging_expire_days: int = 1
+    # уменьшенные копии аватарок в формате WebP
+    avatar_sizes: List[int] = [32, 64, 256]
+    # предел числа пикселей исходника: сжатый PNG в пределах avatar_max_size может распаковаться
+    # в сотни мегабайт; размеры читаются из первых avatar_header_size байт до загрузки изображения
+    avatar_max_pixels: int = 25_000_000
+    avatar_header_size: int = 64 * 1024
+    avatar_webp_quality: int = 80
+    avatar_workers: int = 2
+    # максимальное число пользователей в /files/icon-get-links
+    avatar_links_batch_max: int = 500
+    # время кэширования перенаправления на аватарку в браузере и CDN (public), не больше
+    # s3_link_cache_margin; столько же живёт ETag оригинала в кэше процесса
+    avatar_redirect_max_age: int = 300
 
     @property
     def build_postgres_dsn(self) -> str:
@@ -35,5 +113,9 @@ class Config(BaseSettings):
         )
         return res
 
+    @property
+    def build_postgres_async_dsn(self) -> str:
+        return self.build_postgres_dsn.replace("postgresql://", "postgresql+asyncpg://", 1)
+
 
 cfg = Config()
\ No newline at end of file
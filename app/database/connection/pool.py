@@ -0,0 +1,59 @@
+import time
+
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+
+class PoolStats:
+    """Накопительные счётчики выдачи соединений из пула."""
+
+    def __init__(self):
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def observe(self, waited: float) -> None:
+        self.checkouts += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+
+    def as_dict(self) -> dict:
+        return {
+            "checkouts": self.checkouts,
+            "timeouts": self.timeouts,
+            "wait_total_ms": self.wait_total * 1000,
+            "wait_max_ms": self.wait_max * 1000,
+            "wait_avg_ms": self.wait_total * 1000 / self.checkouts if self.checkouts else 0.0,
+        }
+
+
+# общие для всех экземпляров пула: engine.dispose() пересоздаёт пул
+pool_stats = PoolStats()
+
+
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    """Пул соединений, замеряющий время ожидания свободного соединения."""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except PoolTimeoutError:
+            pool_stats.timeouts += 1
+            raise
+        pool_stats.observe(time.perf_counter() - started)
+        return connection
+
+
+def pool_status(engine) -> dict:
+    """Текущее состояние пула движка вместе с накопленными счётчиками."""
+    pool = engine.pool
+    return {
+        "size": pool.size(),
+        "checked_in": pool.checkedin(),
+        "checked_out": pool.checkedout(),
+        # счётчик SQLAlchemy равен -size, пока открыты не все постоянные соединения
+        "overflow": max(0, pool.overflow()),
+        **pool_stats.as_dict(),
+    }
@@ -1,15 +1,25 @@
-from sqlalchemy import create_engine
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from typing import AsyncIterator
+
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
 from app.config import cfg
+from app.database.connection.pool import InstrumentedPool
+from app.database.slow_query import install_slow_query_log
 
-engine = create_engine(cfg.build_postgres_dsn)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+async_engine = create_async_engine(
+    cfg.build_postgres_async_dsn,
+    poolclass=InstrumentedPool,
+    pool_size=cfg.postgres_pool_size,
+    max_overflow=cfg.postgres_max_overflow,
+    pool_timeout=cfg.postgres_pool_timeout,
+    pool_recycle=cfg.postgres_pool_recycle,
+    pool_pre_ping=cfg.postgres_pool_pre_ping,
+    connect_args={"server_settings": {"statement_timeout": str(cfg.postgres_statement_timeout_ms)}},
+)
+install_slow_query_log(async_engine.sync_engine)
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
 
 
-def get_session() -> SessionLocal:
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+async def get_session() -> AsyncIterator[AsyncSession]:
+    async with AsyncSessionLocal() as session:
+        yield session
@@ -0,0 +1,64 @@
+import json
+from typing import Iterable, List, Sequence, Tuple
+
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+# таблицы, которые растут вместе с числом пользователей
+LARGE_TABLES = frozenset({"users", "tags", "user_tags", "shelf", "bookmarks", "bookmarks_inshelf"})
+
+EXPLAINABLE = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")
+
+INDEX_SCANS = ("Index Scan", "Index Only Scan")
+
+
+def explain(cursor, statement: str, parameters: Sequence = (), analyze: bool = False) -> dict:
+    """Возвращает корневой узел плана запроса через DBAPI-курсор."""
+    options = "ANALYZE, BUFFERS, FORMAT JSON" if analyze else "FORMAT JSON"
+    cursor.execute(f"EXPLAIN ({options}) {statement}", parameters)
+    plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]["Plan"]
+
+
+def seq_scans(plan: dict, tables: Iterable[str] = LARGE_TABLES) -> List[str]:
+    """
+    Таблицы из tables, которые план читает целиком.
+
+    Кроме Seq Scan учитывается проход по индексу без условия: так планировщик
+    обходит таблицу, когда последовательное сканирование запрещено.
+    """
+    tables = set(tables)
+    found = []
+    nodes = [plan]
+    while nodes:
+        node = nodes.pop()
+        full_scan = (node.get("Node Type") == "Seq Scan"
+                     or (node.get("Node Type") in INDEX_SCANS and "Index Cond" not in node))
+        if full_scan and node.get("Relation Name") in tables:
+            found.append(node["Relation Name"])
+        nodes.extend(node.get("Plans", []))
+    return found
+
+
+async def find_seq_scans(engine: AsyncEngine,
+                         statements: Iterable[Tuple[str, Sequence]]) -> List[Tuple[str, List[str]]]:
+    """
+    Строит планы запросов с запрещённым последовательным сканированием.
+
+    Если планировщику всё равно приходится читать большую таблицу целиком,
+    значит подходящего индекса нет.
+    """
+    statements = [(statement, parameters) for statement, parameters in statements
+                  if statement.lstrip().split(None, 1)[0].upper() in EXPLAINABLE]
+
+    def run(sync_connection):
+        cursor = sync_connection.connection.cursor()
+        cursor.execute("SET LOCAL enable_seqscan = off")
+        return [(statement, seq_scans(explain(cursor, statement, parameters)))
+                for statement, parameters in statements]
+
+    async with engine.connect() as connection:
+        result = await connection.run_sync(run)
+        await connection.rollback()
+    return [(statement, tables) for statement, tables in result if tables]
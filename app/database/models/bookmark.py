@@ -1,11 +1,12 @@
-from sqlalchemy import Column, Integer, String, ForeignKey
+from sqlalchemy import Column, Integer, String, ForeignKey, Index
 
 from app.database.models import Base
 
 
 class Shelf(Base):
     __tablename__ = 'shelf'
-    __table_args__ = ({"schema": "personal_account"})
+    __table_args__ = (Index("ix_shelf_fk_user_id", "fk_user", "id"),
+                      {"schema": "personal_account"})
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     fk_user = Column(Integer, ForeignKey('personal_account.users.id'), nullable=False)
@@ -19,6 +20,7 @@ class Bookmark(Base):
 
 class BookmarkInShelf(Base):
     __tablename__ = 'bookmarks_inshelf'
+    __table_args__ = (Index("ix_bookmarks_inshelf_fk_bookmark", "fk_bookmark"),)
     title = Column(String, nullable=False)
     fk_shelf = Column(Integer, ForeignKey('shelf.id'), primary_key=True, nullable=False)
     fk_bookmark = Column(Integer, ForeignKey('bookmarks.id'), primary_key=True, nullable=False)
\ No newline at end of file
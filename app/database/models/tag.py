@@ -1,21 +1,31 @@
-from datetime import datetime, timezone
-from sqlalchemy import Column, Integer, String, TIMESTAMP, ForeignKey
-
-from app.database.models import Base
-
-
-class UserTag(Base):
-    __tablename__ = "user_tags"
-    __table_args__ = ({"schema": "personal_account"})
-
-    user_id = Column(Integer, ForeignKey("personal_account.users.id"), primary_key=True)
-    tag_id = Column(Integer, ForeignKey("personal_account.tags.id"), primary_key=True)
-    created_at = Column(TIMESTAMP(timezone=True), default=datetime.now(timezone.utc), nullable=False)
-
-
-class Tag(Base):
-    __tablename__ = "tags"
-    __table_args__ = {'schema': 'personal_account'}
-
-    id = Column(Integer, primary_key=True, index=True)
-    name = Column(String, unique=True, nullable=False)
+from datetime import datetime, timezone
+from sqlalchemy import Column, Integer, String, TIMESTAMP, ForeignKey, Index, Table, text
+
+from app.database.models import Base
+
+
+class UserTag(Base):
+    __tablename__ = "user_tags"
+    __table_args__ = (Index("ix_user_tags_tag_id", "tag_id"),
+                      {"schema": "personal_account"})
+
+    user_id = Column(Integer, ForeignKey("personal_account.users.id"), primary_key=True)
+    tag_id = Column(Integer, ForeignKey("personal_account.tags.id"), primary_key=True)
+    created_at = Column(TIMESTAMP(timezone=True), default=datetime.now(timezone.utc), nullable=False)
+
+
+class Tag(Base):
+    __tablename__ = "tags"
+    __table_args__ = {'schema': 'personal_account'}
+
+    id = Column(Integer, primary_key=True, index=True)
+    name = Column(String, unique=True, nullable=False)
+    # число пользователей с тегом, периодически пересчитывается TagSuggester.refresh_popularity
+    popularity = Column(Integer, nullable=False, default=0, server_default=text("0"))
+
+
+# теги, чьи пользователи изменились с прошлого пересчёта; заполняется триггерами на user_tags.
+# Индексы подсказок (ix_tags_name_prefix, ix_tags_name_trgm) и триггеры описаны только в миграциях
+tag_popularity_changes = Table("tag_popularity_changes", Base.metadata,
+                               Column("tag_id", Integer, nullable=False),
+                               schema="personal_account")
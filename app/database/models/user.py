@@ -1,6 +1,6 @@
 from datetime import datetime, timezone
 
-from sqlalchemy import Column, Integer, String, TIMESTAMP
+from sqlalchemy import BigInteger, Column, Integer, String, TIMESTAMP, text
 
 from app.database.models.base import Base
 
@@ -13,3 +13,7 @@ class User(Base):
     first_name = Column(String)
     last_name = Column(String)
     created_at = Column(TIMESTAMP(timezone=True), default=datetime.now(timezone.utc), nullable=False)
+    # sha256 исходной аватарки, под которым лежат её уменьшенные копии
+    avatar_hash = Column(String(64))
+    # растёт при каждом изменении полок, закладок и тегов пользователя; из неё строится ETag ответов
+    data_version = Column(BigInteger, nullable=False, default=0, server_default=text("0"))
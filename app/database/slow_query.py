@@ -0,0 +1,134 @@
+import json
+import logging
+import random
+import re
+import threading
+import time
+from typing import Any, Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app.config import cfg
+from app.database.explain import EXPLAINABLE, explain
+from app.monitoring.metrics import request_stats
+
+logger = logging.getLogger(__name__)
+
+
+def redact(value: Any) -> Any:
+    """Значения параметров без пользовательских данных: числа остаются, строки и байты заменяются длиной."""
+    if isinstance(value, (list, tuple)):
+        return [redact(item) for item in value]
+    if isinstance(value, dict):
+        return {key: redact(item) for key, item in value.items()}
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if isinstance(value, (str, bytes)):
+        return f"<{type(value).__name__}:{len(value)}>"
+    return f"<{type(value).__name__}>"
+
+
+# строковые литералы в условиях плана: туда подставляются значения параметров
+PLAN_LITERAL = re.compile(r"'(?:[^']|'')*'")
+
+
+def redact_plan(plan: Any) -> Any:
+    if isinstance(plan, dict):
+        return {key: redact_plan(value) for key, value in plan.items()}
+    if isinstance(plan, list):
+        return [redact_plan(item) for item in plan]
+    if isinstance(plan, str):
+        return PLAN_LITERAL.sub("'?'", plan)
+    return plan
+
+
+class RateLimiter:
+    """Token bucket: не больше rate событий в минуту, пропущенные события считаются."""
+
+    def __init__(self):
+        self.tokens = 0.0
+        self.updated = None
+        self.suppressed = 0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> Optional[int]:
+        """Возвращает число пропущенных с прошлого раза событий или None, если лимит исчерпан."""
+        rate = cfg.slow_query_log_per_minute
+        now = time.monotonic()
+        with self._lock:
+            if self.updated is None:
+                self.tokens = rate
+            else:
+                self.tokens = min(rate, self.tokens + (now - self.updated) * rate / 60)
+            self.updated = now
+            if self.tokens < 1:
+                self.suppressed += 1
+                return None
+            self.tokens -= 1
+            suppressed, self.suppressed = self.suppressed, 0
+            return suppressed
+
+    def reset(self) -> None:
+        with self._lock:
+            self.updated = None
+            self.suppressed = 0
+
+
+rate_limiter = RateLimiter()
+
+
+def capture_plan(cursor, statement: str, parameters) -> Optional[dict]:
+    """
+    План медленного запроса в той же транзакции.
+
+    ANALYZE повторно выполняет запрос, поэтому используется только для SELECT. Точка сохранения
+    не даёт ошибке EXPLAIN прервать транзакцию самого запроса.
+    """
+    keyword = statement.lstrip().split(None, 1)[0].upper()
+    if keyword not in EXPLAINABLE:
+        return None
+    cursor.execute("SAVEPOINT slow_query_explain")
+    try:
+        plan = explain(cursor, statement, parameters, analyze=keyword == "SELECT")
+    except Exception:
+        cursor.execute("ROLLBACK TO SAVEPOINT slow_query_explain")
+        raise
+    cursor.execute("RELEASE SAVEPOINT slow_query_explain")
+    return plan
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("slow_query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed_ms = (time.perf_counter() - conn.info["slow_query_start"].pop()) * 1000
+    if cfg.slow_query_threshold_ms <= 0 or elapsed_ms < cfg.slow_query_threshold_ms:
+        return
+    suppressed = rate_limiter.acquire()
+    if suppressed is None:
+        return
+
+    stats = request_stats.get()
+    route = stats.route if stats is not None else None
+    plan = None
+    if not executemany and random.random() < cfg.slow_query_explain_rate:
+        try:
+            plan = capture_plan(conn.connection.cursor(), statement, parameters)
+        except Exception as e:
+            logger.warning("Could not explain slow query: %s", e)
+
+    logger.warning(
+        "Slow query %.1f ms on %s: %s; parameters: %s; plan: %s%s",
+        elapsed_ms, route or "-", " ".join(statement.split()),
+        json.dumps(redact(parameters), default=str),
+        json.dumps(redact_plan(plan)) if plan is not None else "not sampled",
+        f"; {suppressed} slow queries not logged" if suppressed else "",
+    )
+
+
+def install_slow_query_log(engine: Engine) -> None:
+    """Подключает к движку журнал запросов дольше cfg.slow_query_threshold_ms."""
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
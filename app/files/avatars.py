@@ -0,0 +1,151 @@
+import asyncio
+import hashlib
+import io
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Optional, Set
+
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import cfg
+from app.database.connection.session import AsyncSessionLocal
+from app.database.models.user import User
+from app.files.upload import run_s3
+from app.s3.minio import S3Service
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # без Pillow аватарки отдаются только в исходном виде
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+_executor: Optional[ThreadPoolExecutor] = None
+_tasks: Set[asyncio.Task] = set()
+
+
+def variant_key(content_hash: str, size: int) -> str:
+    # ключ зависит только от содержимого, поэтому одинаковые картинки хранятся один раз
+    return f"avatars/{content_hash}/{size}.webp"
+
+
+def render_variants(data: bytes) -> Dict[int, bytes]:
+    """Квадратные уменьшенные копии изображения в WebP для каждого размера из cfg.avatar_sizes."""
+    variants = {}
+    largest = max(cfg.avatar_sizes)
+    with Image.open(io.BytesIO(data)) as image:
+        # размеры известны до распаковки: огромное изображение не загружается в память
+        if image.width * image.height > cfg.avatar_max_pixels:
+            raise ValueError(f"Image has {image.width}x{image.height} pixels, "
+                             f"more than avatar_max_pixels={cfg.avatar_max_pixels}")
+        # JPEG распаковывается сразу в уменьшенном масштабе, не меньше самой большой копии
+        image.draft("RGB", (largest, largest))
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA")
+        scale = largest / min(image.size)
+        if scale < 1:
+            image.thumbnail((round(image.width * scale), round(image.height * scale)), Image.LANCZOS)
+        image = image.convert("RGBA")
+        for size in sorted(cfg.avatar_sizes):
+            thumbnail = ImageOps.fit(image, (size, size), Image.LANCZOS)
+            output = io.BytesIO()
+            thumbnail.save(output, "WEBP", quality=cfg.avatar_webp_quality)
+            variants[size] = output.getvalue()
+    return variants
+
+
+async def reset_avatar_hash(session: AsyncSession, user_id: int) -> None:
+    """Отвязывает копии прежней аватарки: пока новые не готовы, отдаётся исходник."""
+    await session.execute(update(User).where(User.id == user_id).values(avatar_hash=None))
+    await session.commit()
+
+
+async def process_avatar(s3: S3Service, user_id: int, key: str, etag: str) -> Optional[str]:
+    """
+    Строит уменьшенные копии загруженной аватарки и привязывает их к пользователю.
+
+    etag — ETag загруженного объекта: если исходник с тех пор заменён новой загрузкой,
+    копии не привязываются, их привяжет обработка новой загрузки.
+    """
+    data = await run_s3(s3.read_object, key)
+    content_hash = hashlib.sha256(data).hexdigest()
+
+    # самая большая копия пишется последней: если она есть, есть и остальные
+    if not await run_s3(s3.check_object_exists, variant_key(content_hash, max(cfg.avatar_sizes))):
+        global _executor
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=cfg.avatar_workers, thread_name_prefix="avatars")
+        variants = await asyncio.get_running_loop().run_in_executor(_executor, render_variants, data)
+        for size, body in variants.items():
+            await run_s3(s3.put_object, variant_key(content_hash, size), body, "image/webp")
+
+    async with AsyncSessionLocal() as session:
+        # строка пользователя заблокирована на время сверки: сброс хэша новой загрузкой
+        # дождётся этой записи и затрёт её, а сверка после сброса увидит новый ETag
+        await session.execute(select(User.id).where(User.id == user_id).with_for_update())
+        metadata = await run_s3(s3.get_metadata, key)
+        if metadata is None or metadata["ETag"] != etag:
+            logger.info("Avatar of user %s was replaced during processing, skipping", user_id)
+            return None
+        await session.execute(update(User).where(User.id == user_id).values(avatar_hash=content_hash))
+        await session.commit()
+    return content_hash
+
+
+def schedule_avatar_processing(s3: S3Service, user_id: int, key: str, etag: str) -> None:
+    """Запускает обработку аватарки в фоне, не задерживая ответ на загрузку."""
+    if Image is None:
+        return
+    task = asyncio.create_task(process_avatar(s3, user_id, key, etag))
+    _tasks.add(task)
+    task.add_done_callback(_on_done)
+
+
+def _on_done(task: asyncio.Task) -> None:
+    _tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Avatar processing failed", exc_info=task.exception())
+
+
+async def wait_avatar_tasks() -> None:
+    """Дожидается фоновых обработок при остановке приложения."""
+    if _tasks:
+        await asyncio.gather(*_tasks, return_exceptions=True)
+
+
+async def get_avatar_hash(session: AsyncSession, user_id: int) -> Optional[str]:
+    return (await session.execute(select(User.avatar_hash).where(User.id == user_id))).scalar()
+
+
+async def resolve_avatar_links(session: AsyncSession, s3: S3Service,
+                               user_ids: Iterable[int], size: Optional[int]) -> Dict[int, Optional[str]]:
+    """
+    Ссылки на аватарки многих пользователей за один запрос к базе.
+
+    Готовые уменьшенные копии подписываются без проверки существования, для остальных
+    пользователей проверяется исходник; всё выполняется параллельно в пуле потоков S3,
+    так как подпись и первое создание клиента boto3 блокируют цикл событий.
+    """
+    user_ids = list(dict.fromkeys(user_ids))
+    links: Dict[int, Optional[str]] = {user_id: None for user_id in user_ids}
+
+    hashes = {}
+    if size is not None:
+        hashes_query = select(User.id, User.avatar_hash).where(User.id.in_(user_ids),
+                                                               User.avatar_hash.is_not(None))
+        hashes = dict((await session.execute(hashes_query)).fetchall())
+
+    async def variant_link(user_id: int, content_hash: str) -> None:
+        links[user_id] = await run_s3(s3.get_link, variant_key(content_hash, size), False)
+
+    async def original_link(user_id: int) -> None:
+        try:
+            links[user_id] = await run_s3(s3.get_link, s3.create_key("icons", str(user_id)))
+        except FileNotFoundError:
+            pass
+
+    await asyncio.gather(*(variant_link(user_id, content_hash) for user_id, content_hash in hashes.items()),
+                         *(original_link(user_id) for user_id in user_ids if user_id not in hashes))
+    return links
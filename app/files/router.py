@@ -1,23 +1,146 @@
-from fastapi import APIRouter, UploadFile, Header, Depends, HTTPException
+import uuid
+from typing import Optional
 
+from fastapi import APIRouter, Request, Header, Depends, HTTPException, Response
+from fastapi.responses import RedirectResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.cache.etag import etag_matches
+from app.config import cfg
+from app.database.connection.session import get_session
+from app.files.avatars import (get_avatar_hash, reset_avatar_hash, resolve_avatar_links,
+                               schedule_avatar_processing, variant_key)
+from app.files.schema import IconLinks, IconLinksRequest, UploadConfirm, UploadPolicy
+from app.files.upload import run_s3, stream_upload, verify_uploaded_image
 from app.s3.minio import get_s3, S3Service
 
 router = APIRouter(prefix="/files", tags=["files"])
 
+# тело читается потоком, поэтому схему multipart-формы описываем вручную
+FILE_FORM_SCHEMA = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "required": ["file"],
+                    "properties": {"file": {"type": "string", "format": "binary"}},
+                }
+            }
+        },
+    }
+}
+
 
-@router.post("/icon-upload")
-def icon_upload(file: UploadFile,
-                user_id: int = Header(None, alias="x-user-id"),
-                s3: S3Service = Depends(get_s3)) -> str:
+@router.post("/icon-upload", openapi_extra=FILE_FORM_SCHEMA)
+async def icon_upload(request: Request,
+                      user_id: int = Header(None, alias="x-user-id"),
+                      s3: S3Service = Depends(get_s3),
+                      session: AsyncSession = Depends(get_session)) -> str:
     """Загрузка аватарки пользователя"""
-    return s3.upload_file(file, s3.create_key("icons", str(user_id)))
+    key = s3.create_key("icons", str(user_id))
+    etag = await stream_upload(request, s3, key)
+    # хэш сбрасывается, когда новый исходник уже на месте: обработка прежней загрузки,
+    # успевшая записать свой хэш раньше, будет затёрта, а позже — увидит чужой ETag
+    await reset_avatar_hash(session, user_id)
+    schedule_avatar_processing(s3, user_id, key, etag)
+    return await run_s3(s3.get_link, key)
+
+
+def staging_key(user_id: int, upload_id: str) -> str:
+    # прямая загрузка попадает во временный ключ и становится аватаркой только после проверки
+    return f"{cfg.avatar_staging_prefix}/{user_id}/{upload_id}"
+
+
+@router.post("/icon-upload-policy", response_model=UploadPolicy)
+def icon_upload_policy(user_id: int = Header(None, alias="x-user-id"),
+                       s3: S3Service = Depends(get_s3)):
+    """Политика для загрузки аватарки напрямую в S3, минуя приложение"""
+    upload_id = uuid.uuid4().hex
+    policy = s3.create_upload_policy(staging_key(user_id, upload_id),
+                                     cfg.avatar_max_size, cfg.avatar_upload_policy_expires)
+    return {"url": policy["url"], "fields": policy["fields"], "max_size": cfg.avatar_max_size,
+            "upload_id": upload_id}
+
+
+@router.post("/icon-upload-confirm")
+async def icon_upload_confirm(upload: UploadConfirm,
+                              user_id: int = Header(None, alias="x-user-id"),
+                              s3: S3Service = Depends(get_s3),
+                              session: AsyncSession = Depends(get_session)) -> str:
+    """Подтверждение прямой загрузки аватарки: проверка временного объекта и перенос его в аватарку"""
+    source = staging_key(user_id, upload.upload_id)
+    image_type = await run_s3(verify_uploaded_image, s3, source)
+    key = s3.create_key("icons", str(user_id))
+    # тип содержимого берётся по сигнатуре, а не из формы клиента
+    etag = await run_s3(s3.copy_object, source, key, image_type)
+    await run_s3(s3.delete_object, source)
+    await reset_avatar_hash(session, user_id)
+    schedule_avatar_processing(s3, user_id, key, etag)
+    return await run_s3(s3.get_link, key)
 
 
 @router.get("/icon-get-link")
-def icon_get_link(user_id: int = Header(None, alias="x-user-id"),
-                  s3: S3Service = Depends(get_s3)) -> str:
-    """Получить ссылку на аватарку пользователя"""
+async def icon_get_link(size: Optional[int] = None,
+                        user_id: int = Header(None, alias="x-user-id"),
+                        s3: S3Service = Depends(get_s3),
+                        session: AsyncSession = Depends(get_session)) -> str:
+    """Получить ссылку на аватарку пользователя; size выбирает уменьшенную копию"""
+    if size is not None:
+        if size not in cfg.avatar_sizes:
+            raise HTTPException(status_code=400, detail=f"Size must be one of {cfg.avatar_sizes}")
+        content_hash = await get_avatar_hash(session, user_id)
+        # пока копии не готовы, отдаётся исходная аватарка
+        if content_hash is not None:
+            return await run_s3(s3.get_link, variant_key(content_hash, size), False)
     try:
-        return s3.get_link(s3.create_key("icons", str(user_id)))
+        return await run_s3(s3.get_link, s3.create_key("icons", str(user_id)))
     except FileNotFoundError:
-        raise HTTPException(status_code=404, detail="File not found")
\ No newline at end of file
+        raise HTTPException(status_code=404, detail="File not found")
+
+
+@router.post("/icon-get-links", response_model=IconLinks)
+async def icon_get_links(request: IconLinksRequest,
+                         s3: S3Service = Depends(get_s3),
+                         session: AsyncSession = Depends(get_session)):
+    """Ссылки на аватарки нескольких пользователей; null, если аватарки нет"""
+    if len(request.user_ids) > cfg.avatar_links_batch_max:
+        raise HTTPException(status_code=400,
+                            detail=f"User ids list cannot be longer than {cfg.avatar_links_batch_max}")
+    if request.size is not None and request.size not in cfg.avatar_sizes:
+        raise HTTPException(status_code=400, detail=f"Size must be one of {cfg.avatar_sizes}")
+    return {"links": await resolve_avatar_links(session, s3, request.user_ids, request.size)}
+
+
+@router.get("/icon/{user_id}", status_code=307, response_class=RedirectResponse)
+async def icon(user_id: int,
+               size: Optional[int] = None,
+               if_none_match: Optional[str] = Header(None),
+               s3: S3Service = Depends(get_s3),
+               session: AsyncSession = Depends(get_session)):
+    """Перенаправление на аватарку пользователя с ETag; повторный просмотр получает 304"""
+    content_hash = None
+    if size is not None:
+        if size not in cfg.avatar_sizes:
+            raise HTTPException(status_code=400, detail=f"Size must be one of {cfg.avatar_sizes}")
+        content_hash = await get_avatar_hash(session, user_id)
+
+    if content_hash is not None:
+        # ключ копии зависит от содержимого, поэтому ETag известен без запроса к S3
+        key = variant_key(content_hash, size)
+        etag = f'"{content_hash}-{size}"'
+    else:
+        key = s3.create_key("icons", str(user_id))
+        etag = await run_s3(s3.get_etag, key)
+        if etag is None:
+            raise HTTPException(status_code=404, detail="File not found")
+
+    # аватарки доступны без авторизации, поэтому перенаправление может кэшировать CDN;
+    # max-age не больше запаса подписанной ссылки, чтобы она не истекла в кэше
+    max_age = min(cfg.avatar_redirect_max_age, cfg.s3_link_cache_margin)
+    headers = {"ETag": etag, "Cache-Control": f"public, max-age={max_age}"}
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    link = await run_s3(s3.get_link, key, False)
+    return RedirectResponse(link, status_code=307, headers=headers)
@@ -0,0 +1,23 @@
+from typing import Dict, List, Optional
+
+from pydantic import BaseModel, Field
+
+
+class UploadPolicy(BaseModel):
+    url: str
+    fields: Dict[str, str]
+    max_size: int
+    upload_id: str
+
+
+class UploadConfirm(BaseModel):
+    upload_id: str = Field(pattern=r"^[0-9a-f]{32}$")
+
+
+class IconLinksRequest(BaseModel):
+    user_ids: List[int]
+    size: Optional[int] = None
+
+
+class IconLinks(BaseModel):
+    links: Dict[int, Optional[str]]
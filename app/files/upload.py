@@ -0,0 +1,232 @@
+import io
+from typing import Optional
+
+from anyio import CapacityLimiter, to_thread
+from fastapi import HTTPException, Request
+
+from app.config import cfg
+from app.s3.minio import S3Service
+
+try:
+    import python_multipart as multipart
+    from python_multipart.exceptions import ParseError
+    from python_multipart.multipart import parse_options_header
+except ModuleNotFoundError:  # старые версии python-multipart
+    import multipart
+    from multipart.exceptions import ParseError
+    from multipart.multipart import parse_options_header
+
+try:
+    from PIL import Image
+except ImportError:  # без Pillow размеры изображения не проверяются, копии не строятся
+    Image = None
+
+# запас на заголовки и границы multipart/form-data сверх размера самого файла
+MULTIPART_OVERHEAD = 16 * 1024
+
+IMAGE_SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+)
+
+# отдельный лимит потоков для S3, чтобы загрузки не занимали общий пул потоков
+s3_limiter = CapacityLimiter(cfg.s3_upload_threads)
+
+
+async def run_s3(func, *args):
+    return await to_thread.run_sync(func, *args, limiter=s3_limiter)
+
+
+def sniff_image_type(head: bytes) -> Optional[str]:
+    """Определяет тип изображения по первым байтам файла."""
+    for signature, content_type in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return content_type
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+
+def check_image_pixels(head: bytes) -> None:
+    """
+    Отклоняет изображение, размеры которого в заголовке больше cfg.avatar_max_pixels.
+
+    Pillow читает только заголовок; если размеры не поместились в head, проверку повторит
+    render_variants перед распаковкой.
+    """
+    if Image is None:
+        return
+    try:
+        with Image.open(io.BytesIO(head)) as image:
+            pixels = image.width * image.height
+    except Image.DecompressionBombError:
+        raise HTTPException(status_code=413, detail="Image dimensions are too large")
+    except Exception:
+        return
+    if pixels > cfg.avatar_max_pixels:
+        raise HTTPException(status_code=413, detail="Image dimensions are too large")
+
+
+class FilePartReader:
+    """Разбирает multipart/form-data по мере поступления и накапливает байты одного поля."""
+
+    def __init__(self, boundary: bytes, field_name: str):
+        self.field_name = field_name.encode()
+        self.buffer = bytearray()
+        self.received = 0
+        self.found = False
+        self.finished = False
+        self._in_field = False
+        self._headers = {}
+        self._header_field = b""
+        self._header_value = b""
+        self.parser = multipart.MultipartParser(boundary, callbacks={
+            "on_part_begin": self._on_part_begin,
+            "on_header_field": self._on_header_field,
+            "on_header_value": self._on_header_value,
+            "on_header_end": self._on_header_end,
+            "on_headers_finished": self._on_headers_finished,
+            "on_part_data": self._on_part_data,
+            "on_part_end": self._on_part_end,
+        })
+
+    def write(self, chunk: bytes) -> None:
+        self.parser.write(chunk)
+
+    def _on_part_begin(self) -> None:
+        self._headers = {}
+
+    def _on_header_field(self, data: bytes, start: int, end: int) -> None:
+        self._header_field += data[start:end]
+
+    def _on_header_value(self, data: bytes, start: int, end: int) -> None:
+        self._header_value += data[start:end]
+
+    def _on_header_end(self) -> None:
+        self._headers[self._header_field.lower()] = self._header_value
+        self._header_field = b""
+        self._header_value = b""
+
+    def _on_headers_finished(self) -> None:
+        _, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+        self._in_field = not self.found and options.get(b"name") == self.field_name
+        self.found = self.found or self._in_field
+
+    def _on_part_data(self, data: bytes, start: int, end: int) -> None:
+        if self._in_field:
+            self.buffer += data[start:end]
+            self.received += end - start
+
+    def _on_part_end(self) -> None:
+        if self._in_field:
+            self._in_field = False
+            self.finished = True
+
+
+class MultipartUpload:
+    """Загрузка объекта в S3 частями по мере чтения запроса."""
+
+    def __init__(self, s3: S3Service, key: str, content_type: str):
+        self.s3 = s3
+        self.key = key
+        self.content_type = content_type
+        self.upload_id = None
+        self.parts = []
+
+    async def send(self, body: bytes) -> None:
+        if self.upload_id is None:
+            self.upload_id = await run_s3(self.s3.start_multipart_upload, self.key, self.content_type)
+        part = await run_s3(self.s3.upload_part, self.key, self.upload_id, len(self.parts) + 1, body)
+        self.parts.append(part)
+
+    async def complete(self) -> str:
+        return await run_s3(self.s3.complete_multipart_upload, self.key, self.upload_id, self.parts)
+
+    async def abort(self) -> None:
+        if self.upload_id is not None:
+            await run_s3(self.s3.abort_multipart_upload, self.key, self.upload_id)
+
+
+async def stream_upload(request: Request, s3: S3Service, key: str, field_name: str = "file") -> str:
+    """
+    Передаёт файл из multipart/form-data запроса в S3, не сохраняя его целиком, и возвращает ETag объекта.
+
+    Тип содержимого проверяется по первым байтам, превышение размера прерывает
+    загрузку сразу, а незавершённая multipart-загрузка в S3 отменяется.
+    """
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > cfg.avatar_max_size + MULTIPART_OVERHEAD:
+        raise HTTPException(status_code=413, detail="File is too large")
+
+    content_type, options = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or b"boundary" not in options:
+        raise HTTPException(status_code=400, detail="Expected multipart/form-data with a file")
+
+    reader = FilePartReader(options[b"boundary"], field_name)
+    upload = None
+    pixels_checked = False
+    try:
+        async for chunk in request.stream():
+            try:
+                reader.write(chunk)
+            except ParseError:
+                raise HTTPException(status_code=400, detail="Malformed multipart body")
+
+            if reader.received > cfg.avatar_max_size:
+                raise HTTPException(status_code=413, detail="File is too large")
+            if upload is None and (len(reader.buffer) >= 16 or reader.finished) and reader.buffer:
+                image_type = sniff_image_type(bytes(reader.buffer[:16]))
+                if image_type is None:
+                    raise HTTPException(status_code=415, detail="Unsupported file type")
+                upload = MultipartUpload(s3, key, image_type)
+            if upload is not None and not pixels_checked and (len(reader.buffer) >= cfg.avatar_header_size
+                                                              or reader.finished):
+                # первая часть уходит в S3 не раньше avatar_upload_chunk_size, буфер ещё с начала файла
+                check_image_pixels(bytes(reader.buffer[:cfg.avatar_header_size]))
+                pixels_checked = True
+            while upload is not None and len(reader.buffer) >= cfg.avatar_upload_chunk_size:
+                await upload.send(bytes(reader.buffer[:cfg.avatar_upload_chunk_size]))
+                del reader.buffer[:cfg.avatar_upload_chunk_size]
+            if reader.finished:
+                break
+
+        if not reader.finished or upload is None:
+            raise HTTPException(status_code=400, detail="File is missing")
+
+        if not upload.parts:
+            # файл поместился в одну часть: обычный PUT без multipart-загрузки
+            return await run_s3(s3.put_object, key, bytes(reader.buffer), upload.content_type)
+        if reader.buffer:
+            await upload.send(bytes(reader.buffer))
+        return await upload.complete()
+    except BaseException:
+        if upload is not None:
+            await upload.abort()
+        raise
+
+
+def verify_uploaded_image(s3: S3Service, key: str) -> str:
+    """
+    Проверяет объект, загруженный клиентом напрямую в S3, и возвращает его тип по первым байтам.
+
+    Неподходящий объект удаляется, чтобы по ключу аватарки не отдавался чужой контент.
+    """
+    metadata = s3.get_metadata(key)
+    if metadata is None:
+        raise HTTPException(status_code=404, detail="File not found")
+    if metadata["ContentLength"] > cfg.avatar_max_size:
+        s3.delete_object(key)
+        raise HTTPException(status_code=413, detail="File is too large")
+    head = s3.read_head(key, cfg.avatar_header_size)
+    image_type = sniff_image_type(head[:16])
+    if image_type is None:
+        s3.delete_object(key)
+        raise HTTPException(status_code=415, detail="Unsupported file type")
+    try:
+        check_image_pixels(head)
+    except HTTPException:
+        s3.delete_object(key)
+        raise
+    return image_type
@@ -0,0 +1,62 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable
+
+from fastapi import FastAPI
+
+from app.config import cfg
+from app.database.connection.session import AsyncSessionLocal, async_engine
+from app.files.avatars import wait_avatar_tasks
+from app.s3.minio import s3_service
+from app.tags.service import tag_dictionary, tag_suggester
+
+logger = logging.getLogger(__name__)
+
+
+async def with_retries(name: str, action: Callable[[], Awaitable]) -> None:
+    """Выполняет action, повторяя с экспоненциальной паузой, пока зависимость не поднимется."""
+    delay = cfg.startup_retry_delay
+    for attempt in range(1, cfg.startup_retries + 1):
+        try:
+            await action()
+            return
+        except Exception as e:
+            if attempt == cfg.startup_retries:
+                raise
+            logger.warning("%s is not ready (attempt %d of %d): %s", name, attempt, cfg.startup_retries, e)
+            await asyncio.sleep(delay)
+            delay *= 2
+
+
+async def init_postgres() -> None:
+    # схему создают только миграции goose (make migration-up), приложение её не меняет
+    async with AsyncSessionLocal() as session:
+        await tag_dictionary.warm(session)
+        await tag_suggester.detect(session)
+
+
+async def refresh_tag_popularity() -> None:
+    """Фоновый пересчёт популярности тегов; ошибка одного прохода не останавливает следующие."""
+    while True:
+        await asyncio.sleep(cfg.tag_popularity_refresh_interval)
+        try:
+            async with AsyncSessionLocal() as session:
+                await tag_suggester.refresh_popularity(session)
+        except Exception:
+            logger.exception("Tag popularity refresh failed")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # зависимости поднимаются параллельно, а не при импорте модулей
+    await asyncio.gather(
+        with_retries("postgres", init_postgres),
+        with_retries("s3", lambda: asyncio.to_thread(s3_service.ensure_bucket)),
+    )
+    popularity = asyncio.create_task(refresh_tag_popularity())
+    yield
+    popularity.cancel()
+    await asyncio.gather(popularity, return_exceptions=True)
+    await wait_avatar_tasks()
+    await async_engine.dispose()
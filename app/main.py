@@ -1,10 +1,15 @@
 from fastapi import FastAPI
 
 from app.config import cfg
+from app.database.connection.session import async_engine
+from app.lifespan import lifespan
+from app.monitoring.metrics import MetricsMiddleware, instrument_engine
 from app.files.router import router as files_router
 from app.users.router import router as register_router
 from app.tags.router import router as tags_router
 from app.bookmarks.router import router as bookmarks_router
+from app.monitoring.router import router as monitoring_router, metrics_router
+from app.account.router import router as account_router
 
 
 app = FastAPI(
@@ -12,12 +17,18 @@ app = FastAPI(
     description=cfg.app_desc,
     version=cfg.app_version,
     debug=cfg.debug,
+    lifespan=lifespan,
 )
+app.add_middleware(MetricsMiddleware)
+instrument_engine(async_engine.sync_engine)
 
 app.include_router(files_router)
 app.include_router(register_router)
 app.include_router(bookmarks_router)
 app.include_router(tags_router)
+app.include_router(account_router)
+app.include_router(monitoring_router)
+app.include_router(metrics_router)
 
 
 @app.get("/")
@@ -0,0 +1,190 @@
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app.config import cfg
+
+Labels = Tuple[str, ...]
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+def _format_labels(names: Sequence[str], values: Labels, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values: Dict[Labels, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels: str, amount: float = 1.0) -> None:
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0.0) + amount
+
+    def collect(self, kind: str = "counter") -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {kind}"]
+        for labels, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class Gauge(Counter):
+    def dec(self, *labels: str, amount: float = 1.0) -> None:
+        self.inc(*labels, amount=-amount)
+
+    def collect(self, kind: str = "gauge") -> List[str]:
+        return super().collect(kind)
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # по меткам: количество наблюдений в каждом интервале (последний — +Inf), сумма
+        self.values: Dict[Labels, Tuple[List[int], List[float]]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels: str) -> None:
+        with self._lock:
+            counts, total = self.values.setdefault(labels, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[bisect_left(self.buckets, value)] += 1
+            total[0] += value
+
+    def collect(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                bucket_labels = _format_labels(self.labelnames, labels, 'le="' + le + '"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            label_text = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_text} {total[0]}")
+            lines.append(f"{self.name}_count{label_text} {cumulative}")
+        return lines
+
+
+requests_total = Counter("http_requests_total", "HTTP requests by route and status.",
+                         ("method", "route", "status"))
+request_duration = Histogram("http_request_duration_seconds", "HTTP request latency.", ("method", "route"))
+# маршрут известен только после сопоставления внутри приложения, поэтому gauge разбит лишь по методу
+requests_in_flight = Gauge("http_requests_in_flight", "HTTP requests being processed.", ("method",))
+request_queries = Histogram("http_request_db_queries", "Database queries per HTTP request.",
+                            ("method", "route"), buckets=QUERY_COUNT_BUCKETS)
+request_db_duration = Histogram("http_request_db_duration_seconds", "Database time per HTTP request.",
+                                ("method", "route"))
+
+METRICS = (requests_total, request_duration, requests_in_flight, request_queries, request_db_duration)
+
+
+def render_metrics() -> str:
+    """Метрики в текстовом формате Prometheus."""
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.collect())
+    return "\n".join(lines) + "\n"
+
+
+class RequestStats:
+    """Запросы к базе, выполненные при обработке текущего HTTP-запроса."""
+
+    def __init__(self, scope=None):
+        self.scope = scope
+        self.queries = 0
+        self.db_time = 0.0
+
+    @property
+    def route(self) -> Optional[str]:
+        return _route_path(self.scope) if self.scope is not None else None
+
+
+# статистика текущего запроса; события движка выполняются в гринлете, который наследует контекст задачи
+request_stats: ContextVar[Optional[RequestStats]] = ContextVar("request_stats", default=None)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_start"].pop()
+    stats = request_stats.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.db_time += elapsed
+
+
+def instrument_engine(engine: Engine) -> None:
+    """Подключает к движку подсчёт запросов и времени в базе для текущего HTTP-запроса."""
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+
+def _route_path(scope) -> str:
+    # шаблон пути вместо самого пути, чтобы число меток не росло с идентификаторами
+    route = scope.get("route")
+    return getattr(route, "path_format", None) or getattr(route, "path", None) or "unmatched"
+
+
+class MetricsMiddleware:
+    """ASGI-middleware: задержка, статусы и число обрабатываемых запросов по маршрутам."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        stats = RequestStats(scope)
+        token = request_stats.set(stats)
+        start = time.perf_counter()
+        status = 500
+        requests_in_flight.inc(method)
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if cfg.debug:
+                    elapsed_ms = (time.perf_counter() - start) * 1000
+                    timing = (f"app;dur={elapsed_ms:.1f}, "
+                              f'db;dur={stats.db_time * 1000:.1f};desc="{stats.queries} queries"')
+                    message = {**message, "headers": [*message.get("headers", []),
+                                                      (b"server-timing", timing.encode())]}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            request_stats.reset(token)
+            requests_in_flight.dec(method)
+            route = _route_path(scope)
+            elapsed = time.perf_counter() - start
+            requests_total.inc(method, route, str(status))
+            request_duration.observe(elapsed, method, route)
+            request_queries.observe(stats.queries, method, route)
+            request_db_duration.observe(stats.db_time, method, route)
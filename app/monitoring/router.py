@@ -0,0 +1,35 @@
+from typing import Dict
+
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+from app.cache.response import response_cache
+from app.database.connection.pool import pool_status
+from app.database.connection.session import async_engine
+from app.monitoring.metrics import render_metrics
+from app.monitoring.schema import PoolStatus, CacheStatus
+from app.s3.minio import s3_service
+
+router = APIRouter(prefix="/monitoring", tags=["monitoring"])
+# путь по умолчанию для сборщика Prometheus
+metrics_router = APIRouter(tags=["monitoring"])
+
+
+@router.get("/pool", response_model=PoolStatus)
+async def get_pool_status():
+    """Текущее состояние пула соединений с базой данных"""
+    return pool_status(async_engine)
+
+
+@router.get("/cache", response_model=Dict[str, CacheStatus])
+async def get_cache_status():
+    """Размер и доля попаданий кэшей"""
+    caches = {"s3_links": s3_service.links.stats()}
+    caches.update({f"responses.{scope}": stats for scope, stats in response_cache.stats().items()})
+    return caches
+
+
+@metrics_router.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Метрики HTTP-запросов и запросов к базе в текстовом формате Prometheus"""
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,24 @@
+from typing import Optional
+
+from pydantic import BaseModel
+
+
+class PoolStatus(BaseModel):
+    size: int
+    checked_in: int
+    checked_out: int
+    overflow: int
+    checkouts: int
+    timeouts: int
+    wait_total_ms: float
+    wait_max_ms: float
+    wait_avg_ms: float
+
+
+class CacheStatus(BaseModel):
+    # неизвестны для внешнего хранилища
+    size: Optional[int]
+    maxsize: Optional[int]
+    hits: int
+    misses: int
+    hit_ratio: float
@@ -1,33 +1,169 @@
+import logging
+import threading
+from typing import Optional
+
 import boto3
 from botocore.client import BaseClient
 from botocore.exceptions import ClientError, EndpointConnectionError
 
+from app.cache.ttl import TTLCache
 from app.config import cfg
 
+logger = logging.getLogger(__name__)
+
+# правило жизненного цикла для неподтверждённых прямых загрузок аватарок
+STAGING_RULE_ID = "expire-avatar-uploads"
+
 
 class S3Service:
     def __init__(self):
-        self.s3_client: BaseClient = boto3.client(
-            "s3",
-            endpoint_url=cfg.minio_url,
-            aws_access_key_id=cfg.minio_root_user,
-            aws_secret_access_key=cfg.minio_root_password
-        )
         self.bucket_name = cfg.s3_bucket_name
+        self._s3_client: Optional[BaseClient] = None
+        self._client_lock = threading.Lock()
+        # подписанные ссылки по ключу объекта
+        self.links = TTLCache(maxsize=cfg.s3_link_cache_size,
+                              ttl=cfg.s3_link_expires - cfg.s3_link_cache_margin)
+        # ETag объектов по ключу, сбрасываются вместе со ссылками; сброс виден только
+        # в текущем процессе, поэтому другие воркеры отдают старый ETag не дольше,
+        # чем браузер или CDN и так держат перенаправление
+        self.etags = TTLCache(maxsize=cfg.s3_link_cache_size,
+                              ttl=min(cfg.s3_link_expires - cfg.s3_link_cache_margin,
+                                      cfg.avatar_redirect_max_age))
+
+    @property
+    def s3_client(self) -> BaseClient:
+        # клиент создаётся при первом обращении, а не при импорте модуля
+        if self._s3_client is None:
+            with self._client_lock:
+                if self._s3_client is None:
+                    self._s3_client = boto3.client(
+                        "s3",
+                        endpoint_url=cfg.minio_url,
+                        aws_access_key_id=cfg.minio_root_user,
+                        aws_secret_access_key=cfg.minio_root_password
+                    )
+        return self._s3_client
+
+    @s3_client.setter
+    def s3_client(self, client: BaseClient) -> None:
+        self._s3_client = client
+
+    def ensure_bucket(self) -> None:
         try:
             self.s3_client.head_bucket(Bucket=self.bucket_name)
         except ClientError:
             # Если бакет не существует, создаем его
             self.s3_client.create_bucket(Bucket=self.bucket_name)
+        self.ensure_staging_rule()
+
+    def ensure_staging_rule(self) -> None:
+        """
+        Добавляет правило, по которому S3 удаляет неподтверждённые прямые загрузки.
+
+        PUT заменяет всю конфигурацию жизненного цикла, поэтому чужие правила общего бакета
+        сохраняются, а уже добавленное правило не перезаписывается. Хранилище без поддержки
+        жизненного цикла не мешает старту: правило тогда должна настроить инфраструктура.
+        """
+        try:
+            try:
+                rules = self.s3_client.get_bucket_lifecycle_configuration(Bucket=self.bucket_name)["Rules"]
+            except ClientError as e:
+                if e.response.get("Error", {}).get("Code") != "NoSuchLifecycleConfiguration":
+                    raise
+                rules = []
+            if any(rule.get("ID") == STAGING_RULE_ID for rule in rules):
+                return
+            rules.append({
+                "ID": STAGING_RULE_ID,
+                "Filter": {"Prefix": cfg.avatar_staging_prefix + "/"},
+                "Status": "Enabled",
+                "Expiration": {"Days": cfg.avatar_staging_expire_days},
+            })
+            self.s3_client.put_bucket_lifecycle_configuration(Bucket=self.bucket_name,
+                                                              LifecycleConfiguration={"Rules": rules})
+        except ClientError as e:
+            logger.warning("Cannot configure lifecycle of bucket %s, staging uploads under %s/ will not expire: %s",
+                           self.bucket_name, cfg.avatar_staging_prefix, e)
 
     @staticmethod
     def create_key(folder: str, key: str) -> str:
         return f"{folder}/{key}"
 
-    def upload_file(self, file, key: str) -> str:
-        self.s3_client.upload_fileobj(file.file, self.bucket_name, key)
+    def put_object(self, key: str, body: bytes, content_type: str) -> str:
+        response = self.s3_client.put_object(Bucket=self.bucket_name, Key=key, Body=body,
+                                             ContentType=content_type)
+        self.invalidate_link(key)
+        return response["ETag"]
+
+    def copy_object(self, source: str, key: str, content_type: str) -> str:
+        response = self.s3_client.copy_object(Bucket=self.bucket_name, Key=key,
+                                              CopySource={"Bucket": self.bucket_name, "Key": source},
+                                              ContentType=content_type, MetadataDirective="REPLACE")
+        self.invalidate_link(key)
+        return response["CopyObjectResult"]["ETag"]
+
+    def start_multipart_upload(self, key: str, content_type: str) -> str:
+        response = self.s3_client.create_multipart_upload(Bucket=self.bucket_name, Key=key,
+                                                          ContentType=content_type)
+        return response["UploadId"]
+
+    def upload_part(self, key: str, upload_id: str, number: int, body: bytes) -> dict:
+        response = self.s3_client.upload_part(Bucket=self.bucket_name, Key=key, UploadId=upload_id,
+                                               PartNumber=number, Body=body)
+        return {"ETag": response["ETag"], "PartNumber": number}
+
+    def complete_multipart_upload(self, key: str, upload_id: str, parts: list) -> str:
+        response = self.s3_client.complete_multipart_upload(Bucket=self.bucket_name, Key=key,
+                                                            UploadId=upload_id,
+                                                            MultipartUpload={"Parts": parts})
+        self.invalidate_link(key)
+        return response["ETag"]
+
+    def abort_multipart_upload(self, key: str, upload_id: str) -> None:
+        self.s3_client.abort_multipart_upload(Bucket=self.bucket_name, Key=key, UploadId=upload_id)
+
+    def create_upload_policy(self, key: str, max_size: int, expires: int) -> dict:
+        """Подписанная POST-политика для загрузки объекта клиентом напрямую в S3."""
+        return self.s3_client.generate_presigned_post(
+            Bucket=self.bucket_name,
+            Key=key,
+            Conditions=[
+                ["content-length-range", 1, max_size],
+                ["starts-with", "$Content-Type", "image/"],
+            ],
+            ExpiresIn=expires,
+        )
+
+    def get_metadata(self, key: str) -> Optional[dict]:
+        try:
+            return self.s3_client.head_object(Bucket=self.bucket_name, Key=key)
+        except ClientError:
+            return None
+
+    def read_object(self, key: str) -> bytes:
+        return self.s3_client.get_object(Bucket=self.bucket_name, Key=key)["Body"].read()
+
+    def read_head(self, key: str, size: int) -> bytes:
+        response = self.s3_client.get_object(Bucket=self.bucket_name, Key=key, Range=f"bytes=0-{size - 1}")
+        return response["Body"].read()
+
+    def delete_object(self, key: str) -> None:
+        self.s3_client.delete_object(Bucket=self.bucket_name, Key=key)
+        self.invalidate_link(key)
+
+    def get_etag(self, key: str) -> Optional[str]:
+        etag = self.etags.get(key)
+        if etag is None:
+            metadata = self.get_metadata(key)
+            if metadata is None:
+                return None
+            etag = metadata["ETag"]
+            self.etags.set(key, etag)
+        return etag
 
-        return self.get_link(key)
+    def invalidate_link(self, key: str) -> None:
+        self.links.invalidate(key)
+        self.etags.invalidate(key)
 
     def check_object_exists(self, key):
         try:
@@ -37,12 +173,17 @@ class S3Service:
         except ClientError:
             return False  # Объект не найден
 
-    def get_link(self, key):
-        if not self.check_object_exists(key):
+    def get_link(self, key, check_exists: bool = True):
+        link = self.links.get(key)
+        if link is not None:
+            return link
+        if check_exists and not self.check_object_exists(key):
             raise FileNotFoundError("Object does not exist.")
-        return self.s3_client.generate_presigned_url('get_object',
-                                                      Params={'Bucket': self.bucket_name, 'Key': key},
-                                                      ExpiresIn=3600)
+        link = self.s3_client.generate_presigned_url('get_object',
+                                                     Params={'Bucket': self.bucket_name, 'Key': key},
+                                                     ExpiresIn=cfg.s3_link_expires)
+        self.links.set(key, link)
+        return link
 
 
 
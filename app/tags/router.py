@@ -1,22 +1,26 @@
 from datetime import datetime, timezone
-from fastapi import APIRouter, Depends, HTTPException, Header
-from sqlalchemy import select, delete, literal
+from fastapi import APIRouter, Depends, HTTPException, Header, Query
+from sqlalchemy import select, delete, literal, union_all
 from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
 
+from app.cache.response import TAGS, CachedResponse, ResponseCacheScope, response_cache
+from app.config import cfg
 from app.database.connection.session import get_session
 from app.database.models.tag import UserTag, Tag
-from app.database.models.user import User
-from app.tags.schemas import TagsInput, TagsOutput
+from app.users.service import bump_version, get_version, version_etag
+from app.tags.schemas import TagsChanges, TagsInput, TagsOutput
+from app.tags.service import tag_dictionary, tag_suggester
 
 
 router = APIRouter(prefix="/tags", tags=["tags"])
 
 
 @router.post("/update", response_model=dict)
-def update_user_tags(tags_input: TagsInput,
-                     user_id: int = Header(None, alias="x-user-id"),
-                     session=Depends(get_session)):
+async def update_user_tags(tags_input: TagsInput,
+                           user_id: int = Header(None, alias="x-user-id"),
+                           session: AsyncSession = Depends(get_session)):
 
     """
     Сохраняет теги для пользователя. Игнорирует дубликаты.
@@ -31,76 +35,66 @@ def update_user_tags(tags_input: TagsInput,
     if not tags_input.tags:
         raise HTTPException(status_code=400, detail="Tags list cannot be empty or some tags is empty")
     
-    user_exists_query = select(User).where(User.id == user_id)
-    user_exists = session.execute(user_exists_query).fetchone()
-    if not user_exists:
-        raise HTTPException(status_code=404, detail=f"User with id {user_id} not found")
-
-    tags_insert_query = (
-        pg_insert(Tag)
-        .values([{"name": name} for name in tags_input.tags])
-        .on_conflict_do_nothing(index_elements=["name"])
-    )
-    session.execute(tags_insert_query)
+    await bump_version(user_id, session)
 
+    # в базу попадают только неизвестные словарю теги, связи пишутся сразу по id
+    tag_ids, created = await tag_dictionary.resolve(session, tags_input.tags, create=True)
+    created_at = datetime.now(timezone.utc)
     user_tags_query = (
         pg_insert(UserTag)
-        .from_select(
-            ["user_id", "tag_id", "created_at"],
-            select(
-                literal(user_id).label("user_id"),
-                Tag.id.label("tag_id"),
-                literal(datetime.now(timezone.utc)).label("created_at"),
-            ).where(Tag.name.in_(tags_input.tags))
-        )
+        .values([{"user_id": user_id, "tag_id": tag_id, "created_at": created_at}
+                 for tag_id in sorted(tag_ids.values())])
         .on_conflict_do_nothing(index_elements=["user_id", "tag_id"])
     )
 
     try:
-        session.execute(user_tags_query)
-        session.commit()
+        await session.execute(user_tags_query)
+        await session.commit()
     except SQLAlchemyError as e:
-        session.rollback()
+        await session.rollback()
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+    tag_dictionary.remember(created)
+    await response_cache.invalidate(user_id, TAGS)
 
     return {"message": "Tags successfully saved"}
 
 
 @router.get("/get", response_model=TagsOutput)
-def get_user_tags(user_id: int = Header(None, alias="x-user-id"),
-                  session=Depends(get_session)):
+async def get_user_tags(user_id: int = Header(None, alias="x-user-id"),
+                        cached: CachedResponse = Depends(ResponseCacheScope(TAGS)),
+                        session: AsyncSession = Depends(get_session)):
 
     """
     Получает список тегов пользователя по ID.
 
     :param user_id: Идентификатор пользователя, для которого запрашиваются теги.
+    :param cached: Ответ в кэше ответов пользователя, передаётся через Depends.
     :param session: Подключение к базе данных, передаётся через Depends.
     :return: Объект TagsOutput, содержащий список тегов пользователя.
     :raises HTTPException: Если для указанного пользователя теги не найдены.
     """
-
-    user_exists_query = select(User).where(User.id == user_id)
-    user_exists = session.execute(user_exists_query).fetchone()
-    if not user_exists:
-        raise HTTPException(status_code=404, detail=f"User with id {user_id} not found")
+    etag = version_etag(user_id, await get_version(user_id, session))
+    response = await cached.get(user_id, etag)
+    if response is not None:
+        return response
 
     query = (
         select(Tag.name)
         .join(UserTag, UserTag.tag_id == Tag.id)
         .where(UserTag.user_id == user_id)
     )
-    result = session.execute(query).fetchall()
+    result = (await session.execute(query)).fetchall()
 
     if not result:
         raise HTTPException(status_code=404, detail="No tags found for this user")
 
-    return {"tags": [row[0] for row in result]}
+    return await cached.store(user_id, etag, TagsOutput, {"tags": [row[0] for row in result]})
 
 
 @router.post("/delete", response_model=dict)
-def delete_user_tags(tags_input: TagsInput,
-                     user_id: int = Header(None, alias="x-user-id"),
-                     session=Depends(get_session)):
+async def delete_user_tags(tags_input: TagsInput,
+                           user_id: int = Header(None, alias="x-user-id"),
+                           session: AsyncSession = Depends(get_session)):
 
     """
     Удаляет теги для пользователя.
@@ -114,23 +108,96 @@ def delete_user_tags(tags_input: TagsInput,
     if not tags_input.tags:
         raise HTTPException(status_code=400, detail="Tags list cannot be empty")
 
-    user_exists_query = select(User).where(User.id == user_id)
-    user_exists = session.execute(user_exists_query).fetchone()
-    if not user_exists:
-        raise HTTPException(status_code=404, detail=f"User with id {user_id} not found")
+    await bump_version(user_id, session)
 
+    tag_ids, _ = await tag_dictionary.resolve(session, tags_input.tags)
     delete_query = (
         delete(UserTag)
-        .where(UserTag.user_id == user_id, UserTag.tag_id.in_(
-            select(Tag.id).where(Tag.name.in_(tags_input.tags))
-        ))
+        .where(UserTag.user_id == user_id, UserTag.tag_id.in_(tag_ids.values()))
     )
 
     try:
-        session.execute(delete_query)
-        session.commit()
+        await session.execute(delete_query)
+        await session.commit()
     except SQLAlchemyError as e:
-        session.rollback()
+        await session.rollback()
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+    await response_cache.invalidate(user_id, TAGS)
 
     return {"message": "Tags successfully deleted"}
+
+
+@router.put("/set", response_model=TagsChanges)
+async def set_user_tags(tags_input: TagsInput,
+                        user_id: int = Header(None, alias="x-user-id"),
+                        session: AsyncSession = Depends(get_session)):
+
+    """
+    Заменяет набор тегов пользователя на переданный одним запросом к user_tags.
+
+    :param user_id: Идентификатор пользователя, теги которого заменяются.
+    :param tags_input: Итоговый список тегов пользователя; пустой список удаляет все теги.
+    :param session: Подключение к базе данных, передаётся через Depends.
+    :return: Объект TagsChanges с добавленными и удалёнными тегами.
+    :raises HTTPException: Если какой-то тег пустой, не найден пользователь или произошла ошибка базы данных.
+    """
+    if any(not name.strip() for name in tags_input.tags):
+        raise HTTPException(status_code=400, detail="Some tags is empty")
+
+    await bump_version(user_id, session)
+
+    tag_ids, created = await tag_dictionary.resolve(session, tags_input.tags, create=True)
+    ids = sorted(tag_ids.values())
+
+    # удаление и вставка — CTE одного запроса: уже привязанные теги не трогаются и сохраняют created_at
+    removed = (
+        delete(UserTag)
+        .where(UserTag.user_id == user_id, UserTag.tag_id.notin_(ids))
+        .returning(UserTag.tag_id)
+        .cte("removed")
+    )
+    changes = [select(literal("removed").label("change"), Tag.name).join(removed, removed.c.tag_id == Tag.id)]
+    if ids:
+        created_at = datetime.now(timezone.utc)
+        added = (
+            pg_insert(UserTag)
+            .values([{"user_id": user_id, "tag_id": tag_id, "created_at": created_at} for tag_id in ids])
+            .on_conflict_do_nothing(index_elements=["user_id", "tag_id"])
+            .returning(UserTag.tag_id)
+            .cte("added")
+        )
+        changes.append(select(literal("added"), Tag.name).join(added, added.c.tag_id == Tag.id))
+
+    try:
+        rows = (await session.execute(union_all(*changes))).all()
+        await session.commit()
+    except SQLAlchemyError as e:
+        await session.rollback()
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+    tag_dictionary.remember(created)
+    await response_cache.invalidate(user_id, TAGS)
+
+    result = {"added": [], "removed": []}
+    for change, name in rows:
+        result[change].append(name)
+    return {change: sorted(names) for change, names in result.items()}
+
+
+@router.get("/suggest", response_model=TagsOutput)
+async def suggest_tags(q: str = Query(..., min_length=cfg.tag_suggest_min_length, max_length=100),
+                       limit: int = Query(cfg.tag_suggest_limit, ge=1, le=cfg.tag_suggest_limit_max),
+                       session: AsyncSession = Depends(get_session)):
+
+    """
+    Подсказывает теги по началу имени, самые популярные первыми.
+
+    :param q: Начало имени тега; без учёта регистра.
+    :param limit: Максимальное число подсказок.
+    :param session: Подключение к базе данных, передаётся через Depends.
+    :return: Объект TagsOutput со списком подходящих тегов.
+    """
+    q = q.strip()
+    if len(q) < cfg.tag_suggest_min_length:
+        raise HTTPException(status_code=422,
+                            detail=f"Query must be at least {cfg.tag_suggest_min_length} characters long")
+    return {"tags": await tag_suggester.suggest(session, q, limit)}
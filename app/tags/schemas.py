@@ -9,4 +9,10 @@ class TagsInput(BaseModel):
 
 class TagsOutput(BaseModel):
     """Схема для получения тегов пользователя."""
-    tags: List[str]
\ No newline at end of file
+    tags: List[str]
+
+
+class TagsChanges(BaseModel):
+    """Схема изменений тегов пользователя после замены набора."""
+    added: List[str]
+    removed: List[str]
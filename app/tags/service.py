@@ -0,0 +1,141 @@
+from typing import Dict, Iterable, List, Tuple
+
+from sqlalchemy import delete, func, select, text, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import cfg
+from app.database.models.tag import Tag, UserTag, tag_popularity_changes
+
+
+class TagDictionary:
+    """
+    Словарь имя тега -> id в памяти процесса.
+
+    Теги общие для всех пользователей, их немного и они не удаляются, поэтому словарь не устаревает:
+    прогревается при старте и дополняется при промахах.
+    """
+
+    def __init__(self):
+        self.ids: Dict[str, int] = {}
+
+    async def warm(self, session: AsyncSession) -> None:
+        rows = await session.execute(select(Tag.name, Tag.id))
+        self.ids.update(rows.tuples().all())
+
+    async def resolve(self, session: AsyncSession, names: Iterable[str],
+                      create: bool = False) -> Tuple[Dict[str, int], Dict[str, int]]:
+        """
+        Находит id тегов, при create=True добавляет неизвестные.
+
+        Возвращает найденные id и отдельно созданные в текущей транзакции: их нужно запомнить через
+        remember() только после коммита, иначе откат оставит в словаре несуществующие id.
+        """
+        names = set(names)
+        missing = sorted(names - self.ids.keys())
+        created: Dict[str, int] = {}
+        if missing:
+            if create:
+                # сортировка задаёт одинаковый порядок блокировок уникального индекса для параллельных запросов
+                insert_query = (
+                    pg_insert(Tag)
+                    .values([{"name": name} for name in missing])
+                    .on_conflict_do_nothing(index_elements=["name"])
+                    .returning(Tag.name, Tag.id)
+                )
+                created = dict((await session.execute(insert_query)).tuples().all())
+            # теги, которые уже есть в базе, но ещё не попали в словарь
+            existing = [name for name in missing if name not in created]
+            if existing:
+                rows = await session.execute(select(Tag.name, Tag.id).where(Tag.name.in_(existing)))
+                self.ids.update(rows.tuples().all())
+
+        ids = {name: self.ids[name] for name in names if name in self.ids}
+        ids.update(created)
+        return ids, created
+
+    def remember(self, ids: Dict[str, int]) -> None:
+        self.ids.update(ids)
+
+    def clear(self) -> None:
+        self.ids.clear()
+
+
+tag_dictionary = TagDictionary()
+
+
+def escape_like(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+# ключ pg_try_advisory_xact_lock для пересчёта популярности тегов
+POPULARITY_LOCK = 0x74616773
+
+
+class TagSuggester:
+    """
+    Подсказки тегов по началу имени, ранжированные по популярности.
+
+    Префикс ищется по индексу lower(name) text_pattern_ops. Если совпадений по префиксу не хватает,
+    выдача дополняется нечёткими совпадениями по триграммам, когда в базе есть pg_trgm.
+
+    Популярность не обновляется при каждой записи user_tags: общие строки tags становились
+    узким местом /tags/set. Триггеры только добавляют id тегов в очередь tag_popularity_changes,
+    а пересчёт по очереди идёт в фоне и может отставать на tag_popularity_refresh_interval,
+    чего для порядка подсказок достаточно.
+    """
+
+    def __init__(self):
+        self.fuzzy = False
+
+    async def detect(self, session: AsyncSession) -> None:
+        query = text("SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm')")
+        self.fuzzy = bool(await session.scalar(query))
+
+    async def refresh_popularity(self, session: AsyncSession) -> int:
+        """
+        Пересчитывает популярность тегов из очереди и возвращает число изменённых строк.
+
+        Проход выполняет один процесс: остальные, не получив блокировку, пропускают его.
+        """
+        if not await session.scalar(select(func.pg_try_advisory_xact_lock(POPULARITY_LOCK))):
+            await session.rollback()
+            return 0
+        changed = (
+            delete(tag_popularity_changes)
+            .returning(tag_popularity_changes.c.tag_id)
+            .cte("changed")
+        )
+        users = select(func.count()).where(UserTag.tag_id == Tag.id).scalar_subquery()
+        result = await session.execute(
+            update(Tag)
+            .add_cte(changed)
+            .where(Tag.id.in_(select(changed.c.tag_id)), Tag.popularity != users)
+            .values(popularity=users)
+            .execution_options(synchronize_session=False)
+        )
+        await session.commit()
+        return result.rowcount
+
+    async def suggest(self, session: AsyncSession, q: str, limit: int) -> List[str]:
+        prefix_query = (
+            select(Tag.name)
+            .where(func.lower(Tag.name).like(escape_like(q.lower()) + "%", escape="\\"))
+            .order_by(Tag.popularity.desc(), Tag.name)
+            .limit(limit)
+        )
+        names = list((await session.execute(prefix_query)).scalars())
+        if len(names) == limit or not self.fuzzy or len(q) < cfg.tag_suggest_fuzzy_min_length:
+            return names
+
+        fuzzy_query = (
+            select(Tag.name)
+            .where(Tag.name.op("%")(q), Tag.name.notin_(names))
+            .order_by(func.similarity(Tag.name, q).desc(), Tag.popularity.desc())
+            .limit(limit - len(names))
+        )
+        names.extend((await session.execute(fuzzy_query)).scalars())
+        return names
+
+
+tag_suggester = TagSuggester()
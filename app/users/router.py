@@ -1,8 +1,14 @@
-from fastapi import APIRouter, Header, Depends, HTTPException
+from typing import Optional
 
-from app.database.connection.session import SessionLocal, get_session
+from fastapi import APIRouter, Header, Depends, HTTPException, Response
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database.connection.session import get_session
 from app.database.models.user import User
 from app.users.schema import RegisterRequest
+from app.cache.etag import etag_matches, not_modified
+from app.users.service import version_etag
 
 from app.users.schema import UserDto
 
@@ -13,10 +19,10 @@ router = APIRouter(prefix="/users", tags=["users"])
 async def register_user(
         register_request: RegisterRequest,
         user_id: int = Header(None, alias="x-user-id"),
-        session: SessionLocal = Depends(get_session)
+        session: AsyncSession = Depends(get_session)
 ):
     """Регистрация пользователя"""
-    existing_user = session.query(User).filter(User.id == user_id).first()
+    existing_user = (await session.execute(select(User).where(User.id == user_id))).scalars().first()
     if existing_user:
         raise HTTPException(status_code=400, detail="User already exists")
 
@@ -28,18 +34,25 @@ async def register_user(
     )
 
     session.add(new_user)
-    session.commit()
+    await session.commit()
 
 
 @router.get("/get", response_model=UserDto)
 async def get_user(
+        response: Response,
         user_id: int = Header(None, alias="x-user-id"),
-        session: SessionLocal = Depends(get_session)
+        if_none_match: Optional[str] = Header(None),
+        session: AsyncSession = Depends(get_session)
 ):
     """Получение информации о пользователе"""
-    user = session.query(User).filter(User.id == user_id).first()
+    user = (await session.execute(select(User).where(User.id == user_id))).scalars().first()
     if not user:
         raise HTTPException(status_code=400, detail="User is not found")
 
-    return UserDto.from_orm(user)
+    # строка пользователя уже прочитана целиком, поэтому кэш ответов здесь ничего не сэкономит
+    etag = version_etag(user_id, user.data_version)
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+    response.headers["ETag"] = etag
+    return UserDto.model_validate(user, from_attributes=True)
 
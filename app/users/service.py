@@ -0,0 +1,32 @@
+from fastapi import HTTPException
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database.models.user import User
+
+
+def version_etag(user_id: int, version: int) -> str:
+    return f'"{user_id}.{version}"'
+
+
+# возвращает версию данных пользователя; заодно проверяет его существование
+async def get_version(user_id: int, session: AsyncSession) -> int:
+    version = await session.scalar(select(User.data_version).where(User.id == user_id))
+    if version is None:
+        raise HTTPException(status_code=404, detail=f"User with id {user_id} not found")
+    return version
+
+
+# увеличивает версию данных пользователя в транзакции изменения; вызывается вместо проверки существования
+async def bump_version(user_id: int, session: AsyncSession) -> int:
+    bump_query = (
+        update(User)
+        .where(User.id == user_id)
+        .values(data_version=User.data_version + 1)
+        .returning(User.data_version)
+        .execution_options(synchronize_session=False)
+    )
+    version = await session.scalar(bump_query)
+    if version is None:
+        raise HTTPException(status_code=404, detail=f"User with id {user_id} not found")
+    return version
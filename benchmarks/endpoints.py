@@ -0,0 +1,334 @@
+"""
+Нагрузочный прогон всех маршрутов bookmarks, tags, users и files.
+
+Данные засеваются в настроенную базу для отдельного диапазона id пользователей, S3 заменяется
+клиентом в памяти, запросы идут в приложение через httpx без сети.
+
+Схема базы должна быть создана миграциями (make migration-up). Запуск из корня репозитория:
+    python -m benchmarks.endpoints --requests 300 --concurrency 8 --save benchmarks/baseline.json
+    python -m benchmarks.endpoints --compare benchmarks/baseline.json
+"""
+import argparse
+import asyncio
+import io
+import json
+import random
+import sys
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import httpx
+from sqlalchemy import delete, insert, select
+
+from app.cache.response import response_cache
+from app.database.connection.session import AsyncSessionLocal
+from app.database.models.bookmark import Bookmark, BookmarkInShelf, Shelf
+from app.database.models.tag import Tag, UserTag
+from app.database.models.user import User
+from app.files.router import staging_key
+from app.lifespan import lifespan
+from app.main import app
+from app.s3.minio import s3_service
+from benchmarks.s3 import InMemoryS3
+
+# диапазон id, который занимают данные прогона; пересоздаётся при каждом запуске
+FIRST_USER_ID = 900_000
+FIRST_BOOKMARK_ID = 900_000_000
+# пользователи, регистрируемые во время прогона
+FIRST_NEW_USER_ID = 990_000
+INSERT_CHUNK = 5000
+
+
+@dataclass
+class Seed:
+    users: List[int]
+    shelves: Dict[int, List[int]]
+    bookmarks: Dict[int, List[tuple]]
+    tags: List[str]
+    disposable_shelves: List[int] = field(default_factory=list)
+
+
+def make_image() -> bytes:
+    try:
+        from PIL import Image
+    except ImportError:
+        return b"\x89PNG\r\n\x1a\n" + bytes(256)
+    buffer = io.BytesIO()
+    Image.new("RGB", (256, 256), (200, 80, 40)).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+async def insert_chunked(session, table, rows: List[dict]) -> None:
+    for start in range(0, len(rows), INSERT_CHUNK):
+        await session.execute(insert(table), rows[start:start + INSERT_CHUNK])
+
+
+async def clear(session) -> None:
+    bench_users = User.id >= FIRST_USER_ID
+    bench_shelves = select(Shelf.id).where(Shelf.fk_user >= FIRST_USER_ID)
+    await session.execute(delete(BookmarkInShelf).where(BookmarkInShelf.fk_shelf.in_(bench_shelves)))
+    await session.execute(delete(Shelf).where(Shelf.fk_user >= FIRST_USER_ID))
+    await session.execute(delete(Bookmark).where(Bookmark.id >= FIRST_BOOKMARK_ID))
+    await session.execute(delete(UserTag).where(UserTag.user_id >= FIRST_USER_ID))
+    await session.execute(delete(User).where(bench_users))
+
+
+async def seed(args) -> Seed:
+    rng = random.Random(args.seed)
+    async with AsyncSessionLocal() as session:
+        await clear(session)
+        users = list(range(FIRST_USER_ID, FIRST_USER_ID + args.users))
+        await insert_chunked(session, User, [{"id": user_id, "login": f"bench{user_id}", "first_name": "Bench",
+                                              "last_name": "User"} for user_id in users])
+
+        # таблица тегов общая для всех пользователей: добавляются только отсутствующие
+        tags = [f"bench-tag-{i}" for i in range(args.tags)]
+        existing = set((await session.execute(select(Tag.name).where(Tag.name.in_(tags)))).scalars())
+        await insert_chunked(session, Tag, [{"name": name} for name in tags if name not in existing])
+        tag_ids = (await session.execute(select(Tag.id).where(Tag.name.in_(tags)))).scalars().all()
+
+        shelves, bookmarks = {}, {}
+        bookmark_id = FIRST_BOOKMARK_ID
+        for user_id in users:
+            shelf_ids = (await session.execute(
+                insert(Shelf).returning(Shelf.id, sort_by_parameter_order=True),
+                [{"fk_user": user_id, "name": f"Shelf {i}"} for i in range(args.shelves)],
+            )).scalars().all()
+            shelves[user_id] = list(shelf_ids)
+
+            links = []
+            for i in range(args.bookmarks):
+                links.append({"fk_shelf": rng.choice(shelf_ids), "fk_bookmark": bookmark_id + i,
+                              "title": f"Bookmark {i}"})
+            await insert_chunked(session, Bookmark, [{"id": bookmark_id + i} for i in range(args.bookmarks)])
+            await insert_chunked(session, BookmarkInShelf, links)
+            bookmarks[user_id] = [(link["fk_shelf"], link["fk_bookmark"]) for link in links]
+            bookmark_id += args.bookmarks
+
+            await insert_chunked(session, UserTag, [{"user_id": user_id, "tag_id": tag_id}
+                                                    for tag_id in rng.sample(tag_ids, min(args.user_tags,
+                                                                                          len(tag_ids)))])
+
+        disposable = (await session.execute(
+            insert(Shelf).returning(Shelf.id, sort_by_parameter_order=True),
+            [{"fk_user": users[0], "name": "Disposable"} for _ in range(args.requests + args.warmup)],
+        )).scalars().all()
+        await session.commit()
+    return Seed(users, shelves, bookmarks, tags, list(disposable))
+
+
+Request = Callable[[httpx.AsyncClient], Awaitable[httpx.Response]]
+
+
+def scenarios(state: Seed, rng: random.Random) -> Dict[str, Callable[[], Request]]:
+    """Для каждого маршрута — фабрика одного запроса со случайными, но реалистичными параметрами."""
+    image = make_image()
+    counters = {"user": FIRST_NEW_USER_ID, "bookmark": FIRST_BOOKMARK_ID + 100_000_000}
+
+    def user() -> int:
+        return rng.choice(state.users)
+
+    def headers(user_id: int) -> dict:
+        return {"x-user-id": str(user_id)}
+
+    def next_id(name: str) -> int:
+        counters[name] += 1
+        return counters[name]
+
+    def get(path: str, user_id: Optional[int] = None, **kwargs) -> Request:
+        return lambda client: client.get(path, headers=headers(user_id) if user_id else None, **kwargs)
+
+    def send(method: str, path: str, user_id: int, **kwargs) -> Request:
+        return lambda client: client.request(method, path, headers=headers(user_id), **kwargs)
+
+    def shelf_of(user_id: int) -> int:
+        return rng.choice(state.shelves[user_id])
+
+    def add_bookmark() -> Request:
+        user_id = user()
+        return send("POST", "/bookmarks/add_bookmark", user_id,
+                    json={"bookmark_id": next_id("bookmark"), "title": "New", "shelf_id": shelf_of(user_id)})
+
+    def add_bookmarks() -> Request:
+        user_id = user()
+        items = [{"bookmark_id": next_id("bookmark"), "title": "Batch", "shelf_id": shelf_of(user_id)}
+                 for _ in range(50)]
+        return send("POST", "/bookmarks/add_bookmarks", user_id, json={"bookmarks": items})
+
+    def delete_bookmark() -> Request:
+        user_id = user()
+        shelf_id, bookmark_id = rng.choice(state.bookmarks[user_id])
+        return send("POST", "/bookmarks/delete_bookmark_from_shelf", user_id,
+                    json={"bookmark_id": bookmark_id, "shelf_id": shelf_id})
+
+    def delete_shelf() -> Request:
+        return send("POST", "/bookmarks/delete_shelf", state.users[0],
+                    json={"shelf_id": state.disposable_shelves.pop()})
+
+    def tags_sample(size: int) -> List[str]:
+        return rng.sample(state.tags, min(size, len(state.tags)))
+
+    def register() -> Request:
+        user_id = next_id("user")
+        return send("POST", "/users/register", user_id,
+                    json={"login": f"bench{user_id}", "first_name": "New", "last_name": "User"})
+
+    def icon_upload() -> Request:
+        return send("POST", "/files/icon-upload", user(), files={"file": ("avatar.png", image, "image/png")})
+
+    def icon_upload_confirm() -> Request:
+        # прямая загрузка клиента в S3 — запись во временный ключ до начала замера
+        user_id = state.users[0]
+        upload_id = uuid.uuid4().hex
+        s3_service.put_object(staging_key(user_id, upload_id), image, "image/png")
+        return send("POST", "/files/icon-upload-confirm", user_id, json={"upload_id": upload_id})
+
+    return {
+        "bookmarks/get_only_shelves": lambda: get("/bookmarks/get_only_shelves", user()),
+        "bookmarks/get_shelves": lambda: get("/bookmarks/get_shelves", user()),
+        "bookmarks/get_bookmarks": lambda: (lambda user_id: get(
+            f"/bookmarks/get_bookmarks?shelf_id={shelf_of(user_id)}", user_id))(user()),
+        "bookmarks/create_shelf": lambda: send("POST", "/bookmarks/create_shelf", user(), json={"name": "New"}),
+        "bookmarks/add_bookmark": add_bookmark,
+        "bookmarks/add_bookmarks": add_bookmarks,
+        "bookmarks/delete_bookmark_from_shelf": delete_bookmark,
+        "bookmarks/delete_shelf": delete_shelf,
+        "tags/get": lambda: get("/tags/get", user()),
+        "tags/update": lambda: send("POST", "/tags/update", user(), json={"tags": tags_sample(5)}),
+        "tags/delete": lambda: send("POST", "/tags/delete", user(), json={"tags": tags_sample(5)}),
+        "tags/set": lambda: send("PUT", "/tags/set", user(), json={"tags": tags_sample(50)}),
+        "tags/suggest": lambda: get(f"/tags/suggest?q=bench-tag-{rng.randint(0, 99)}"),
+        "users/register": register,
+        "users/get": lambda: get("/users/get", user()),
+        "files/icon-upload": icon_upload,
+        "files/icon-upload-policy": lambda: send("POST", "/files/icon-upload-policy", user()),
+        "files/icon-upload-confirm": icon_upload_confirm,
+        "files/icon-get-link": lambda: get("/files/icon-get-link", state.users[0]),
+        "files/icon-get-links": lambda: send("POST", "/files/icon-get-links", user(),
+                                             json={"user_ids": state.users[:100], "size": 64}),
+        "files/icon": lambda: get(f"/files/icon/{state.users[0]}?size=64", follow_redirects=False),
+    }
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, round(q * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+async def run_endpoint(client: httpx.AsyncClient, factory: Callable[[], Request],
+                       requests: int, concurrency: int) -> dict:
+    latencies: List[float] = []
+    errors = 0
+    remaining = requests
+
+    async def worker():
+        nonlocal remaining, errors
+        while remaining > 0:
+            remaining -= 1
+            request = factory()
+            start = time.perf_counter()
+            response = await request(client)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code >= 500:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+    }
+
+
+def compare(results: Dict[str, dict], baseline: Dict[str, dict], tolerance: float) -> List[str]:
+    """Маршруты, у которых p95 вырос больше чем на tolerance относительно базовой линии."""
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None or not before["p95_ms"]:
+            continue
+        change = result["p95_ms"] / before["p95_ms"] - 1
+        print(f"{name:<40}{before['p95_ms']:>10.2f}{result['p95_ms']:>10.2f}{change:>+9.0%}")
+        if change > tolerance:
+            regressions.append(name)
+    return regressions
+
+
+async def main(args) -> int:
+    if not args.response_cache:
+        # по умолчанию меряется путь до базы, а не попадания в кэш ответов
+        response_cache.backend = None
+    s3_service.s3_client = InMemoryS3()
+
+    async with lifespan(app):
+        print(f"Seeding {args.users} users x {args.shelves} shelves, {args.bookmarks} bookmarks, "
+              f"{args.user_tags} of {args.tags} tags...", file=sys.stderr)
+        state = await seed(args)
+        rng = random.Random(args.seed)
+        factories = scenarios(state, rng)
+        selected = {name: factory for name, factory in factories.items()
+                    if not args.only or any(part in name for part in args.only)}
+
+        transport = httpx.ASGITransport(app=app)
+        results = {}
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            # первая аватарка нужна маршрутам чтения файлов
+            await factories["files/icon-upload"]()(client)
+            for name, factory in selected.items():
+                await run_endpoint(client, factory, args.warmup, args.concurrency)
+                results[name] = await run_endpoint(client, factory, args.requests, args.concurrency)
+                result = results[name]
+                print(f"{name:<40}{result['rps']:>9.0f}{result['p50_ms']:>9.2f}{result['p95_ms']:>9.2f}"
+                      f"{result['p99_ms']:>9.2f}{result['errors']:>7}")
+
+        async with AsyncSessionLocal() as session:
+            await clear(session)
+            await session.commit()
+
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump({"args": vars(args), "results": results}, file, indent=2)
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)["results"]
+        print(f"\n{'endpoint':<40}{'p95 was':>10}{'p95 now':>10}{'change':>9}")
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"p95 regressed by more than {args.tolerance:.0%}: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Latency and throughput of every endpoint")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--shelves", type=int, default=300, help="полок на пользователя")
+    parser.add_argument("--bookmarks", type=int, default=5000, help="закладок на пользователя")
+    parser.add_argument("--tags", type=int, default=5000, help="размер словаря тегов")
+    parser.add_argument("--user-tags", type=int, default=1000, help="тегов на пользователя")
+    parser.add_argument("--requests", type=int, default=300, help="запросов на маршрут")
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--only", nargs="*", help="подстроки имён маршрутов")
+    parser.add_argument("--response-cache", action="store_true", help="не отключать кэш ответов")
+    parser.add_argument("--save", help="сохранить результаты как базовую линию")
+    parser.add_argument("--compare", help="сравнить p95 с базовой линией")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="допустимый рост p95")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    print(f"{'endpoint':<40}{'rps':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'errors':>7}")
+    sys.exit(asyncio.run(main(arguments)))
@@ -0,0 +1,94 @@
+import hashlib
+import io
+import threading
+import uuid
+from typing import Dict
+
+from botocore.exceptions import ClientError
+
+
+def _not_found(operation: str) -> ClientError:
+    return ClientError({"Error": {"Code": "404", "Message": "Not Found"}}, operation)
+
+
+class InMemoryS3:
+    """Замена клиента boto3 в памяти процесса с методами, которые вызывает S3Service."""
+
+    def __init__(self):
+        self.buckets = set()
+        self.objects: Dict[str, dict] = {}
+        self.uploads: Dict[str, dict] = {}
+        self.lifecycle: Dict[str, list] = {}
+        self._lock = threading.Lock()
+
+    def head_bucket(self, Bucket):
+        if Bucket not in self.buckets:
+            raise _not_found("HeadBucket")
+
+    def create_bucket(self, Bucket):
+        self.buckets.add(Bucket)
+
+    def put_object(self, Bucket, Key, Body, ContentType="binary/octet-stream"):
+        body = Body if isinstance(Body, bytes) else Body.read()
+        etag = f'"{hashlib.md5(body).hexdigest()}"'
+        with self._lock:
+            self.objects[Key] = {"Body": body, "ContentType": ContentType, "ETag": etag}
+        return {"ETag": etag}
+
+    def get_bucket_lifecycle_configuration(self, Bucket):
+        if Bucket not in self.lifecycle:
+            raise ClientError({"Error": {"Code": "NoSuchLifecycleConfiguration"}}, "GetBucketLifecycleConfiguration")
+        return {"Rules": list(self.lifecycle[Bucket])}
+
+    def put_bucket_lifecycle_configuration(self, Bucket, LifecycleConfiguration):
+        self.lifecycle[Bucket] = list(LifecycleConfiguration["Rules"])
+
+    def copy_object(self, Bucket, Key, CopySource, ContentType, MetadataDirective):
+        item = self.objects.get(CopySource["Key"])
+        if item is None:
+            raise _not_found("CopyObject")
+        with self._lock:
+            self.objects[Key] = {**item, "ContentType": ContentType}
+        return {"CopyObjectResult": {"ETag": item["ETag"]}}
+
+    def create_multipart_upload(self, Bucket, Key, ContentType):
+        upload_id = uuid.uuid4().hex
+        self.uploads[upload_id] = {"Key": Key, "ContentType": ContentType, "Parts": {}}
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.uploads[UploadId]["Parts"][PartNumber] = Body
+        return {"ETag": f'"{hashlib.md5(Body).hexdigest()}"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        upload = self.uploads.pop(UploadId)
+        body = b"".join(upload["Parts"][part["PartNumber"]] for part in MultipartUpload["Parts"])
+        return self.put_object(Bucket, Key, body, upload["ContentType"])
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.uploads.pop(UploadId, None)
+
+    def head_object(self, Bucket, Key):
+        item = self.objects.get(Key)
+        if item is None:
+            raise _not_found("HeadObject")
+        return {"ContentLength": len(item["Body"]), "ContentType": item["ContentType"], "ETag": item["ETag"]}
+
+    def get_object(self, Bucket, Key, Range=None):
+        item = self.objects.get(Key)
+        if item is None:
+            raise _not_found("GetObject")
+        body = item["Body"]
+        if Range is not None:
+            start, end = Range.removeprefix("bytes=").split("-")
+            body = body[int(start):int(end) + 1]
+        return {"Body": io.BytesIO(body), "ContentType": item["ContentType"], "ETag": item["ETag"]}
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop(Key, None)
+
+    def generate_presigned_url(self, ClientMethod, Params, ExpiresIn):
+        return f"http://s3.local/{Params['Bucket']}/{Params['Key']}?expires={ExpiresIn}"
+
+    def generate_presigned_post(self, Bucket, Key, Fields=None, Conditions=None, ExpiresIn=3600):
+        return {"url": f"http://s3.local/{Bucket}", "fields": {"key": Key, **(Fields or {})}}
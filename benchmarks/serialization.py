@@ -0,0 +1,90 @@
+"""
+Сравнение сериализации ответов /bookmarks/get_shelves и /bookmarks/get_bookmarks до и после типизированных моделей.
+
+Запуск из корня репозитория: python -m benchmarks.serialization --rows 10000
+"""
+import argparse
+import json
+import timeit
+from collections import namedtuple
+from typing import List, Optional
+
+from fastapi.encoders import jsonable_encoder
+from pydantic import BaseModel, TypeAdapter
+
+from app.bookmarks.schema import ReturnBookmarks, ReturnShelves
+
+# строки результата запроса: namedtuple даёт тот же доступ к полям, что и Row из SQLAlchemy
+ShelfRow = namedtuple("ShelfRow", ["id", "name", "bookmarks"])
+LateralRow = namedtuple("LateralRow", ["id", "name", "title"])
+BookmarkRow = namedtuple("BookmarkRow", ["id", "title"])
+
+
+class UntypedShelves(BaseModel):
+    shelves: List[dict]
+    next_cursor: Optional[str] = None
+
+
+class UntypedBookmarks(BaseModel):
+    bookmarks: List[dict]
+    next_cursor: Optional[str] = None
+
+
+def render_untyped(model, content) -> bytes:
+    # путь до изменений: проверка dict, jsonable_encoder и json.dumps, как в JSONResponse
+    data = jsonable_encoder(model.model_validate(content))
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def render_typed(adapter: TypeAdapter, content) -> bytes:
+    # путь после: проверка строк по типизированной модели и сериализация в JSON в pydantic-core
+    return adapter.dump_json(adapter.validate_python(content, from_attributes=True))
+
+
+def shelves_before(rows: List[LateralRow]) -> bytes:
+    response_list = []
+    for shelf in rows:
+        if not response_list or response_list[-1]["id"] != shelf.id:
+            response_list.append({"id": shelf.id, "name": shelf.name, "bookmarks": []})
+        if shelf.title is not None:
+            response_list[-1]["bookmarks"].append(shelf.title)
+    return render_untyped(UntypedShelves, {"shelves": response_list, "next_cursor": None})
+
+
+def bookmarks_before(rows: List[BookmarkRow]) -> bytes:
+    bookmark_list = []
+    for element in rows:
+        bookmark_list.append({"id": element.id, "title": element.title})
+    return render_untyped(UntypedBookmarks, {"bookmarks": bookmark_list, "next_cursor": None})
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=10000, help="полок и закладок в ответе")
+    parser.add_argument("--preview", type=int, default=3, help="закладок в превью полки")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    titles = [f"Bookmark title {i}" for i in range(args.preview)]
+    lateral_rows = [LateralRow(i, f"Shelf {i}", title) for i in range(args.rows) for title in titles]
+    shelf_rows = [ShelfRow(i, f"Shelf {i}", titles) for i in range(args.rows)]
+    bookmark_rows = [BookmarkRow(i, f"Bookmark title {i}") for i in range(args.rows)]
+    shelves_adapter = TypeAdapter(ReturnShelves)
+    bookmarks_adapter = TypeAdapter(ReturnBookmarks)
+
+    cases = {
+        "get_shelves": (lambda: shelves_before(lateral_rows),
+                        lambda: render_typed(shelves_adapter, {"shelves": shelf_rows, "next_cursor": None})),
+        "get_bookmarks": (lambda: bookmarks_before(bookmark_rows),
+                          lambda: render_typed(bookmarks_adapter, {"bookmarks": bookmark_rows, "next_cursor": None})),
+    }
+    print(f"{'endpoint':<15}{'before, ms':>12}{'after, ms':>12}{'speedup':>10}")
+    for name, (before, after) in cases.items():
+        assert json.loads(before()) == json.loads(after())
+        before_ms = min(timeit.repeat(before, number=1, repeat=args.repeat)) * 1000
+        after_ms = min(timeit.repeat(after, number=1, repeat=args.repeat)) * 1000
+        print(f"{name:<15}{before_ms:>12.2f}{after_ms:>12.2f}{before_ms / after_ms:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
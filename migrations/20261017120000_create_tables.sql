@@ -0,0 +1,47 @@
+-- +goose Up
+CREATE SCHEMA IF NOT EXISTS personal_account;
+
+CREATE TABLE IF NOT EXISTS personal_account.users (
+    id         SERIAL PRIMARY KEY,
+    login      VARCHAR,
+    first_name VARCHAR,
+    last_name  VARCHAR,
+    created_at TIMESTAMP WITH TIME ZONE NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS personal_account.tags (
+    id   SERIAL PRIMARY KEY,
+    name VARCHAR NOT NULL UNIQUE
+);
+
+CREATE TABLE IF NOT EXISTS personal_account.user_tags (
+    user_id    INTEGER NOT NULL REFERENCES personal_account.users (id),
+    tag_id     INTEGER NOT NULL REFERENCES personal_account.tags (id),
+    created_at TIMESTAMP WITH TIME ZONE NOT NULL,
+    PRIMARY KEY (user_id, tag_id)
+);
+
+CREATE TABLE IF NOT EXISTS personal_account.shelf (
+    id      SERIAL PRIMARY KEY,
+    fk_user INTEGER NOT NULL REFERENCES personal_account.users (id),
+    name    VARCHAR
+);
+
+CREATE TABLE IF NOT EXISTS personal_account.bookmarks (
+    id SERIAL PRIMARY KEY
+);
+
+CREATE TABLE IF NOT EXISTS personal_account.bookmarks_inshelf (
+    title       VARCHAR NOT NULL,
+    fk_shelf    INTEGER NOT NULL REFERENCES personal_account.shelf (id),
+    fk_bookmark INTEGER NOT NULL REFERENCES personal_account.bookmarks (id),
+    PRIMARY KEY (fk_shelf, fk_bookmark)
+);
+
+-- +goose Down
+DROP TABLE IF EXISTS personal_account.bookmarks_inshelf;
+DROP TABLE IF EXISTS personal_account.bookmarks;
+DROP TABLE IF EXISTS personal_account.shelf;
+DROP TABLE IF EXISTS personal_account.user_tags;
+DROP TABLE IF EXISTS personal_account.tags;
+DROP TABLE IF EXISTS personal_account.users;
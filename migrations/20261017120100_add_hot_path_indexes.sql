@@ -0,0 +1,18 @@
+-- +goose NO TRANSACTION
+-- +goose Up
+-- полки пользователя в порядке id: get_only_shelves, get_shelves, export
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_shelf_fk_user_id
+    ON personal_account.shelf (fk_user, id);
+
+-- поиск полок, содержащих закладку
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_bookmarks_inshelf_fk_bookmark
+    ON personal_account.bookmarks_inshelf (fk_bookmark);
+
+-- пользователи тега: удаление тегов и проверки внешнего ключа
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_user_tags_tag_id
+    ON personal_account.user_tags (tag_id);
+
+-- +goose Down
+DROP INDEX CONCURRENTLY IF EXISTS personal_account.ix_user_tags_tag_id;
+DROP INDEX CONCURRENTLY IF EXISTS personal_account.ix_bookmarks_inshelf_fk_bookmark;
+DROP INDEX CONCURRENTLY IF EXISTS personal_account.ix_shelf_fk_user_id;
@@ -0,0 +1,5 @@
+-- +goose Up
+ALTER TABLE personal_account.users ADD COLUMN IF NOT EXISTS avatar_hash VARCHAR(64);
+
+-- +goose Down
+ALTER TABLE personal_account.users DROP COLUMN IF EXISTS avatar_hash;
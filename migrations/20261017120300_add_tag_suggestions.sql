@@ -0,0 +1,64 @@
+-- +goose NO TRANSACTION
+-- +goose Up
+ALTER TABLE personal_account.tags ADD COLUMN IF NOT EXISTS popularity INTEGER NOT NULL DEFAULT 0;
+
+-- теги, чьи пользователи изменились с прошлого пересчёта популярности (TagSuggester.refresh_popularity);
+-- только вставки без уникального ключа: запись user_tags не блокирует общие строки
+CREATE TABLE IF NOT EXISTS personal_account.tag_popularity_changes (
+    tag_id INTEGER NOT NULL
+);
+
+-- +goose StatementBegin
+CREATE OR REPLACE FUNCTION personal_account.user_tags_changed() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO personal_account.tag_popularity_changes (tag_id)
+    SELECT DISTINCT tag_id FROM changed;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+-- +goose StatementEnd
+
+DROP TRIGGER IF EXISTS user_tags_changed_insert ON personal_account.user_tags;
+CREATE TRIGGER user_tags_changed_insert
+    AFTER INSERT ON personal_account.user_tags
+    REFERENCING NEW TABLE AS changed
+    FOR EACH STATEMENT EXECUTE FUNCTION personal_account.user_tags_changed();
+
+DROP TRIGGER IF EXISTS user_tags_changed_delete ON personal_account.user_tags;
+CREATE TRIGGER user_tags_changed_delete
+    AFTER DELETE ON personal_account.user_tags
+    REFERENCING OLD TABLE AS changed
+    FOR EACH STATEMENT EXECUTE FUNCTION personal_account.user_tags_changed();
+
+-- начальный подсчёт после триггеров: изменения во время подсчёта попадут в очередь
+UPDATE personal_account.tags AS t
+SET popularity = counts.users
+FROM (SELECT tag_id, count(*) AS users FROM personal_account.user_tags GROUP BY tag_id) AS counts
+WHERE counts.tag_id = t.id;
+
+-- подсказки по префиксу: lower(name) LIKE 'abc%'
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_tags_name_prefix
+    ON personal_account.tags (lower(name) text_pattern_ops);
+
+-- нечёткие подсказки: name % 'abc'; pg_trgm необязателен (TagSuggester.detect),
+-- поэтому без contrib миграция проходит, а подсказки остаются префиксными
+-- +goose StatementBegin
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm') THEN
+        CREATE EXTENSION IF NOT EXISTS pg_trgm;
+        CREATE INDEX IF NOT EXISTS ix_tags_name_trgm
+            ON personal_account.tags USING gin (name gin_trgm_ops);
+    END IF;
+END
+$$;
+-- +goose StatementEnd
+
+-- +goose Down
+DROP INDEX CONCURRENTLY IF EXISTS personal_account.ix_tags_name_trgm;
+DROP INDEX CONCURRENTLY IF EXISTS personal_account.ix_tags_name_prefix;
+DROP TRIGGER IF EXISTS user_tags_changed_delete ON personal_account.user_tags;
+DROP TRIGGER IF EXISTS user_tags_changed_insert ON personal_account.user_tags;
+DROP FUNCTION IF EXISTS personal_account.user_tags_changed();
+DROP TABLE IF EXISTS personal_account.tag_popularity_changes;
+ALTER TABLE personal_account.tags DROP COLUMN IF EXISTS popularity;
@@ -0,0 +1,5 @@
+-- +goose Up
+ALTER TABLE personal_account.users ADD COLUMN IF NOT EXISTS data_version BIGINT NOT NULL DEFAULT 0;
+
+-- +goose Down
+ALTER TABLE personal_account.users DROP COLUMN IF EXISTS data_version;
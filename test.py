@@ -1,6 +1,13 @@
+import asyncio
+import io
+import json
+from contextlib import contextmanager
+from pathlib import Path
+from datetime import datetime, timezone
+
 import pytest
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, func, insert, select, text
 from sqlalchemy.orm import sessionmaker
 from unittest.mock import MagicMock
 from app.main import app
@@ -8,9 +15,18 @@ from app.database.models.base import Base
 from app.database.models.user import User
 from app.database.models.tag import Tag, UserTag
 from app.database.models.bookmark import Shelf, Bookmark, BookmarkInShelf
-from app.database.connection.session import get_session
+from app.database.connection.session import AsyncSessionLocal, get_session, async_engine
 from app.s3.minio import S3Service, get_s3
+from app.cache.etag import etag_matches
+from app.cache.response import LocalBackend, RedisBackend, response_cache
+from app.cache.ttl import TTLCache
+from app.database.explain import find_seq_scans
+from app.tags.service import POPULARITY_LOCK, tag_dictionary, tag_suggester
 from app.config import cfg
+from app.lifespan import with_retries
+from app.monitoring.metrics import Histogram
+from app.database.slow_query import rate_limiter, redact
+from app.files.avatars import process_avatar, render_variants, variant_key, wait_avatar_tasks
 from botocore.exceptions import ClientError
 
 # Использовать URL базы данных из конфигурации
@@ -18,12 +34,46 @@ DATABASE_URL = cfg.build_postgres_dsn
 engine = create_engine(DATABASE_URL)
 TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+MIGRATIONS = Path(__file__).parent / "migrations"
+
+def migration_statements(path):
+    """Запросы секции Up миграции goose; блок StatementBegin/StatementEnd — один запрос."""
+    statements, current, in_block, up = [], [], False, False
+    for line in path.read_text(encoding="utf-8").splitlines():
+        directive = line.strip()
+        if directive.startswith("-- +goose"):
+            if directive == "-- +goose Down":
+                break
+            up = up or directive == "-- +goose Up"
+            if directive == "-- +goose StatementBegin":
+                in_block = True
+            elif directive == "-- +goose StatementEnd":
+                in_block = False
+                statements.append("\n".join(current))
+                current = []
+            continue
+        # комментарии не отправляются: кодировка клиента тестовой базы может быть ASCII
+        if not up or directive.startswith("--"):
+            continue
+        current.append(line)
+        if not in_block and directive.endswith(";"):
+            statements.append("\n".join(current))
+            current = []
+    return statements
+
 @pytest.fixture(scope="module")
 def setup_database():
-    """Инициализация схемы базы данных перед тестами."""
-    Base.metadata.create_all(bind=engine)
+    """Схема базы данных создаётся теми же миграциями, что и в окружении (make migration-up)."""
+    with engine.begin() as connection:
+        connection.execute(text("DROP SCHEMA IF EXISTS personal_account CASCADE"))
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        # CREATE INDEX CONCURRENTLY нельзя выполнять в транзакции
+        for path in sorted(MIGRATIONS.glob("*.sql")):
+            for statement in migration_statements(path):
+                connection.exec_driver_sql(statement)
     yield
-    Base.metadata.drop_all(bind=engine)
+    with engine.begin() as connection:
+        connection.execute(text("DROP SCHEMA personal_account CASCADE"))
 
 @pytest.fixture()
 def db_session(setup_database):
@@ -34,6 +84,8 @@ def db_session(setup_database):
         for table in reversed(Base.metadata.sorted_tables):
             session.execute(table.delete())
         session.commit()
+        tag_dictionary.clear()
+        response_cache.clear()
         yield session
     finally:
         session.close()
@@ -41,7 +93,35 @@ def db_session(setup_database):
 @pytest.fixture()
 def client():
     """Клиент для тестирования."""
-    return TestClient(app)
+    # lifespan закрывает пул, соединения которого привязаны к циклу событий клиента
+    with TestClient(app) as test_client:
+        yield test_client
+
+@pytest.fixture()
+def query_budget():
+    """
+    Бюджет запросов к базе: with query_budget(3) требует ровно три запроса внутри блока,
+    with query_budget(most=3) — не больше трёх. Лишние обращения к базе (N+1) роняют тест.
+    """
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    @contextmanager
+    def check(exact=None, *, most=None):
+        start = len(statements)
+        yield
+        executed = statements[start:]
+        details = "\n".join(executed)
+        if exact is not None:
+            assert len(executed) == exact, f"expected {exact} queries, got {len(executed)}:\n{details}"
+        if most is not None:
+            assert len(executed) <= most, f"expected at most {most} queries, got {len(executed)}:\n{details}"
+
+    event.listen(async_engine.sync_engine, "before_cursor_execute", count)
+    yield check
+    event.remove(async_engine.sync_engine, "before_cursor_execute", count)
 
 @pytest.fixture
 def test_user(db_session):
@@ -75,26 +155,54 @@ def test_tags(db_session):
     db_session.commit()
     return tags
 
+# Тесты для запуска приложения
+
+def test_with_retries_recovers(monkeypatch):
+    monkeypatch.setattr(cfg, "startup_retry_delay", 0)
+    attempts = []
+
+    async def flaky():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise ConnectionError("not ready")
+
+    asyncio.run(with_retries("flaky", flaky))
+    assert len(attempts) == 3
+
+def test_with_retries_gives_up(monkeypatch):
+    monkeypatch.setattr(cfg, "startup_retry_delay", 0)
+    monkeypatch.setattr(cfg, "startup_retries", 2)
+
+    async def broken():
+        raise ConnectionError("down")
+
+    with pytest.raises(ConnectionError):
+        asyncio.run(with_retries("broken", broken))
+
 # Тесты для подключения к сессии
 def test_get_session(db_session):
-    session_generator = get_session()
-    session = next(session_generator)
-    assert session is not None
-    session.close()
+    async def open_session():
+        session_generator = get_session()
+        session = await session_generator.__anext__()
+        assert session is not None
+        await session_generator.aclose()
+
+    asyncio.run(open_session())
 
 # Тесты для users
 
-def test_register_user_success(client, db_session):
+def test_register_user_success(client, db_session, query_budget):
     user_id = 1
-    response = client.post(
-        "/users/register",
-        headers={"x-user-id": str(user_id)},
-        json={
-            "login": "testuser",
-            "first_name": "Test",
-            "last_name": "User"
-        }
-    )
+    with query_budget(2):
+        response = client.post(
+            "/users/register",
+            headers={"x-user-id": str(user_id)},
+            json={
+                "login": "testuser",
+                "first_name": "Test",
+                "last_name": "User"
+            }
+        )
     assert response.status_code == 200
 
     user = db_session.query(User).filter_by(id=user_id).first()
@@ -126,15 +234,16 @@ def test_register_user_exists(client, db_session):
     assert response.status_code == 400
     assert response.json()["detail"] == "User already exists"
 
-def test_get_user_success(client, db_session):
+def test_get_user_success(client, db_session, query_budget):
     user = User(id=2, login="getuser", first_name="Get", last_name="User")
     db_session.add(user)
     db_session.commit()
 
-    response = client.get(
-        "/users/get",
-        headers={"x-user-id": str(user.id)}
-    )
+    with query_budget(1):
+        response = client.get(
+            "/users/get",
+            headers={"x-user-id": str(user.id)}
+        )
     assert response.status_code == 200
     assert response.json() == {
         "login": "getuser",
@@ -142,6 +251,51 @@ def test_get_user_success(client, db_session):
         "last_name": "User"
     }
 
+def test_data_version_etag(client, db_session, test_user):
+    """Изменения пользователя увеличивают версию, чтение отвечает 304 на неизменившуюся версию."""
+    headers = {"x-user-id": str(test_user.id)}
+    response = client.get("/tags/get", headers=headers)
+    assert response.status_code == 404
+
+    client.post("/tags/update", json={"tags": ["tag1"]}, headers=headers)
+    response = client.get("/tags/get", headers=headers)
+    etag = response.headers["etag"]
+    assert etag == f'"{test_user.id}.1"'
+
+    response = client.get("/tags/get", headers={**headers, "If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["etag"] == etag
+
+    # версия одна на пользователя: запись полки обновляет и ETag тегов
+    client.post("/bookmarks/create_shelf", json={"name": "Shelf"}, headers=headers)
+    response = client.get("/tags/get", headers={**headers, "If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] == f'"{test_user.id}.2"'
+    response = client.get("/bookmarks/get_only_shelves", headers={**headers, "If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] == f'"{test_user.id}.2"'
+    db_session.refresh(test_user)
+    assert test_user.data_version == 2
+
+def test_data_version_etag_uncached(client, db_session, test_user, test_shelf):
+    headers = {"x-user-id": str(test_user.id)}
+    response = client.get(f"/bookmarks/get_bookmarks?shelf_id={test_shelf.id}", headers=headers)
+    etag = response.headers["etag"]
+    response = client.get(f"/bookmarks/get_bookmarks?shelf_id={test_shelf.id}",
+                          headers={**headers, "If-None-Match": etag})
+    assert response.status_code == 304
+
+    response = client.get("/account/export", headers={**headers, "If-None-Match": etag})
+    assert response.status_code == 304
+
+    response = client.get("/users/get", headers={**headers, "If-None-Match": etag})
+    assert response.status_code == 304
+
+def test_bump_version_user_not_found(client, db_session):
+    response = client.post("/bookmarks/create_shelf", json={"name": "Shelf"}, headers={"x-user-id": "999"})
+    assert response.status_code == 404
+    assert response.json()["detail"] == "User with id 999 not found"
+
 def test_get_user_not_found(client, db_session):
     response = client.get(
         "/users/get",
@@ -152,13 +306,14 @@ def test_get_user_not_found(client, db_session):
 
 # Тесты для bookmarks
 
-def test_get_only_shelves_success(client, db_session, test_user, test_shelf):
+def test_get_only_shelves_success(client, db_session, test_user, test_shelf, query_budget):
     """Тест успешного получения только идентификаторов полок."""
     headers = {"x-user-id": str(test_user.id)}
-    response = client.get("/bookmarks/get_only_shelves", headers=headers)
+    with query_budget(2):
+        response = client.get("/bookmarks/get_only_shelves", headers=headers)
 
     assert response.status_code == 200
-    assert response.json() == {"id": [test_shelf.id]}
+    assert response.json() == {"id": [test_shelf.id], "next_cursor": None}
 
 
 def test_get_only_shelves_empty(client, test_user):
@@ -167,7 +322,7 @@ def test_get_only_shelves_empty(client, test_user):
     response = client.get("/bookmarks/get_only_shelves", headers=headers)
 
     assert response.status_code == 200
-    assert response.json() == {"id": []}
+    assert response.json() == {"id": [], "next_cursor": None}
 
 def test_get_shelves_success(client, db_session, test_user, test_shelf, test_bookmark):
     """Тест успешного получения списка полок."""
@@ -185,7 +340,8 @@ def test_get_shelves_success(client, db_session, test_user, test_shelf, test_boo
                 "name": test_shelf.name,
                 "bookmarks": [test_bookmark.title],
             }
-        ]
+        ],
+        "next_cursor": None,
     }
 
 def test_get_shelves_empty(client, test_user):
@@ -194,7 +350,31 @@ def test_get_shelves_empty(client, test_user):
     response = client.get("/bookmarks/get_shelves", headers=headers)
 
     assert response.status_code == 200
-    assert response.json() == {"shelves": []}
+    assert response.json() == {"shelves": [], "next_cursor": None}
+
+def test_get_shelves_preview_limited(client, db_session, test_user, test_shelf, query_budget):
+    """Превью полки ограничено первыми закладками, пустые полки возвращаются."""
+    empty_shelf = Shelf(id=2, name="Empty Shelf", fk_user=test_user.id)
+    db_session.add(empty_shelf)
+    db_session.add_all([Bookmark(id=i) for i in range(1, 6)])
+    db_session.commit()
+    db_session.add_all([BookmarkInShelf(fk_shelf=test_shelf.id, fk_bookmark=i, title=f"Bookmark {i}")
+                        for i in range(5, 0, -1)])
+    db_session.commit()
+
+    headers = {"x-user-id": str(test_user.id)}
+    with query_budget(2):
+        response = client.get("/bookmarks/get_shelves", headers=headers)
+
+    assert response.status_code == 200
+    assert response.json() == {
+        "shelves": [
+            {"id": test_shelf.id, "name": test_shelf.name,
+             "bookmarks": ["Bookmark 1", "Bookmark 2", "Bookmark 3"]},
+            {"id": empty_shelf.id, "name": empty_shelf.name, "bookmarks": []},
+        ],
+        "next_cursor": None,
+    }
 
 def test_get_bookmarks_success(client, db_session, test_user, test_shelf, test_bookmark):
     """Тест успешного получения закладок с полки."""
@@ -205,24 +385,93 @@ def test_get_bookmarks_success(client, db_session, test_user, test_shelf, test_b
     response = client.get(f"/bookmarks/get_bookmarks?shelf_id={test_shelf.id}", headers=headers)
 
     assert response.status_code == 200
-    assert response.json() == {"bookmarks": [{"id": test_bookmark.id, "title": test_bookmark.title}]}
+    assert response.json() == {"bookmarks": [{"id": test_bookmark.id, "title": test_bookmark.title}],
+                               "next_cursor": None}
 
 
-def test_get_bookmarks_empty(client, test_user, test_shelf):
+def test_get_bookmarks_empty(client, test_user, test_shelf, query_budget):
     """Тест получения пустого списка закладок."""
     headers = {"x-user-id": str(test_user.id)}
-    response = client.get(f"/bookmarks/get_bookmarks?shelf_id={test_shelf.id}", headers=headers)
+    with query_budget(2):
+        response = client.get(f"/bookmarks/get_bookmarks?shelf_id={test_shelf.id}", headers=headers)
 
     assert response.status_code == 200
-    assert response.json() == {"bookmarks": []}
+    assert response.json() == {"bookmarks": [], "next_cursor": None}
 
 
-def test_create_shelf_success(client, test_user):
+def test_get_bookmarks_foreign_shelf(client, db_session, test_user, test_shelf):
+    """Чужая или несуществующая полка не читается и не получает 304 по ETag читающего."""
+    other = User(id=2, login="other", first_name="Other", last_name="User")
+    db_session.add_all([other, Bookmark(id=1)])
+    db_session.commit()
+    db_session.add(BookmarkInShelf(fk_shelf=test_shelf.id, fk_bookmark=1, title="Private"))
+    db_session.commit()
+
+    headers = {"x-user-id": str(other.id), "If-None-Match": f'"{other.id}.0"'}
+    for shelf_id in (test_shelf.id, 999):
+        response = client.get(f"/bookmarks/get_bookmarks?shelf_id={shelf_id}", headers=headers)
+        assert response.status_code == 404
+        assert response.json()["detail"] == "Shelf not found"
+
+    response = client.get(f"/bookmarks/get_bookmarks?shelf_id={test_shelf.id}", headers={"x-user-id": "999"})
+    assert response.status_code == 404
+    assert response.json()["detail"] == "User with id 999 not found"
+
+def test_get_bookmarks_paginated(client, db_session, test_user, test_shelf):
+    """Курсор продолжает выдачу после удаления и добавления закладок."""
+    db_session.add_all([Bookmark(id=i) for i in range(1, 7)])
+    db_session.commit()
+    db_session.add_all([BookmarkInShelf(fk_shelf=test_shelf.id, fk_bookmark=i, title=f"Bookmark {i}")
+                        for i in range(1, 6)])
+    db_session.commit()
+
+    headers = {"x-user-id": str(test_user.id)}
+    url = f"/bookmarks/get_bookmarks?shelf_id={test_shelf.id}&limit=2"
+    first = client.get(url, headers=headers).json()
+    assert [b["id"] for b in first["bookmarks"]] == [1, 2]
+    assert first["next_cursor"] is not None
+
+    db_session.query(BookmarkInShelf).filter_by(fk_bookmark=1).delete()
+    db_session.add(BookmarkInShelf(fk_shelf=test_shelf.id, fk_bookmark=6, title="Bookmark 6"))
+    db_session.commit()
+
+    second = client.get(f"{url}&cursor={first['next_cursor']}", headers=headers).json()
+    assert [b["id"] for b in second["bookmarks"]] == [3, 4]
+    third = client.get(f"{url}&cursor={second['next_cursor']}", headers=headers).json()
+    assert [b["id"] for b in third["bookmarks"]] == [5, 6]
+    assert third["next_cursor"] is None
+
+
+def test_get_only_shelves_paginated(client, db_session, test_user):
+    db_session.add_all([Shelf(id=i, name=f"Shelf {i}", fk_user=test_user.id) for i in range(1, 4)])
+    db_session.commit()
+
+    headers = {"x-user-id": str(test_user.id)}
+    first = client.get("/bookmarks/get_only_shelves?limit=2", headers=headers).json()
+    assert first["id"] == [1, 2]
+    second = client.get(f"/bookmarks/get_only_shelves?limit=2&cursor={first['next_cursor']}",
+                        headers=headers).json()
+    assert second == {"id": [3], "next_cursor": None}
+
+    shelves = client.get("/bookmarks/get_shelves?limit=2", headers=headers).json()
+    assert [shelf["id"] for shelf in shelves["shelves"]] == [1, 2]
+    assert shelves["next_cursor"] == first["next_cursor"]
+
+
+def test_get_only_shelves_invalid_cursor(client, test_user):
+    headers = {"x-user-id": str(test_user.id)}
+    response = client.get("/bookmarks/get_only_shelves?cursor=not-a-cursor", headers=headers)
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Invalid cursor"
+
+
+def test_create_shelf_success(client, test_user, query_budget):
     """Тест успешного создания полки."""
     headers = {"x-user-id": str(test_user.id)}
     payload = {"name": "New Shelf"}
 
-    response = client.post("/bookmarks/create_shelf", json=payload, headers=headers)
+    with query_budget(2):
+        response = client.post("/bookmarks/create_shelf", json=payload, headers=headers)
     assert response.status_code == 200
     assert response.json()["message"] == "Shelf successfully created"
 
@@ -234,7 +483,7 @@ def test_create_shelf_user_not_found(client):
     assert response.status_code == 404
     assert response.json()["detail"] == "User with id 999 not found"
 
-def test_add_bookmark_success(client, test_user, test_shelf):
+def test_add_bookmark_success(client, test_user, test_shelf, query_budget):
     """Тест успешного добавления закладки."""
     headers = {"x-user-id": str(test_user.id)}
     payload = {
@@ -243,11 +492,54 @@ def test_add_bookmark_success(client, test_user, test_shelf):
         "shelf_id": test_shelf.id,
     }
 
-    response = client.post("/bookmarks/add_bookmark", json=payload, headers=headers)
+    with query_budget(4):
+        response = client.post("/bookmarks/add_bookmark", json=payload, headers=headers)
     assert response.status_code == 200
     assert response.json()["message"] == "Bookmark successfully added"
 
 
+def test_add_bookmark_foreign_shelf(client, db_session, test_user, test_shelf, query_budget):
+    """Закладка не добавляется на чужую или несуществующую полку, дальше проверки запросы не идут."""
+    db_session.add(User(id=2, login="other", first_name="Other", last_name="User"))
+    db_session.commit()
+
+    for user_id, shelf_id in ((2, test_shelf.id), (test_user.id, 999)):
+        payload = {"bookmark_id": 2, "title": "New Bookmark", "shelf_id": shelf_id}
+        with query_budget(2):
+            response = client.post("/bookmarks/add_bookmark", json=payload, headers={"x-user-id": str(user_id)})
+        assert response.status_code == 404
+        assert response.json()["detail"] == "Shelf not found"
+    assert db_session.query(BookmarkInShelf).count() == 0
+
+def test_add_bookmarks_batch(client, db_session, test_user, test_shelf, query_budget):
+    """Тест пакетного добавления закладок с результатом по каждому элементу."""
+    db_session.add(Bookmark(id=1))
+    db_session.commit()
+    db_session.add(BookmarkInShelf(fk_shelf=test_shelf.id, fk_bookmark=1, title="Existing"))
+    db_session.commit()
+
+    headers = {"x-user-id": str(test_user.id)}
+    payload = {"bookmarks": [
+        {"bookmark_id": 1, "title": "Existing", "shelf_id": test_shelf.id},
+        {"bookmark_id": 2, "title": "New", "shelf_id": test_shelf.id},
+        {"bookmark_id": 2, "title": "New again", "shelf_id": test_shelf.id},
+        {"bookmark_id": 3, "title": "Lost", "shelf_id": 999},
+    ]}
+    with query_budget(4):
+        response = client.post("/bookmarks/add_bookmarks", json=payload, headers=headers)
+
+    assert response.status_code == 200
+    assert [r["status"] for r in response.json()["results"]] == ["exists", "added", "duplicate", "shelf_not_found"]
+    assert db_session.query(BookmarkInShelf).filter_by(fk_shelf=test_shelf.id).count() == 2
+
+
+def test_add_bookmarks_empty(client, test_user):
+    headers = {"x-user-id": str(test_user.id)}
+    response = client.post("/bookmarks/add_bookmarks", json={"bookmarks": []}, headers=headers)
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Bookmarks list cannot be empty"
+
+
 def test_delete_bookmark_success(client, db_session, test_user, test_shelf, test_bookmark):
     """Тест успешного удаления закладки."""
     db_session.add(BookmarkInShelf(fk_shelf=test_shelf.id, fk_bookmark=test_bookmark.id))
@@ -260,23 +552,168 @@ def test_delete_bookmark_success(client, db_session, test_user, test_shelf, test
     assert response.status_code == 200
     assert response.json()["message"] == "Bookmark removed from shelf"
 
-def test_delete_bookmark_not_found(client, test_user, test_shelf):
+def test_delete_bookmark_not_found(client, test_user, test_shelf, query_budget):
     """Тест удаления несуществующей закладки."""
     headers = {"x-user-id": str(test_user.id)}
     payload = {"bookmark_id": 999, "shelf_id": test_shelf.id}
-    response = client.post("/bookmarks/delete_bookmark_from_shelf", json=payload, headers=headers)
+    with query_budget(3):
+        response = client.post("/bookmarks/delete_bookmark_from_shelf", json=payload, headers=headers)
     assert response.status_code == 200
     assert response.json()["message"] == "Bookmark removed from shelf"
 
-def test_delete_shelf_success(client, db_session, test_user, test_shelf):
+def test_delete_bookmark_foreign_shelf(client, db_session, test_user, test_shelf):
+    """Закладка не удаляется с чужой полки."""
+    db_session.add_all([User(id=2, login="other", first_name="Other", last_name="User"), Bookmark(id=1)])
+    db_session.commit()
+    db_session.add(BookmarkInShelf(fk_shelf=test_shelf.id, fk_bookmark=1, title="First"))
+    db_session.commit()
+
+    payload = {"bookmark_id": 1, "shelf_id": test_shelf.id}
+    response = client.post("/bookmarks/delete_bookmark_from_shelf", json=payload, headers={"x-user-id": "2"})
+    assert response.status_code == 404
+    assert response.json()["detail"] == "Shelf not found"
+    assert db_session.query(BookmarkInShelf).count() == 1
+
+def test_delete_shelf_success(client, db_session, test_user, test_shelf, query_budget):
     """Тест успешного удаления полки."""
     headers = {"x-user-id": str(test_user.id)}
     payload = {"shelf_id": test_shelf.id}
 
-    response = client.post("/bookmarks/delete_shelf", json=payload, headers=headers)
+    with query_budget(4):
+        response = client.post("/bookmarks/delete_shelf", json=payload, headers=headers)
     assert response.status_code == 200
     assert response.json()["message"] == "Shelf removed"
 
+def test_delete_shelf_with_bookmarks(client, db_session, test_user, test_shelf):
+    """Полка удаляется вместе со связями закладок."""
+    db_session.add(Bookmark(id=1))
+    db_session.commit()
+    db_session.add(BookmarkInShelf(fk_shelf=test_shelf.id, fk_bookmark=1, title="First"))
+    db_session.commit()
+
+    headers = {"x-user-id": str(test_user.id)}
+    response = client.post("/bookmarks/delete_shelf", json={"shelf_id": test_shelf.id}, headers=headers)
+    assert response.status_code == 200
+    assert response.json()["message"] == "Shelf removed"
+    assert db_session.query(BookmarkInShelf).count() == 0
+
+def test_delete_shelf_not_found(client, db_session, test_user, test_shelf, query_budget):
+    """Чужая или несуществующая полка не удаляется."""
+    db_session.add(User(id=2, login="other", first_name="Other", last_name="User"))
+    db_session.commit()
+
+    for user_id, shelf_id in ((2, test_shelf.id), (test_user.id, 999)):
+        with query_budget(2):
+            response = client.post("/bookmarks/delete_shelf", json={"shelf_id": shelf_id},
+                                   headers={"x-user-id": str(user_id)})
+        assert response.status_code == 200
+        assert response.json()["message"] == "Nothing to remove"
+    assert db_session.query(Shelf).count() == 1
+
+# Тесты для account
+
+def test_export_import_account(client, db_session, test_user, test_shelf, query_budget):
+    """Выгрузка одного пользователя загружается другому без потерь."""
+    other_user = User(id=2, login="other", first_name="Other", last_name="User")
+    tag = Tag(name="tag1")
+    db_session.add_all([other_user, tag, Bookmark(id=1), Bookmark(id=2)])
+    db_session.commit()
+    db_session.add_all([BookmarkInShelf(fk_shelf=test_shelf.id, fk_bookmark=1, title="First"),
+                        BookmarkInShelf(fk_shelf=test_shelf.id, fk_bookmark=2, title="Second"),
+                        UserTag(user_id=test_user.id, tag_id=tag.id)])
+    db_session.commit()
+
+    with query_budget(most=4):
+        response = client.get("/account/export", headers={"x-user-id": str(test_user.id)})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    records = [json.loads(line) for line in response.text.splitlines()]
+    assert [r["type"] for r in records] == ["shelf", "bookmark", "bookmark", "tag"]
+
+    with query_budget(8):
+        response = client.post("/account/import", content=response.content, headers={"x-user-id": "2"})
+    assert response.status_code == 200
+    assert response.json() == {"shelves": 1, "bookmarks": 2, "tags": 1}
+
+    imported_shelf = db_session.query(Shelf).filter_by(fk_user=2).one()
+    assert imported_shelf.name == test_shelf.name
+    titles = {row.title for row in db_session.query(BookmarkInShelf).filter_by(fk_shelf=imported_shelf.id)}
+    assert titles == {"First", "Second"}
+    assert db_session.query(UserTag).filter_by(user_id=2).count() == 1
+
+
+def test_import_account_invalid_line(client, test_user):
+    headers = {"x-user-id": str(test_user.id)}
+    payload = b'{"type": "shelf", "id": 1, "name": "Shelf"}\n{"type": "unknown"}\n'
+    response = client.post("/account/import", content=payload, headers=headers)
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Invalid record on line 2"
+
+def test_import_account_line_too_large(client, test_user, monkeypatch):
+    monkeypatch.setattr(cfg, "account_max_line_size", 64)
+    headers = {"x-user-id": str(test_user.id)}
+    payload = b'{"type": "shelf", "id": 1, "name": "Shelf"}\n{"type": "shelf", "id": 2, "name": "' + b"x" * 100
+    response = client.post("/account/import", content=payload, headers=headers)
+    assert response.status_code == 413
+    assert response.json()["detail"] == "Record on line 2 is too large"
+
+def test_import_account_counts_inserted(client, db_session, test_user):
+    """Теги, которые уже есть у пользователя, не считаются добавленными."""
+    headers = {"x-user-id": str(test_user.id)}
+    payload = b'{"type": "tag", "name": "tag1"}\n{"type": "tag", "name": "tag2"}\n'
+    response = client.post("/account/import", content=payload, headers=headers)
+    assert response.json() == {"shelves": 0, "bookmarks": 0, "tags": 2}
+    # созданные импортом теги попадают в словарь тегов
+    assert {"tag1", "tag2"} <= tag_dictionary.ids.keys()
+
+    payload = b'{"type": "tag", "name": "tag2"}\n{"type": "tag", "name": "tag3"}\n'
+    response = client.post("/account/import", content=payload, headers=headers)
+    assert response.json() == {"shelves": 0, "bookmarks": 0, "tags": 1}
+    assert db_session.query(UserTag).filter_by(user_id=test_user.id).count() == 3
+
+# Тесты для индексов
+
+@pytest.fixture
+def captured_statements():
+    """Запросы, отправленные приложением в базу во время теста."""
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if not executemany:
+            statements.append((statement, parameters))
+
+    event.listen(async_engine.sync_engine, "before_cursor_execute", capture)
+    yield statements
+    event.remove(async_engine.sync_engine, "before_cursor_execute", capture)
+
+
+def test_router_queries_use_indexes(client, db_session, test_user, test_shelf, captured_statements):
+    """Ни один запрос роутеров не читает большую таблицу последовательно."""
+    headers = {"x-user-id": str(test_user.id)}
+    client.post("/tags/update", json={"tags": ["tag1", "tag2"]}, headers=headers)
+    client.get("/tags/get", headers=headers)
+    client.get("/tags/suggest?q=ta")
+    client.put("/tags/set", json={"tags": ["tag1", "tag3"]}, headers=headers)
+    client.post("/tags/delete", json={"tags": ["tag1"]}, headers=headers)
+    client.post("/bookmarks/create_shelf", json={"name": "Second"}, headers=headers)
+    client.post("/bookmarks/add_bookmark", json={"bookmark_id": 1, "title": "One", "shelf_id": test_shelf.id},
+                headers=headers)
+    client.post("/bookmarks/add_bookmarks",
+                json={"bookmarks": [{"bookmark_id": 2, "title": "Two", "shelf_id": test_shelf.id}]},
+                headers=headers)
+    client.get("/bookmarks/get_only_shelves", headers=headers)
+    client.get("/bookmarks/get_shelves", headers=headers)
+    client.get(f"/bookmarks/get_bookmarks?shelf_id={test_shelf.id}", headers=headers)
+    client.post("/bookmarks/delete_bookmark_from_shelf", json={"bookmark_id": 1, "shelf_id": test_shelf.id},
+                headers=headers)
+    client.get("/account/export", headers=headers)
+    client.post("/bookmarks/delete_shelf", json={"shelf_id": test_shelf.id}, headers=headers)
+    client.get("/users/get", headers=headers)
+
+    assert captured_statements
+    offenders = client.portal.call(find_seq_scans, async_engine, captured_statements)
+    assert offenders == []
+
 # Тесты для models
 
 def test_user_model(db_session):
@@ -352,12 +789,13 @@ def test_bookmark_in_shelf_model(db_session):
 
 # Тесты для tags
 
-def test_update_user_tags_success(client, db_session, test_user):
+def test_update_user_tags_success(client, db_session, test_user, query_budget):
     """Тест успешного добавления тегов."""
     headers = {"x-user-id": str(test_user.id)}
     payload = {"tags": ["tag1", "tag2"]}
 
-    response = client.post("/tags/update", json=payload, headers=headers)
+    with query_budget(3):
+        response = client.post("/tags/update", json=payload, headers=headers)
     assert response.status_code == 200
     assert response.json()["message"] == "Tags successfully saved"
 
@@ -369,6 +807,21 @@ def test_update_user_tags_success(client, db_session, test_user):
     assert len(user_tags) == 2
 
 
+def test_update_user_tags_uses_dictionary(client, db_session, test_user, test_tags, captured_statements):
+    """Известные теги не вставляются повторно, связи пишутся по id из словаря."""
+    headers = {"x-user-id": str(test_user.id)}
+    client.post("/tags/update", json={"tags": ["tag1", "new"]}, headers=headers)
+    assert tag_dictionary.ids.keys() >= {"tag1", "new"}
+
+    captured_statements.clear()
+    response = client.post("/tags/update", json={"tags": ["tag1", "new"]}, headers=headers)
+    assert response.status_code == 200
+    statements = [statement for statement, _ in captured_statements]
+    assert not any("INSERT INTO personal_account.tags" in statement for statement in statements)
+    assert not any("FROM personal_account.tags" in statement for statement in statements)
+    assert db_session.query(UserTag).filter_by(user_id=test_user.id).count() == 2
+
+
 def test_update_user_tags_empty_list(client, test_user):
     """Тест добавления пустого списка тегов."""
     headers = {"x-user-id": str(test_user.id)}
@@ -389,14 +842,15 @@ def test_update_user_tags_user_not_found(client):
     assert response.json()["detail"] == "User with id 999 not found"
 
 
-def test_get_user_tags_success(client, db_session, test_user, test_tags):
+def test_get_user_tags_success(client, db_session, test_user, test_tags, query_budget):
     """Тест успешного получения тегов пользователя."""
     user_tags = [UserTag(user_id=test_user.id, tag_id=tag.id) for tag in test_tags]
     db_session.add_all(user_tags)
     db_session.commit()
 
     headers = {"x-user-id": str(test_user.id)}
-    response = client.get("/tags/get", headers=headers)
+    with query_budget(2):
+        response = client.get("/tags/get", headers=headers)
     assert response.status_code == 200
     assert set(response.json()["tags"]) == {"tag1", "tag2", "tag3"}
 
@@ -419,7 +873,7 @@ def test_get_user_tags_user_not_found(client):
     assert response.json()["detail"] == "User with id 999 not found"
 
 
-def test_delete_user_tags_success(client, db_session, test_user, test_tags):
+def test_delete_user_tags_success(client, db_session, test_user, test_tags, query_budget):
     """Тест успешного удаления тегов пользователя."""
     user_tags = [UserTag(user_id=test_user.id, tag_id=tag.id) for tag in test_tags]
     db_session.add_all(user_tags)
@@ -428,7 +882,8 @@ def test_delete_user_tags_success(client, db_session, test_user, test_tags):
     headers = {"x-user-id": str(test_user.id)}
     payload = {"tags": ["tag1", "tag2"]}
 
-    response = client.post("/tags/delete", json=payload, headers=headers)
+    with query_budget(3):
+        response = client.post("/tags/delete", json=payload, headers=headers)
     assert response.status_code == 200
     assert response.json()["message"] == "Tags successfully deleted"
 
@@ -455,21 +910,189 @@ def test_delete_user_tags_user_not_found(client):
     assert response.status_code == 404
     assert response.json()["detail"] == "User with id 999 not found"
 
+def test_set_user_tags(client, db_session, test_user, test_tags, captured_statements, query_budget):
+    """Замена набора тегов пишет только разницу и сохраняет created_at оставшихся."""
+    kept_at = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    db_session.add_all([UserTag(user_id=test_user.id, tag_id=test_tags[0].id, created_at=kept_at),
+                        UserTag(user_id=test_user.id, tag_id=test_tags[1].id)])
+    db_session.commit()
+    headers = {"x-user-id": str(test_user.id)}
+
+    with query_budget(4):
+        response = client.put("/tags/set", json={"tags": ["tag1", "tag3", "new"]}, headers=headers)
+    assert response.status_code == 200
+    assert response.json() == {"added": ["new", "tag3"], "removed": ["tag2"]}
+    writes = [s for s, _ in captured_statements if "DELETE FROM personal_account.user_tags" in s
+              or "INSERT INTO personal_account.user_tags" in s]
+    assert len(writes) == 1
+
+    user_tags = {tag.name: user_tag.created_at for user_tag, tag in
+                 db_session.query(UserTag, Tag).join(Tag).filter(UserTag.user_id == test_user.id)}
+    assert set(user_tags) == {"tag1", "tag3", "new"}
+    assert user_tags["tag1"] == kept_at
+
+    response = client.put("/tags/set", json={"tags": []}, headers=headers)
+    assert response.json() == {"added": [], "removed": ["new", "tag1", "tag3"]}
+
+
+def refresh_popularity(client=None):
+    async def refresh():
+        async with AsyncSessionLocal() as session:
+            return await tag_suggester.refresh_popularity(session)
+
+    if client is not None:
+        # пул соединений принадлежит циклу событий клиента
+        return client.portal.call(refresh)
+
+    async def refresh_once():
+        updated = await refresh()
+        await async_engine.dispose()
+        return updated
+
+    return asyncio.run(refresh_once())
+
+
+def test_refresh_tag_popularity(db_session, test_user, test_tags):
+    other = User(id=2, login="other", first_name="Other", last_name="User")
+    db_session.add(other)
+    db_session.commit()
+    db_session.execute(insert(UserTag), [{"user_id": user_id, "tag_id": test_tags[0].id}
+                                         for user_id in (test_user.id, other.id)])
+    db_session.execute(insert(UserTag), [{"user_id": other.id, "tag_id": test_tags[1].id}])
+    db_session.commit()
+    # запись user_tags не трогает строки tags
+    db_session.refresh(test_tags[0])
+    assert test_tags[0].popularity == 0
+
+    assert refresh_popularity() == 2
+    db_session.refresh(test_tags[0])
+    db_session.refresh(test_tags[1])
+    assert (test_tags[0].popularity, test_tags[1].popularity) == (2, 1)
+
+    # без изменений повторный проход ничего не переписывает
+    assert refresh_popularity() == 0
+
+    db_session.query(UserTag).delete()
+    db_session.commit()
+    assert refresh_popularity() == 2
+    db_session.refresh(test_tags[0])
+    db_session.refresh(test_tags[1])
+    assert (test_tags[0].popularity, test_tags[1].popularity) == (0, 0)
+
+
+def test_refresh_tag_popularity_single_worker(db_session, test_user, test_tags):
+    """Пока проход выполняет другой процесс, очередь не трогается."""
+    db_session.add(UserTag(user_id=test_user.id, tag_id=test_tags[0].id))
+    db_session.commit()
+
+    db_session.execute(select(func.pg_advisory_xact_lock(POPULARITY_LOCK)))
+    assert refresh_popularity() == 0
+    db_session.commit()
+
+    assert refresh_popularity() == 1
+    db_session.refresh(test_tags[0])
+    assert test_tags[0].popularity == 1
+
+
+def test_suggest_tags(client, db_session, test_user):
+    """Подсказки по префиксу без учёта регистра, популярные первыми."""
+    db_session.add_all([Tag(name="Python"), Tag(name="pytest"), Tag(name="rust"), Tag(name="py_%")])
+    db_session.commit()
+    pytest_tag = db_session.query(Tag).filter_by(name="pytest").one()
+    db_session.add(UserTag(user_id=test_user.id, tag_id=pytest_tag.id))
+    db_session.commit()
+    refresh_popularity(client)
+
+    response = client.get("/tags/suggest?q=PY")
+    assert response.status_code == 200
+    assert response.json()["tags"] == ["pytest", "Python", "py_%"]
+
+    response = client.get("/tags/suggest", params={"q": "py_", "limit": 1})
+    assert response.json()["tags"] == ["py_%"]
+
+    response = client.get("/tags/suggest", params={"q": "py", "limit": 1000})
+    assert response.status_code == 422
+
+    # один символ совпадает с большой частью словаря
+    for q in ("p", " p "):
+        response = client.get("/tags/suggest", params={"q": q})
+        assert response.status_code == 422
+
+
+def test_suggest_tags_fuzzy(client, db_session):
+    if not tag_suggester.fuzzy:
+        pytest.skip("pg_trgm is not installed")
+    db_session.add_all([Tag(name="javascript"), Tag(name="java")])
+    db_session.commit()
+
+    response = client.get("/tags/suggest?q=jvascript")
+    assert response.json()["tags"] == ["javascript"]
+
 # Тесты для files
 
+PNG_BYTES = b"\x89PNG\r\n\x1a\n" + b"test content"
+
 def test_icon_upload(client):
     mock_s3 = MagicMock()
     app.dependency_overrides[get_s3] = lambda: mock_s3
 
     mock_s3.create_key.return_value = "icons/1"
-    mock_s3.upload_file.return_value = "http://example.com/icons/1"
+    mock_s3.get_link.return_value = "http://example.com/icons/1"
 
     response = client.post("/files/icon-upload",
                            headers={"x-user-id": "1"},
-                           files={"file": ("avatar.png", b"test content", "image/png")})
+                           files={"file": ("avatar.png", PNG_BYTES, "image/png")})
 
     assert response.status_code == 200
     assert response.json() == "http://example.com/icons/1"
+    mock_s3.put_object.assert_called_once_with("icons/1", PNG_BYTES, "image/png")
+    mock_s3.start_multipart_upload.assert_not_called()
+
+def test_icon_upload_multipart_chunks(client, monkeypatch):
+    monkeypatch.setattr(cfg, "avatar_upload_chunk_size", 8)
+    mock_s3 = MagicMock()
+    app.dependency_overrides[get_s3] = lambda: mock_s3
+
+    mock_s3.create_key.return_value = "icons/1"
+    mock_s3.start_multipart_upload.return_value = "upload-id"
+    mock_s3.get_link.return_value = "http://example.com/icons/1"
+
+    response = client.post("/files/icon-upload",
+                           headers={"x-user-id": "1"},
+                           files={"file": ("avatar.png", PNG_BYTES, "image/png")})
+
+    assert response.status_code == 200
+    mock_s3.start_multipart_upload.assert_called_once_with("icons/1", "image/png")
+    sent = b"".join(call.args[3] for call in mock_s3.upload_part.call_args_list)
+    assert sent == PNG_BYTES
+    mock_s3.complete_multipart_upload.assert_called_once()
+    mock_s3.put_object.assert_not_called()
+
+def test_icon_upload_rejects_non_image(client):
+    mock_s3 = MagicMock()
+    app.dependency_overrides[get_s3] = lambda: mock_s3
+
+    response = client.post("/files/icon-upload",
+                           headers={"x-user-id": "1"},
+                           files={"file": ("avatar.png", b"test content", "image/png")})
+
+    assert response.status_code == 415
+    mock_s3.put_object.assert_not_called()
+
+def test_icon_upload_too_large(client, monkeypatch):
+    monkeypatch.setattr(cfg, "avatar_max_size", 10)
+    monkeypatch.setattr(cfg, "avatar_upload_chunk_size", 8)
+    mock_s3 = MagicMock()
+    app.dependency_overrides[get_s3] = lambda: mock_s3
+    mock_s3.start_multipart_upload.return_value = "upload-id"
+
+    response = client.post("/files/icon-upload",
+                           headers={"x-user-id": "1"},
+                           files={"file": ("avatar.png", PNG_BYTES, "image/png")})
+
+    assert response.status_code == 413
+    mock_s3.upload_part.assert_not_called()
+    mock_s3.put_object.assert_not_called()
 
 def test_icon_get_link(client):
     mock_s3 = MagicMock()
@@ -491,23 +1114,334 @@ def test_icon_get_link(client):
     assert response.status_code == 404
     assert response.json()["detail"] == "File not found"
 
+# Тесты для cache
+
+def test_ttl_cache_evicts_least_recently_used():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.stats()["hits"] == 3
+
+def test_ttl_cache_expires_entries():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", 1, ttl=0)
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+def test_icon_upload_policy(client):
+    mock_s3 = MagicMock()
+    app.dependency_overrides[get_s3] = lambda: mock_s3
+    mock_s3.create_upload_policy.side_effect = lambda key, max_size, expires: {
+        "url": "http://example.com/bucket", "fields": {"key": key, "policy": "p"}}
+
+    response = client.post("/files/icon-upload-policy", headers={"x-user-id": "1"})
+
+    assert response.status_code == 200
+    body = response.json()
+    key = f"icons/uploads/1/{body['upload_id']}"
+    assert body == {"url": "http://example.com/bucket",
+                    "fields": {"key": key, "policy": "p"},
+                    "max_size": cfg.avatar_max_size,
+                    "upload_id": body["upload_id"]}
+    mock_s3.create_upload_policy.assert_called_once_with(key, cfg.avatar_max_size,
+                                                         cfg.avatar_upload_policy_expires)
+    # каждая политика ведёт в свой временный ключ, а не в ключ аватарки
+    second = client.post("/files/icon-upload-policy", headers={"x-user-id": "1"}).json()
+    assert second["upload_id"] != body["upload_id"]
+
+def test_icon_upload_confirm(client):
+    mock_s3 = MagicMock()
+    app.dependency_overrides[get_s3] = lambda: mock_s3
+
+    upload_id = "0" * 32
+    staging = f"icons/uploads/1/{upload_id}"
+    mock_s3.create_key.side_effect = S3Service.create_key
+    mock_s3.get_metadata.return_value = {"ContentLength": len(PNG_BYTES)}
+    mock_s3.read_head.return_value = PNG_BYTES[:16]
+    mock_s3.copy_object.return_value = '"v1"'
+    mock_s3.get_link.return_value = "http://example.com/icons/1"
+
+    response = client.post("/files/icon-upload-confirm", json={"upload_id": upload_id},
+                           headers={"x-user-id": "1"})
+
+    assert response.status_code == 200
+    assert response.json() == "http://example.com/icons/1"
+    mock_s3.get_metadata.assert_called_once_with(staging)
+    mock_s3.copy_object.assert_called_once_with(staging, "icons/1", "image/png")
+    mock_s3.delete_object.assert_called_once_with(staging)
+
+    mock_s3.reset_mock()
+    mock_s3.read_head.return_value = b"not an image"
+    response = client.post("/files/icon-upload-confirm", json={"upload_id": upload_id},
+                           headers={"x-user-id": "1"})
+    assert response.status_code == 415
+    mock_s3.delete_object.assert_called_once_with(staging)
+    mock_s3.copy_object.assert_not_called()
+
+    mock_s3.get_metadata.return_value = None
+    response = client.post("/files/icon-upload-confirm", json={"upload_id": upload_id},
+                           headers={"x-user-id": "1"})
+    assert response.status_code == 404
+
+    response = client.post("/files/icon-upload-confirm", json={"upload_id": "../../icons/2"},
+                           headers={"x-user-id": "1"})
+    assert response.status_code == 422
+
+def _png(width, height):
+    from PIL import Image
+    output = io.BytesIO()
+    Image.new("RGB", (width, height), "red").save(output, "PNG")
+    return output.getvalue()
+
+def test_render_avatar_variants():
+    pytest.importorskip("PIL")
+    from PIL import Image
+
+    variants = render_variants(_png(300, 200))
+
+    assert sorted(variants) == sorted(cfg.avatar_sizes)
+    for size, body in variants.items():
+        with Image.open(io.BytesIO(body)) as image:
+            assert image.format == "WEBP"
+            assert image.size == (size, size)
+
+def test_render_avatar_variants_pixel_limit(monkeypatch):
+    pytest.importorskip("PIL")
+    monkeypatch.setattr(cfg, "avatar_max_pixels", 100 * 100)
+
+    with pytest.raises(ValueError):
+        render_variants(_png(300, 200))
+
+def test_icon_upload_pixel_limit(client, monkeypatch):
+    pytest.importorskip("PIL")
+    monkeypatch.setattr(cfg, "avatar_max_pixels", 100 * 100)
+    mock_s3 = MagicMock()
+    app.dependency_overrides[get_s3] = lambda: mock_s3
+    mock_s3.create_key.return_value = "icons/1"
+
+    response = client.post("/files/icon-upload", headers={"x-user-id": "1"},
+                           files={"file": ("avatar.png", _png(300, 200), "image/png")})
+    assert response.status_code == 413
+    mock_s3.put_object.assert_not_called()
+
+    # прямая загрузка: временный объект удаляется, аватарка не заменяется
+    upload_id = "0" * 32
+    mock_s3.get_metadata.return_value = {"ContentLength": 1000}
+    mock_s3.read_head.return_value = _png(300, 200)
+    response = client.post("/files/icon-upload-confirm", json={"upload_id": upload_id},
+                           headers={"x-user-id": "1"})
+    assert response.status_code == 413
+    mock_s3.delete_object.assert_called_once_with(f"icons/uploads/1/{upload_id}")
+    mock_s3.copy_object.assert_not_called()
+
+def test_process_avatar_deduplicates(client, db_session, test_user):
+    pytest.importorskip("PIL")
+    mock_s3 = MagicMock()
+    mock_s3.read_object.return_value = _png(64, 64)
+    mock_s3.check_object_exists.return_value = False
+    mock_s3.get_metadata.return_value = {"ETag": '"v1"'}
+
+    content_hash = client.portal.call(process_avatar, mock_s3, test_user.id, "icons/1", '"v1"')
+
+    assert mock_s3.put_object.call_count == len(cfg.avatar_sizes)
+    assert mock_s3.put_object.call_args.args[0] == variant_key(content_hash, max(cfg.avatar_sizes))
+    db_session.expire_all()
+    assert db_session.get(User, test_user.id).avatar_hash == content_hash
+
+    mock_s3.reset_mock()
+    mock_s3.check_object_exists.return_value = True
+    assert client.portal.call(process_avatar, mock_s3, test_user.id, "icons/1", '"v1"') == content_hash
+    mock_s3.put_object.assert_not_called()
+
+def test_process_avatar_skips_replaced_upload(client, db_session, test_user):
+    """Обработка, закончившаяся после новой загрузки, не привязывает свои копии."""
+    pytest.importorskip("PIL")
+    mock_s3 = MagicMock()
+    mock_s3.read_object.return_value = _png(64, 64)
+    mock_s3.check_object_exists.return_value = True
+    mock_s3.get_metadata.return_value = {"ETag": '"v2"'}
+
+    assert client.portal.call(process_avatar, mock_s3, test_user.id, "icons/1", '"v1"') is None
+    db_session.expire_all()
+    assert db_session.get(User, test_user.id).avatar_hash is None
+
+def test_icon_upload_resets_avatar_hash(client, db_session, test_user):
+    """Новая загрузка отвязывает прежние копии, даже если её обработка не удалась."""
+    test_user.avatar_hash = "a" * 64
+    db_session.commit()
+    mock_s3 = MagicMock()
+    app.dependency_overrides[get_s3] = lambda: mock_s3
+    mock_s3.create_key.side_effect = S3Service.create_key
+    mock_s3.put_object.return_value = '"v2"'
+    mock_s3.get_metadata.return_value = {"ETag": '"v2"'}
+    # сигнатура PNG, дальше мусор: построить копии не получится
+    mock_s3.read_object.return_value = PNG_BYTES
+    mock_s3.check_object_exists.return_value = False
+    mock_s3.get_link.return_value = "http://example.com/icons/1"
+    headers = {"x-user-id": str(test_user.id)}
+
+    response = client.post("/files/icon-upload", headers=headers,
+                           files={"file": ("avatar.png", PNG_BYTES, "image/png")})
+    assert response.status_code == 200
+    client.portal.call(wait_avatar_tasks)
+
+    db_session.expire_all()
+    assert db_session.get(User, test_user.id).avatar_hash is None
+    mock_s3.get_link.reset_mock()
+    assert client.get("/files/icon-get-link?size=64", headers=headers).json() == "http://example.com/icons/1"
+    mock_s3.get_link.assert_called_once_with("icons/1")
+
+def test_icon_get_link_sized(client, db_session, test_user):
+    test_user.avatar_hash = "a" * 64
+    db_session.commit()
+    mock_s3 = MagicMock()
+    app.dependency_overrides[get_s3] = lambda: mock_s3
+    mock_s3.get_link.return_value = "http://example.com/avatars/64.webp"
+
+    response = client.get("/files/icon-get-link?size=64", headers={"x-user-id": str(test_user.id)})
+
+    assert response.status_code == 200
+    mock_s3.get_link.assert_called_once_with(variant_key("a" * 64, 64), False)
+
+    response = client.get("/files/icon-get-link?size=65", headers={"x-user-id": str(test_user.id)})
+    assert response.status_code == 400
+
+def test_icon_get_links(client, db_session, test_user, query_budget):
+    db_session.add(User(id=2, login="other", first_name="Other", last_name="User"))
+    test_user.avatar_hash = "a" * 64
+    db_session.commit()
+    mock_s3 = MagicMock()
+    app.dependency_overrides[get_s3] = lambda: mock_s3
+    mock_s3.create_key.side_effect = S3Service.create_key
+
+    def get_link(key, check_exists=True):
+        # подпись ссылок выполняется в пуле потоков, а не в цикле событий
+        with pytest.raises(RuntimeError):
+            asyncio.get_running_loop()
+        if key == "icons/3":
+            raise FileNotFoundError()
+        return f"http://example.com/{key}"
+
+    mock_s3.get_link.side_effect = get_link
+
+    # хэши аватаров всех пользователей читаются одним запросом
+    with query_budget(1):
+        response = client.post("/files/icon-get-links", json={"user_ids": [1, 2, 3], "size": 32})
+
+    assert response.status_code == 200
+    assert response.json() == {"links": {
+        "1": f"http://example.com/{variant_key('a' * 64, 32)}",
+        "2": "http://example.com/icons/2",
+        "3": None,
+    }}
+
+def test_icon_redirect_etag(client, db_session, test_user):
+    test_user.avatar_hash = "a" * 64
+    db_session.commit()
+    mock_s3 = MagicMock()
+    app.dependency_overrides[get_s3] = lambda: mock_s3
+    mock_s3.get_link.return_value = "http://example.com/avatar.webp"
+
+    response = client.get(f"/files/icon/{test_user.id}?size=64", follow_redirects=False)
+    assert response.status_code == 307
+    assert response.headers["location"] == "http://example.com/avatar.webp"
+    etag = response.headers["etag"]
+    assert etag == f'"{"a" * 64}-64"'
+    assert response.headers["cache-control"] == f"public, max-age={cfg.avatar_redirect_max_age}"
+
+    mock_s3.reset_mock()
+    response = client.get(f"/files/icon/{test_user.id}?size=64", headers={"If-None-Match": etag},
+                          follow_redirects=False)
+    assert response.status_code == 304
+    assert response.headers["etag"] == etag
+    mock_s3.get_link.assert_not_called()
+    mock_s3.get_etag.assert_not_called()
+
+def test_icon_redirect_original(client):
+    mock_s3 = MagicMock()
+    app.dependency_overrides[get_s3] = lambda: mock_s3
+    mock_s3.create_key.return_value = "icons/1"
+    mock_s3.get_etag.return_value = '"abc"'
+
+    response = client.get("/files/icon/1", headers={"If-None-Match": 'W/"abc"'}, follow_redirects=False)
+    assert response.status_code == 304
+    mock_s3.get_link.assert_not_called()
+
+    mock_s3.get_etag.return_value = None
+    response = client.get("/files/icon/1", follow_redirects=False)
+    assert response.status_code == 404
+
+def test_etag_matches():
+    assert etag_matches('"a", "b"', '"b"')
+    assert etag_matches("*", '"b"')
+    assert not etag_matches('"a"', '"b"')
+    assert not etag_matches(None, '"b"')
+
+def test_get_etag_cached():
+    mock_s3_client = MagicMock()
+    mock_s3_service = S3Service()
+    mock_s3_service.s3_client = mock_s3_client
+    mock_s3_client.head_object.return_value = {"ETag": '"abc"'}
+
+    assert mock_s3_service.get_etag("icons/1") == '"abc"'
+    assert mock_s3_service.get_etag("icons/1") == '"abc"'
+    mock_s3_client.head_object.assert_called_once()
+
+    mock_s3_service.invalidate_link("icons/1")
+    mock_s3_service.get_etag("icons/1")
+    assert mock_s3_client.head_object.call_count == 2
+    # другие воркеры не видят сброс, поэтому ETag живёт не дольше перенаправления
+    assert mock_s3_service.etags.ttl <= cfg.avatar_redirect_max_age
+
 # Тесты для s3
 
 def test_create_key():
     key = S3Service.create_key("folder", "key")
     assert key == "folder/key"
 
-def test_upload_file():
+def test_ensure_bucket_expires_staging_uploads():
     mock_s3_client = MagicMock()
-    mock_s3_service = S3Service()
-    mock_s3_service.s3_client = mock_s3_client
-    mock_s3_service.bucket_name = "test-bucket"
+    s3 = S3Service()
+    s3.s3_client = mock_s3_client
+    s3.bucket_name = "test-bucket"
+    mock_s3_client.get_bucket_lifecycle_configuration.side_effect = ClientError(
+        {"Error": {"Code": "NoSuchLifecycleConfiguration"}}, "GetBucketLifecycleConfiguration")
+
+    s3.ensure_bucket()
 
-    file = MagicMock()
-    file.file = b"test content"
+    rules = mock_s3_client.put_bucket_lifecycle_configuration.call_args.kwargs["LifecycleConfiguration"]["Rules"]
+    assert rules[0]["Filter"] == {"Prefix": "icons/uploads/"}
+    assert rules[0]["Expiration"] == {"Days": cfg.avatar_staging_expire_days}
 
-    mock_s3_service.upload_file(file, "folder/key")
-    mock_s3_client.upload_fileobj.assert_called_once()
+def test_ensure_bucket_keeps_lifecycle_rules():
+    mock_s3_client = MagicMock()
+    s3 = S3Service()
+    s3.s3_client = mock_s3_client
+    s3.bucket_name = "test-bucket"
+    other = {"ID": "expire-logs", "Filter": {"Prefix": "logs/"}, "Status": "Enabled", "Expiration": {"Days": 7}}
+    mock_s3_client.get_bucket_lifecycle_configuration.return_value = {"Rules": [other]}
+
+    s3.ensure_bucket()
+    rules = mock_s3_client.put_bucket_lifecycle_configuration.call_args.kwargs["LifecycleConfiguration"]["Rules"]
+    assert [rule["ID"] for rule in rules] == ["expire-logs", "expire-avatar-uploads"]
+
+    # правило уже есть: конфигурация не перезаписывается
+    mock_s3_client.reset_mock()
+    mock_s3_client.get_bucket_lifecycle_configuration.return_value = {"Rules": rules}
+    s3.ensure_bucket()
+    mock_s3_client.put_bucket_lifecycle_configuration.assert_not_called()
+
+    # хранилище без жизненного цикла не мешает старту
+    mock_s3_client.get_bucket_lifecycle_configuration.side_effect = ClientError(
+        {"Error": {"Code": "NotImplemented"}}, "GetBucketLifecycleConfiguration")
+    s3.ensure_bucket()
+    mock_s3_client.put_bucket_lifecycle_configuration.assert_not_called()
 
 def test_check_object_exists():
     mock_s3_client = MagicMock()
@@ -538,3 +1472,222 @@ def test_get_link():
         mock_s3_service.get_link("folder/key")
     except FileNotFoundError:
         assert True
+
+def test_get_link_cached():
+    mock_s3_client = MagicMock()
+    mock_s3_service = S3Service()
+    mock_s3_service.s3_client = mock_s3_client
+
+    mock_s3_client.generate_presigned_url.return_value = "http://example.com/folder/key"
+    assert mock_s3_service.get_link("folder/key") == "http://example.com/folder/key"
+    assert mock_s3_service.get_link("folder/key") == "http://example.com/folder/key"
+
+    mock_s3_client.head_object.assert_called_once()
+    mock_s3_client.generate_presigned_url.assert_called_once()
+    assert mock_s3_service.links.stats()["hits"] == 1
+
+    # запись объекта сбрасывает его ссылку
+    mock_s3_service.put_object("folder/key", b"test content", "image/png")
+    mock_s3_service.get_link("folder/key")
+    assert mock_s3_client.head_object.call_count == 2
+
+# Тесты для кэша ответов
+
+class FakeRedis:
+    """Замена Redis в памяти с командами, которые использует RedisBackend."""
+
+    def __init__(self):
+        self.values = {}
+
+    async def get(self, name):
+        return self.values.get(name)
+
+    async def set(self, name, value, ex=None):
+        self.values[name] = value
+
+    async def incr(self, name):
+        self.values[name] = int(self.values.get(name, 0)) + 1
+        return self.values[name]
+
+    async def expire(self, name, ttl):
+        pass
+
+
+@pytest.fixture(params=["local", "redis"])
+def response_backend(request):
+    """Кэш ответов с каждым из хранилищ."""
+    backend = response_cache.backend
+    if request.param == "redis":
+        response_cache.backend = RedisBackend(FakeRedis(), ttl=60)
+    else:
+        response_cache.backend = LocalBackend(maxsize=100, ttl=60)
+    yield response_cache.backend
+    response_cache.backend = backend
+
+
+def test_response_cache_tags(client, db_session, test_user, response_backend, query_budget):
+    """Повторное чтение тегов проверяет только версию пользователя, запись сбрасывает ответ."""
+    headers = {"x-user-id": str(test_user.id)}
+    client.post("/tags/update", json={"tags": ["tag1"]}, headers=headers)
+    assert client.get("/tags/get", headers=headers).json() == {"tags": ["tag1"]}
+
+    with query_budget(1):
+        assert client.get("/tags/get", headers=headers).json() == {"tags": ["tag1"]}
+
+    client.post("/tags/update", json={"tags": ["tag2"]}, headers=headers)
+    assert set(client.get("/tags/get", headers=headers).json()["tags"]) == {"tag1", "tag2"}
+
+
+def test_response_cache_stale_version(client, db_session, test_user, test_tags, response_backend):
+    """Ответ прежней версии не отдаётся, даже если сброс кэша до этого процесса не дошёл."""
+    headers = {"x-user-id": str(test_user.id)}
+    db_session.add(UserTag(user_id=test_user.id, tag_id=test_tags[0].id))
+    db_session.commit()
+    assert client.get("/tags/get", headers=headers).json() == {"tags": ["tag1"]}
+    misses = response_cache.stats()["tags"]["misses"]
+
+    # запись в другом процессе: версия в базе растёт, локальный кэш не сбрасывается
+    db_session.add(UserTag(user_id=test_user.id, tag_id=test_tags[1].id))
+    test_user.data_version += 1
+    db_session.commit()
+
+    response = client.get("/tags/get", headers=headers)
+    assert set(response.json()["tags"]) == {"tag1", "tag2"}
+    assert response.headers["etag"] == f'"{test_user.id}.{test_user.data_version}"'
+    assert response_cache.stats()["tags"]["misses"] == misses + 1
+
+
+def test_response_cache_bookmarks(client, db_session, test_user, response_backend):
+    headers = {"x-user-id": str(test_user.id)}
+    assert client.get("/bookmarks/get_shelves", headers=headers).json()["shelves"] == []
+
+    client.post("/bookmarks/create_shelf", json={"name": "Read later"}, headers=headers)
+    shelves = client.get("/bookmarks/get_shelves", headers=headers).json()["shelves"]
+    assert [shelf["name"] for shelf in shelves] == ["Read later"]
+
+    # страницы кэшируются отдельно
+    assert client.get("/bookmarks/get_only_shelves?limit=1", headers=headers).json()["id"] == [shelves[0]["id"]]
+    client.post("/bookmarks/delete_shelf", json={"shelf_id": shelves[0]["id"]}, headers=headers)
+    assert client.get("/bookmarks/get_only_shelves?limit=1", headers=headers).json()["id"] == []
+
+
+def test_response_cache_key_params(client, db_session, test_user, response_backend):
+    """В ключ попадают только объявленные параметры: посторонние не создают новых записей."""
+    headers = {"x-user-id": str(test_user.id)}
+    client.get("/bookmarks/get_only_shelves?limit=5", headers=headers)
+    hits = response_cache.stats()["bookmarks"]["hits"]
+
+    for junk in range(3):
+        client.get(f"/bookmarks/get_only_shelves?x={junk}&limit=5", headers=headers)
+    assert response_cache.stats()["bookmarks"]["hits"] == hits + 3
+
+
+def test_local_backend_bounded():
+    """Ответы всех пользователей делят один LRU; сброс области не копирует и не перебирает её ответы."""
+    backend = LocalBackend(maxsize=2, ttl=60)
+
+    async def scenario():
+        for key in ("a", "b", "c"):
+            await backend.set("1:tags", key, key.encode())
+        assert backend.size() == 2
+        assert await backend.get("1:tags", "a") is None
+        assert await backend.get("1:tags", "c") == b"c"
+
+        await backend.delete("1:tags")
+        assert await backend.get("1:tags", "c") is None
+        await backend.set("1:tags", "c", b"new")
+        assert await backend.get("1:tags", "c") == b"new"
+
+    asyncio.run(scenario())
+
+
+# Тесты для monitoring
+
+def test_pool_status(client, test_user):
+    client.get("/users/get", headers={"x-user-id": str(test_user.id)})
+
+    response = client.get("/monitoring/pool")
+    assert response.status_code == 200
+    status = response.json()
+    assert status["checkouts"] >= 1
+    assert status["checked_out"] == 0
+    # соединений сверх pool_size не открывалось
+    assert status["overflow"] == 0
+    assert status["wait_max_ms"] >= status["wait_avg_ms"]
+
+def test_metrics(client, test_user, monkeypatch):
+    headers = {"x-user-id": str(test_user.id)}
+    client.get("/tags/get", headers=headers)
+    client.get("/users/get", headers=headers)
+
+    monkeypatch.setattr(cfg, "debug", True)
+    response = client.get("/bookmarks/get_only_shelves", headers=headers)
+    assert 'db;dur=' in response.headers["server-timing"]
+    assert 'desc="2 queries"' in response.headers["server-timing"]
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    metrics = response.text
+    assert 'http_requests_total{method="GET",route="/tags/get",status="404"}' in metrics
+    assert 'http_request_duration_seconds_bucket{method="GET",route="/users/get",le="+Inf"}' in metrics
+    assert 'http_request_db_queries_sum{method="GET",route="/bookmarks/get_only_shelves"}' in metrics
+    assert 'http_requests_in_flight{method="GET"} 1.0' in metrics
+
+def test_slow_query_log(client, test_user, monkeypatch, caplog):
+    monkeypatch.setattr(cfg, "slow_query_threshold_ms", 0.001)
+    monkeypatch.setattr(cfg, "slow_query_explain_rate", 1.0)
+    rate_limiter.reset()
+    headers = {"x-user-id": str(test_user.id)}
+
+    with caplog.at_level("WARNING", logger="app.database.slow_query"):
+        client.get("/tags/suggest?q=secret")
+        client.post("/tags/update", json={"tags": ["tag1"]}, headers=headers)
+    messages = [record.getMessage() for record in caplog.records]
+
+    suggest = next(message for message in messages if "on /tags/suggest" in message)
+    assert "secret" not in suggest
+    assert '"<str:7>"' in suggest
+    assert '"Actual Total Time"' in suggest
+    # изменения объясняются без ANALYZE и не ломают транзакцию самого запроса
+    assert any("on /tags/update" in message and "UPDATE" in message and '"Node Type"' in message
+               for message in messages)
+    assert client.get("/tags/get", headers=headers).json() == {"tags": ["tag1"]}
+
+def test_slow_query_rate_limit(monkeypatch):
+    monkeypatch.setattr(cfg, "slow_query_log_per_minute", 2)
+    rate_limiter.reset()
+    assert rate_limiter.acquire() == 0
+    assert rate_limiter.acquire() == 0
+    assert rate_limiter.acquire() is None
+    rate_limiter.updated -= 60
+    assert rate_limiter.acquire() == 1
+
+def test_redact():
+    assert redact((1, "login", b"ab", None, [True, 2.5])) == [1, "<str:5>", "<bytes:2>", None, [True, 2.5]]
+
+def test_histogram():
+    histogram = Histogram("test_seconds", "Test.", ("route",), buckets=(0.1, 1.0))
+    histogram.observe(0.05, "/a")
+    histogram.observe(0.5, "/a")
+    histogram.observe(5, "/a")
+    assert histogram.collect()[2:] == [
+        'test_seconds_bucket{route="/a",le="0.1"} 1',
+        'test_seconds_bucket{route="/a",le="1.0"} 2',
+        'test_seconds_bucket{route="/a",le="+Inf"} 3',
+        'test_seconds_sum{route="/a"} 5.55',
+        'test_seconds_count{route="/a"} 3',
+    ]
+
+def test_cache_status(client, test_user):
+    headers = {"x-user-id": str(test_user.id)}
+    client.get("/bookmarks/get_only_shelves", headers=headers)
+    client.get("/bookmarks/get_only_shelves", headers=headers)
+
+    client.get("/tags/get", headers=headers)
+
+    response = client.get("/monitoring/cache")
+    assert response.status_code == 200
+    caches = response.json()
+    assert caches["responses.bookmarks"]["hits"] >= 1
+    assert caches["responses.bookmarks"]["hit_ratio"] > 0